@@ -0,0 +1,110 @@
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from tracing import count
+
+# 意味的に近い質問に対する回答のキャッシュ
+# 同じインデックス・検索設定(scope)で、質問のベクトルのコサイン類似度が threshold 以上のキャッシュがあれば、その回答と参照元を返す
+# 有効期限(ttl 秒)を過ぎたもの、件数が max_items を超えた場合は最終アクセスが古いもの(LRU)から削除する
+# get_ingested_at(index_name, file_names) を指定した場合、回答の参照元のファイルがキャッシュ後に再登録されていれば無効にする
+
+
+class SemanticAnswerCache:
+    def __init__(self, max_items, ttl, threshold, get_ingested_at=None):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.threshold = threshold
+        self.get_ingested_at = get_ingested_at
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    # 近い質問のキャッシュを探す。見つかった場合はキャッシュの内容(dict)、見つからない場合は None を返す
+    # scope の先頭はインデックス名(複数のインデックスを検索する場合はインデックス名のタプル)にする
+    # 類似度が threshold 以上のキャッシュを類似度の高い順に確認し、参照元のファイルが再登録されていない最初のものを使う
+    def lookup(self, scope, vector):
+        query = self.__normalize(vector)
+        now = time.time()
+        with self.lock:
+            candidates = []
+            for entry_id, entry in list(self.entries.items()):
+                if now - entry["created_at"] > self.ttl:
+                    del self.entries[entry_id]
+                    continue
+                if entry["scope"] != scope:
+                    continue
+                score = float(entry["vector"] @ query)
+                if score >= self.threshold:
+                    candidates.append((score, entry_id, entry))
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        best_id, best_score, entry = None, None, None
+        for score, entry_id, candidate in candidates:
+            # 参照元のファイルが再登録されていないか確認する(ロックの外で行う)。再登録されていれば削除して次に近いものを確認する
+            if self.get_ingested_at is not None:
+                ingested_at = max(self.get_ingested_at(index_name, candidate["file_names"]) for index_name in self.__index_names(scope))
+                if ingested_at > candidate["created_at"]:
+                    with self.lock:
+                        self.entries.pop(entry_id, None)
+                    continue
+            best_id, best_score, entry = entry_id, score, candidate
+            break
+        count("cache.answer.hits" if entry is not None else "cache.answer.misses")
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            if best_id in self.entries:
+                self.entries.move_to_end(best_id)
+            self.hits += 1
+            self.saved_seconds += entry["seconds"]
+            return dict(entry, score=best_score)
+
+    # 回答をキャッシュする。seconds は回答の生成にかかった時間(ヒット時に短縮できた時間として集計する)
+    def store(self, scope, vector, question, answer, sources, file_names, seconds):
+        with self.lock:
+            self.entries[self.next_id] = {
+                "scope": scope,
+                "vector": self.__normalize(vector),
+                "question": question,
+                "answer": answer,
+                "sources": sources,
+                "file_names": set(file_names),
+                "seconds": seconds,
+                "created_at": time.time(),
+            }
+            self.next_id += 1
+            while len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+
+    # 指定したファイルを参照元に含むキャッシュを削除する
+    def invalidate_files(self, index_name, file_names):
+        file_names = set(file_names)
+        with self.lock:
+            for entry_id, entry in list(self.entries.items()):
+                if index_name in self.__index_names(entry["scope"]) and entry["file_names"] & file_names:
+                    del self.entries[entry_id]
+
+    # ヒット率(%)と短縮できた時間(秒)を返す
+    def metrics(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "items": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total * 100 if total else 0.0,
+                "saved_seconds": self.saved_seconds,
+            }
+
+    @staticmethod
+    def __index_names(scope):
+        return scope[0] if isinstance(scope[0], tuple) else (scope[0],)
+
+    @staticmethod
+    def __normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
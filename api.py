@@ -0,0 +1,161 @@
+import os
+import json
+import random
+import string
+import asyncio
+from datetime import datetime
+from typing import List, Literal, Optional
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+# 環境変数を読み込む
+load_dotenv()
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from rag import answer_events
+from diversify import MMR_ENABLED, MMR_LAMBDA, MMR_MAX_PER_FILE
+from cosmos_writer import TRANSIENT_STATUS_CODES
+from tracing import span, count, flush
+from clients import get_async_openai_client, get_async_search_client, get_async_cosmos_container, close_async_clients
+
+# RAG の API サーバー(asyncio)
+# app.py と同じ検索・プロンプトの作成・参照元の抽出(rag.py)を、非同期のクライアント(clients.get_async_*)で実行する
+# 1プロセスで多数のリクエストを同時に処理でき、回答は Server-Sent Events でトークンごとに返す
+#   uvicorn api:app --host 0.0.0.0 --port 8000
+#   curl -N -X POST http://localhost:8000/chat -H "Content-Type: application/json" -d '{"query": "経費精算の手順は？"}'
+# SSE のイベント: sources(プロンプトに入れた情報源)、token(回答の断片)、done(回答全体・参照元・トークン数)、error
+
+AZURE_OPENAI_CHAT_MODEL = os.getenv("AZURE_OPENAI_CHAT_MODEL")
+AZURE_OPENAI_EMBED_MODEL = os.getenv("AZURE_OPENAI_EMBED_MODEL")
+AZURE_OPENAI_CHAT_MAX_TOKENS = int(os.getenv("AZURE_OPENAI_CHAT_MAX_TOKENS", "1000"))
+AI_SEARCH_INDEX_NAME = os.getenv("AI_SEARCH_INDEX_NAME")
+COSMOS_CONTAINER_NAME_CHAT = os.getenv("COSMOS_CONTAINER_NAME_CHAT")
+
+# 同時に処理するリクエスト数の上限(超えた分は空くまで待つ)と、チャット履歴を Cosmos DB に保存するか
+API_MAX_CONCURRENCY = int(os.getenv("API_MAX_CONCURRENCY", "256"))
+API_CHAT_LOG_ENABLED = os.getenv("API_CHAT_LOG_ENABLED", "true").lower() in ("1", "true", "yes")
+
+__semaphore = asyncio.Semaphore(API_MAX_CONCURRENCY)
+# 実行中のチャット履歴の書き込み(終了時に完了を待つ)
+__background_tasks = set()
+
+
+class ChatMessage(BaseModel):
+    role: str
+    content: str
+
+
+class ChatRequest(BaseModel):
+    query: str
+    index: Optional[str] = None
+    search_type: Literal["Vector_only", "Hybrid", "Semantic_Hybrid"] = "Hybrid"
+    top_k: int = 10
+    mmr: bool = MMR_ENABLED
+    mmr_lambda: float = MMR_LAMBDA
+    max_per_file: int = MMR_MAX_PER_FILE
+    temperature: float = 0.0
+    history: List[ChatMessage] = []
+    session_id: Optional[str] = None
+    stream: bool = True
+
+
+# 終了時に、チャット履歴の書き込みを待ってから非同期のクライアントを閉じる
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    if __background_tasks:
+        await asyncio.gather(*__background_tasks, return_exceptions=True)
+    await close_async_clients()
+    flush()
+
+
+app = FastAPI(title="RAG API", lifespan=lifespan)
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+
+# 質問に回答する。stream=true(既定)の場合は SSE で、false の場合は回答全体を JSON で返す
+@app.post("/chat")
+async def chat(request: ChatRequest):
+    if request.stream:
+        return StreamingResponse(
+            __sse(request), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    response = {}
+    async for event, data in __events(request):
+        if event == "sources":
+            response["sources"] = data
+        elif event == "done":
+            response.update(data)
+    response.pop("prompt_source", None)
+    return response
+
+
+# 回答のイベントを順に返す。回答が完了したらチャット履歴の保存をバックグラウンドで開始する
+async def __events(request):
+    index_name = request.index or AI_SEARCH_INDEX_NAME
+    async with __semaphore:
+        with span("api_chat", index=index_name, search_type=request.search_type, top_k=request.top_k):
+            events = answer_events(
+                get_async_openai_client(), get_async_search_client(index_name), index_name, request.query,
+                AZURE_OPENAI_CHAT_MODEL, AZURE_OPENAI_EMBED_MODEL,
+                search_type=request.search_type,
+                top_k=request.top_k,
+                mmr_lambda=request.mmr_lambda if request.mmr else None,
+                max_per_file=request.max_per_file,
+                temperature=request.temperature,
+                max_tokens=AZURE_OPENAI_CHAT_MAX_TOKENS,
+                history=[message.model_dump() for message in request.history],
+            )
+            async for event, data in events:
+                if event == "done":
+                    count("tokens.prompt", data["prompt_tokens"]["total"])
+                    if API_CHAT_LOG_ENABLED:
+                        __save_chat_turn(request, data)
+                yield event, data
+
+
+# イベントを SSE の形式にする。エラーの場合は error イベントを返して終了する
+async def __sse(request):
+    try:
+        async for event, data in __events(request):
+            if event == "done":
+                data = {key: value for key, value in data.items() if key != "prompt_source"}
+            yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    except Exception as e:
+        print("api error:", type(e).__name__, e)
+        yield f"event: error\ndata: {json.dumps({'message': str(e)}, ensure_ascii=False)}\n\n"
+
+
+# 1ターン分のチャット履歴(app.py の CHAT_LOG_SCHEMA=compact と同じ eval 形式)の保存をバックグラウンドで開始する
+def __save_chat_turn(request, data):
+    item = {
+        "id": "".join(random.choice(string.ascii_letters + string.digits) for _ in range(20)),
+        "session": request.session_id or "api",
+        "role": "eval",
+        "question": request.query,
+        "answer": data["answer"],
+        "context": data["prompt_source"],
+        "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "tokens": data["prompt_tokens"],
+    }
+    task = asyncio.create_task(__upsert_with_retry(item))
+    __background_tasks.add(task)
+    task.add_done_callback(__background_tasks.discard)
+
+
+# 一時的なエラーの場合は待ってから再実行する
+async def __upsert_with_retry(item, max_retries=5):
+    for attempt in range(max_retries + 1):
+        try:
+            await get_async_cosmos_container(COSMOS_CONTAINER_NAME_CHAT).upsert_item(item)
+            return
+        except Exception as e:
+            if getattr(e, "status_code", None) not in TRANSIENT_STATUS_CODES or attempt == max_retries:
+                print("failed to write to cosmos db:", item["id"], e)
+                return
+            count("retries.cosmos")
+            await asyncio.sleep(min(30, 0.5 * 2 ** attempt) + random.uniform(0, 0.5))
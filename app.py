@@ -1,34 +1,32 @@
 import os
-import re
 import json
-import logging
 import random
 import string
-import tempfile
+import time
+import threading
 from datetime import datetime
-from openai import AzureOpenAI
 from dotenv import load_dotenv
 # 環境変数を読み込む
 load_dotenv()
 
 import streamlit as st
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from azure.search.documents.indexes import SearchIndexClient
-from azure.search.documents.models import VectorizedQuery
-from azure.cosmos import PartitionKey
-from azure.cosmos.cosmos_client import CosmosClient
-from azure.storage.blob import BlobServiceClient
 
 # 他のスクリプトから関数をインポート
-from preparedata import process_file
-
-# envファイルから環境変数を取得
-client = AzureOpenAI(
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-    api_version=os.getenv("AZURE_OPENAI_API_VERSION")
-)
+# インデックス作成の処理(preparedata)はファイルのアップロード時に読み込む
+from kvcache import EmbeddingCache, MemoryLRUCache, SqliteLRUCache, make_key
+from cosmos_writer import BackgroundWriter
+from rag import SystemPrompt, normalize_query, embed_query, search_documents, stream_answer
+from answercache import SemanticAnswerCache
+from manifest import Manifest
+from diversify import MMR_ENABLED, MMR_LAMBDA, MMR_FETCH_FACTOR, MMR_MAX_PER_FILE, diversify
+from fanout import parse_index_names, search_indexes, merge_results
+from promptbuilder import build_prompt, sources_from_results, cited_sources, format_source, format_display_source, format_history, count_tokens
+from tracing import traced, span, count, format_stages, profile
+from clients import get_openai_client, get_search_client, get_cosmos_container, format_connection_stats
+from startup import format_report
+from provision import warm_up
+
+# クライアントはプロセス内で共有されるため、再実行時も作り直されない。初めて使うとき(またはウォームアップ時)に生成する
 
 # Azure OpenAI Service の情報を環境変数から取得する
 AZURE_OPENAI_CHAT_MODEL = os.getenv("AZURE_OPENAI_CHAT_MODEL")
@@ -39,15 +37,9 @@ AZURE_OPENAI_CHAT_MAX_TOKENS = int(os.getenv("AZURE_OPENAI_CHAT_MAX_TOKENS", "10
 COSMOS_CONNECTION_STRING = os.getenv("COSMOS_CONNECTION_STRING")
 COSMOS_DB_NAME = os.getenv("COSMOS_DB_NAME")
 COSMOS_CONTAINER_NAME_CHAT = os.getenv("COSMOS_CONTAINER_NAME_CHAT")
-
-# Cosmos DB クライアントを生成する
-cosmos_client = CosmosClient.from_connection_string(COSMOS_CONNECTION_STRING)
-database = cosmos_client.get_database_client(COSMOS_DB_NAME)
-database.create_container_if_not_exists(
-    id=COSMOS_CONTAINER_NAME_CHAT,
-    partition_key=PartitionKey(path=f"/id"),
-)
-container = database.get_container_client(COSMOS_CONTAINER_NAME_CHAT)
+# チャット履歴の保存形式。full: user/assistant/context/eval の4ドキュメント、compact: 1ターン1ドキュメント(eval形式)
+CHAT_LOG_SCHEMA = os.getenv("CHAT_LOG_SCHEMA", "full")
+CHAT_LOG_QUEUE_SIZE = int(os.getenv("CHAT_LOG_QUEUE_SIZE", "1000"))
 
 # Azure AI Search の情報を環境変数から取得する
 AI_SEARCH_ENDPOINT = os.getenv("AI_SEARCH_ENDPOINT")
@@ -57,120 +49,151 @@ AI_SEARCH_INDEX_NAME = os.getenv("AI_SEARCH_INDEX_NAME")
 AI_SEACH_SEMANTIC = os.getenv("AI_SEACH_SEMANTIC")
 top_k_temp = 10  # 検索結果の上位何件を表示するか
 
-# Azure Blob Storage の情報を環境変数から取得する
-BLOB_STORAGE_CONNECTION_STRING = os.getenv("BLOB_STORAGE_CONNECTION_STRING")
-BLOB_CONTAINER_NAME = os.getenv("BLOB_CONTAINER_NAME")
-
-# Blob Storage クライアントを作成
-blob_service_client = BlobServiceClient.from_connection_string(BLOB_STORAGE_CONNECTION_STRING)
-blob_container_client = blob_service_client.get_container_client(BLOB_CONTAINER_NAME)
-# コンテナが存在しない場合は作成
-try:
-    blob_container_client.get_container_properties()
-except Exception:
-    blob_container_client.create_container()
-
-# OpenAIへのプロンプト設計を行う。
-SystemPrompt = """あなたは、会社の従業員が社内のナレッジやドキュメントに対する質問をする際に支援する優秀なアシスタントです。
-以下の制約を必ず守ってユーザの質問に回答してください。
-ハルシネーションは起こさないでください。
-魅力的で丁寧な回答をする必要があります。
-最初から最後までじっくり読んで回答を作ってください。最高の仕事をしましょう
-
-# 制約 
-・以下のSources(情報源)に記載されたコンテキストのみを使用して回答してください。必ず情報源に記載されたコンテキストを基に回答を作ってください
-・十分な情報がない場合は、わからないと回答してください。
-・以下のSources(情報源)を使用しない回答は生成しないでください 。回答には役割(userやassistantなど)の情報を含めないでください。
-・ユーザーの質問が不明瞭な場合は、明確化のためにユーザに質問してください。
-・Sourcesには、名前の後にコロンと実際の情報が続きます。回答で使用する各事実について、常にSourcesの情報を含めてください。
-  情報源を参照するには、各Content情報の前段にあるfilenameの情報を反映してください。角かっこを使用してください。
-  Sources参照ルール：[filename] 　Sources出力例：[info1.txt]
-・Sourcesを組み合わせないでください。各Sourcesを個別にリストしてください。例：[info1.txt],[info1.txt]
-・日本語の質問の場合は、日本語で回答を作成してください。英語での質問の場合は、英語で回答を作成し回答してください。    
-"""
+# 質問のベクトルのキャッシュ設定。QUERY_EMBED_CACHE_PATH を指定した場合はディスクにも保存する
+QUERY_EMBED_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", "1000"))
+QUERY_EMBED_CACHE_TTL = int(os.getenv("QUERY_EMBED_CACHE_TTL", "86400"))
+QUERY_EMBED_CACHE_PATH = os.getenv("QUERY_EMBED_CACHE_PATH")
+QUERY_EMBED_CACHE_MAX_MB = int(os.getenv("QUERY_EMBED_CACHE_MAX_MB", "256"))
+
+# 回答のキャッシュ設定。同じインデックス・検索設定で、質問のコサイン類似度が ANSWER_CACHE_THRESHOLD 以上なら回答を再利用する
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "500"))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "3600"))
+
+# 古い会話履歴を要約する際の最大出力トークン数
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "500"))
+
+# 起動時にバックグラウンドでウォームアップ(クライアントの生成と各サービスへの初回リクエスト)を行うか
+WARM_UP_ON_START = os.getenv("WARM_UP_ON_START", "true").lower() in ("1", "true", "yes")
+
+# プロセスの起動後に1回だけ、バックグラウンドでウォームアップを開始する。最初の質問を待たせないため、画面の表示は待たない
+@st.cache_resource
+def start_warm_up():
+    thread = threading.Thread(target=warm_up, kwargs={"index_name": AI_SEARCH_INDEX_NAME}, daemon=True)
+    thread.start()
+    return thread
+
+# 質問のベクトルのキャッシュ。全セッションで共有するため cache_resource で1つだけ生成する
+@st.cache_resource
+def get_query_embedding_cache():
+    memory = MemoryLRUCache(QUERY_EMBED_CACHE_SIZE, QUERY_EMBED_CACHE_TTL)
+    disk = None
+    if QUERY_EMBED_CACHE_PATH:
+        disk = SqliteLRUCache(QUERY_EMBED_CACHE_PATH, QUERY_EMBED_CACHE_MAX_MB * 1024 * 1024)
+    return EmbeddingCache(memory, disk)
+
+# 回答のキャッシュ。参照元のファイルが再登録された場合は、マニフェストの登録時刻と比較して無効にする
+@st.cache_resource
+def get_answer_cache():
+    manifest = Manifest()
+    return SemanticAnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_THRESHOLD, get_ingested_at=manifest.get_ingested_at)
 
 # Function to generate embeddings for title and content fields, also used for query embeddings
+@traced("generate_embeddings")
 def generate_embeddings(text, text_limit=7000):
-    # Clean up text (e.g. line breaks, )
-    text = re.sub(r'\s+', ' ', text).strip()
-    text = re.sub(r'[\n\r]+', ' ', text).strip()
-    # Truncate text if necessary
-    if len(text) > text_limit:
-        logging.warning("Token limit exceeded maximum length, truncating...")
-        text = text[:text_limit]
-
-    response = client.embeddings.create(model=AZURE_OPENAI_EMBED_MODEL, input=text)
-    embeddings = response.data[0].embedding
-    return embeddings
-
-def query_vector_index(index_name, query, searchtype, top_k_parameter):
+    text = normalize_query(text, text_limit)
+
+    # 整形後のテキストをキーにキャッシュを参照する
+    def generate():
+        return embed_query(get_openai_client(), AZURE_OPENAI_EMBED_MODEL, text)
+
+    cache_key = make_key("query", AZURE_OPENAI_EMBED_MODEL, text)
+    return get_query_embedding_cache().get_or_generate(cache_key, generate)
+
+# index_names に複数のインデックスを指定した場合は、同じ質問のベクトルで同時に検索し、結果を1つの順位にまとめる(fanout.py)
+# 1つの場合も含め、FANOUT_TIMEOUT_SECONDS 以内に応答がないかエラーになったインデックスの結果は使わない
+# mmr_lambda を指定した場合は、検索結果を多めに取得して MMR で多様化し、同じファイルの連続するチャンクをまとめる
+# 戻り値は (検索結果のリスト, 結果を取得できなかったインデックス名のリスト)
+@traced("query_vector_index")
+def query_vector_index(index_names, query, searchtype, top_k_parameter, mmr_lambda=None, max_per_file=MMR_MAX_PER_FILE):
     vector = generate_embeddings(query)
-    search_client = SearchClient(AI_SEARCH_ENDPOINT, index_name, AzureKeyCredential(AI_SEARCH_KEY))
-    vector_query = VectorizedQuery(vector=vector, fields="contentVector")
-    # searchtypeがvector_onlyの場合は、search_textをNoneにする
-    if searchtype == "Vector_only":
-        search_text = None
-    # searchtypeがvector_only以外の場合は、search_textにqueryを設定する
-    else:
-        search_text = query
+    top_k = int(top_k_parameter)
+    fetch_k = top_k if mmr_lambda is None else top_k * MMR_FETCH_FACTOR
 
-    # searchtypeがvector_onlyもしくはHybridの場合
-    if searchtype == "Vector_only" or searchtype == "Hybrid":
-        results = search_client.search(search_text=search_text, vector_queries=[vector_query], top=int(top_k_parameter))
-    # searchtypeがFullの場合
+    def search(index_name, timeout):
+        return search_documents(get_search_client(index_name), index_name, query, vector, searchtype, fetch_k,
+                                with_vectors=mmr_lambda is not None, timeout=timeout)
+
+    results_by_index = search_indexes(index_names, search)
+    failed = [index_name for index_name in index_names if index_name not in results_by_index]
+    if len(index_names) == 1:
+        results = results_by_index.get(index_names[0], [])
     else:
-        results = search_client.search(search_text=search_text, vector_queries=[vector_query], top=int(top_k_parameter),
-                                       query_type='semantic', semantic_configuration_name=AI_SEACH_SEMANTIC)
+        results = merge_results(results_by_index, fetch_k)
+    if mmr_lambda is None:
+        return results, failed
+    with span("diversify", candidates=len(results)):
+        return diversify(results, top_k, mmr_lambda, max_per_file), failed
+
+# 古い会話履歴をこれまでの要約にまとめる
+def summarize_history(summary, messages):
+    prompt = "以下の「これまでの要約」と「会話」をまとめて、後続の質問に回答するために必要な事実・質問の意図・回答の要点を残した簡潔な要約を日本語で作成してください。\n\n"
+    prompt += "# これまでの要約\n\n" + (summary or "なし") + "\n\n# 会話\n\n" + format_history(messages)
+    response = get_openai_client().chat.completions.create(
+        model=AZURE_OPENAI_CHAT_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0.0,
+        max_tokens=HISTORY_SUMMARY_MAX_TOKENS,
+    )
+    print("history summarized:", len(messages), "messages")
+    return response.choices[0].message.content
 
-    return results
+# chat履歴を書き込むバックグラウンドライター。全セッションで共有するため cache_resource で1つだけ生成する
+@st.cache_resource
+def get_chat_log_writer():
+    return BackgroundWriter(get_cosmos_container(COSMOS_CONTAINER_NAME_CHAT), max_queue_size=CHAT_LOG_QUEUE_SIZE)
 
-# chat履歴を Cosmos DB に保存する
+# chat履歴を Cosmos DB に保存する。書き込みはバックグラウンドで行われる
+@traced("add_to_cosmos")
 def add_to_cosmos(item):
-    container.upsert_item(item)
+    get_chat_log_writer().put(item)
+
+# 1ターン分のchat履歴を Cosmos DB に保存する
+# tokens にはプロンプトのトークン数の内訳を指定する(eval ドキュメントに保存する)
+def save_chat_turn(session_id, user_input, response, prompt_source, tokens=None):
+    date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # compact の場合は eval ドキュメントのみを保存する(評価用ノートブックはこの形式を参照する)
+    if CHAT_LOG_SCHEMA == "compact":
+        add_to_cosmos({"id": randomname(20), "session": session_id, "role": "eval", "question": user_input, "answer": response, "context": prompt_source, "date": date, "tokens": tokens})
+        return
+
+    # idにはランダム値を挿入する
+    id1 = randomname(20)
+    id2 = randomname(20)
+    id3 = randomname(20)
+    id4 = randomname(20)
+
+    add_to_cosmos({"id": id1, "session": session_id, "role": "user", "content": user_input})
+    add_to_cosmos({"id": id2, "session": session_id, "role": "assistant", "content": response})
+    add_to_cosmos({"id": id3, "session": session_id, "role": "context", "content": prompt_source})
+    add_to_cosmos({"id": id4, "session": session_id, "role": "eval", "question": user_input, "answer": response, "context": prompt_source, "date": date, "tokens": tokens})
 
 def randomname(n):
     randlst = [random.choice(string.ascii_letters + string.digits) for i in range(n)]
     return ''.join(randlst)
 
-def upload_file_to_blob_storage(uploaded_file):
-    blob_client = blob_container_client.get_blob_client(uploaded_file.name)
-    blob_client.upload_blob(uploaded_file.getbuffer(), overwrite=True)
-    print(f"Uploaded {uploaded_file.name} to Blob Storage.")
-
-def download_file_from_blob_storage(file_name):
-    blob_client = blob_container_client.get_blob_client(file_name)
-    download_file_path = os.path.join(tempfile.gettempdir(), file_name)
-    with open(download_file_path, "wb") as download_file:
-        download_data = blob_client.download_blob()
-        download_data.readinto(download_file)
-    print(f"Downloaded {file_name} from Blob Storage to {download_file_path}.")
-    return download_file_path
-
 def process_uploaded_file(uploaded_file, index_name):
-    # ファイルをBlob Storageにアップロード
-    upload_file_to_blob_storage(uploaded_file)
-
-    # Blob Storageからファイルをダウンロード
-    downloaded_file_path = download_file_from_blob_storage(uploaded_file.name)
-
-    # Args クラスを定義
-    class Args:
-        def __init__(self):
-            self.blob = None
+    from preparedata import process_buffer, print_cache_stats
 
-    # args をインスタンス化し、blob を設定
-    args = Args()
-    args.blob = 1  # または適切な値
+    # アップロードされたファイルをメモリ上のまま処理する。Blob Storage へのアップロードは OCR・登録と並行して行う
+    process_buffer(uploaded_file.getbuffer(), uploaded_file.name, index_name, upload_to_blob=True)
+    print_cache_stats()
 
-    # ファイルを処理
-    process_file(downloaded_file_path, index_name, args)
-
-    # ダウンロードした一時ファイルを削除
-    os.remove(downloaded_file_path)
+    # 再登録したファイルを参照する回答のキャッシュを削除
+    get_answer_cache().invalidate_files(index_name, [uploaded_file.name])
 
     # アップロード済みフラグを設定
     st.session_state['file_processed'] = True
 
+#output内に[]形式がある場合は、[]内のファイル名を取得し、sourcetemp内のfilenameと一致するものを探索する
+#一致するものがあれば、sourcetemp内の内容を表示する。既に1回表示されている場合は、2回目以降は表示しない
+def show_sources(response, sourcetemp):
+    with st.expander("参照元"):
+        for filename, source in cited_sources(response, sourcetemp, text=str):
+            with st.popover(filename):
+                st.write(source)
+
 def main():
     # Set page title and icon
     st.set_page_config(page_title="RAG App", page_icon="💬", layout="wide")
@@ -182,6 +205,9 @@ def main():
     st.sidebar.header("Sample RAG App")
     st.sidebar.markdown("RAGを検証するサンプルアプリケーション")
 
+    if WARM_UP_ON_START:
+        start_warm_up()
+
     # セッションIDの初期化
     if "session_id" not in st.session_state:
         st.session_state['session_id'] = randomname(10)
@@ -190,6 +216,10 @@ def main():
     if "messages" not in st.session_state:
         st.session_state['messages'] = []
 
+    # 古い会話履歴の要約の初期化
+    if "history_summary" not in st.session_state:
+        st.session_state['history_summary'] = {"summary": "", "count": 0}
+
     # ファイル処理済みフラグの初期化
     if 'file_processed' not in st.session_state:
         st.session_state['file_processed'] = False
@@ -197,6 +227,7 @@ def main():
     # クリアボタンを押した場合、チャットとst.text_input,promptallをクリアする。
     if st.sidebar.button("Clear Chat"):
         st.session_state['messages'] = []
+        st.session_state['history_summary'] = {"summary": "", "count": 0}
         promptall = ""
         # 新しいセッションIDを生成して保存
         st.session_state['session_id'] = randomname(10)
@@ -206,7 +237,9 @@ def main():
         st.rerun()
         
     # インデックスの名前をテキストボックスで指定する。indexnameの設定
-    indexname = st.sidebar.text_input("インデックス名", AI_SEARCH_INDEX_NAME)
+    # カンマ区切りで複数のインデックスを指定すると、全てのインデックスを同時に検索する。ファイルは先頭のインデックスに登録する
+    indexname = st.sidebar.text_input("インデックス名(カンマ区切りで複数指定可)", AI_SEARCH_INDEX_NAME)
+    index_names = parse_index_names(indexname) or [AI_SEARCH_INDEX_NAME]
 
     # ファイルアップロード機能を追加
     st.sidebar.markdown("### ファイルアップロード")
@@ -217,7 +250,7 @@ def main():
             uploaded_file = st.file_uploader("ファイルをアップロードしてください", type=['pdf', 'txt'])
             if uploaded_file is not None:
                 with st.spinner('ファイルを処理しています...'):
-                    process_uploaded_file(uploaded_file, indexname)
+                    process_uploaded_file(uploaded_file, index_names[0])
                 st.success(f"ファイル '{uploaded_file.name}' の処理が完了しました")
                 st.session_state['file_processed'] = True
                 # ファイルアップローダーを削除
@@ -235,6 +268,32 @@ def main():
     # 検索のタイプを選択する。vector_only or Hybrid or Fullの選択。1つの選択可能
     search_type = st.sidebar.radio("検索タイプ", ("Semantic_Hybrid", "Vector_only", "Hybrid"))
 
+    # 検索結果の多様化(MMR)の設定。λ が小さいほど、似た内容の検索結果を避ける
+    use_mmr = st.sidebar.checkbox("検索結果の多様化(MMR)", MMR_ENABLED)
+    mmr_lambda = st.sidebar.slider("MMR λ(関連度の重み)", 0.0, 1.0, MMR_LAMBDA, 0.05, disabled=not use_mmr)
+    max_per_file = st.sidebar.number_input("同じファイルから取得する最大件数(0は制限なし)", 0, 50, MMR_MAX_PER_FILE, disabled=not use_mmr)
+
+
+    # 質問のベクトルのキャッシュのヒット率と短縮時間を表示する
+    cache_metrics = get_query_embedding_cache().metrics()
+    st.sidebar.caption(
+        f"Embedding cache: hit rate {cache_metrics['hit_rate']:.1f}% "
+        f"({cache_metrics['hits']}/{cache_metrics['hits'] + cache_metrics['misses']}), "
+        f"saved {cache_metrics['saved_seconds']:.1f}s"
+    )
+    # 回答のキャッシュのヒット率と短縮時間を表示する
+    if ANSWER_CACHE_ENABLED:
+        answer_metrics = get_answer_cache().metrics()
+        st.sidebar.caption(
+            f"Answer cache: hit rate {answer_metrics['hit_rate']:.1f}% "
+            f"({answer_metrics['hits']}/{answer_metrics['hits'] + answer_metrics['misses']}), "
+            f"saved {answer_metrics['saved_seconds']:.1f}s, {answer_metrics['items']} items"
+        )
+    # 接続の再利用状況を表示する
+    st.sidebar.caption(f"Connections: {format_connection_stats()}")
+    # 起動時間(モジュールの読み込み・クライアントの生成・初回リクエスト)の内訳を表示する
+    with st.sidebar.expander("起動時間"):
+        st.text(format_report())
 
     # Set ChatGPT parameters in sidebar
     st.sidebar.markdown("### ChatGPT Parameters")
@@ -263,106 +322,102 @@ def main():
         if not any(message["role"] == "system" for message in st.session_state.messages):
             st.session_state.messages.append({"role": "system", "content": SystemRole})
 
-    # Azure AI Search のクライアントを作成する
-    credential = AzureKeyCredential(AI_SEARCH_KEY)
-    index_client = SearchIndexClient(
-        endpoint=AI_SEARCH_ENDPOINT,
-        credential=credential,
-        api_version=AI_SEARCH_API_VERSION,
-    )
-
     # ユーザからの入力を取得する
     if user_input := st.chat_input("プロンプトを入力してください"):
-        # 検索する。search_fieldsはcontentを対象に検索する
-        results = query_vector_index(indexname, user_input, search_type, top_k_parameter)
-
-        # 変数を初期化する
-        prompt_source = ""
-        sourcetemp = []
-
-        with st.chat_message("user"):
-            st.markdown(user_input)
-
-        # st.session_state.messagesの内容を平文にして、conversion_historyに代入する。RoleがSystemの場合は、代入しない。
-        # 各messageのcontentを改行して表示する。roleもわかるように代入する
-        conversion_history = ""
-        for message in st.session_state.messages:
-            if message['role'] == 'system':
-                pass
-            else:
-                conversion_history += message['role'] + ": " + message['content'] + "\n\n"
-
-        # resultsから各resultの結果を変数prompt_sourceに代入する。filepathとcontentの情報を代入する。
-        for result in results:
-            Score = result['@search.score']
-            filename = result['fileName'] + "-" + str(result['chunkNo'])
-            chunkNo = result['chunkNo']
-            content = result['content']
-            title = result['title']
-            Keywords = result['keywords']
-
-            # 変数prompt_sourceに各変数の値を追加する
-            prompt_source += f"## filename: {filename}\n\n  ### score: {Score}\n\n  ### content: \n\n {content}\n\n"
-
-            # filename, title, contentの内容をmarkdown形式でsourcetemp配列に格納する
-            # sourcetempはresultの内容が変わる度に配列を変更する
-            sourcetemp.append(f"## filename: {filename}\n\n  ### title: {title}\n\n  ### content: \n\n {content}\n\n")
-
-        # プロンプトを作成する
-        promptall = SystemRole + "\n\n# Sources(情報源): \n\n" + prompt_source + "# 今までの会話履歴：\n\n" + conversion_history + "# 回答の生成\n\nそれでは、制約を踏まえて最高の回答をしてください。あなたならできる！"
-        st.session_state.messages.append({"role": "user", "content": user_input})
-
-        # expanderを作成する
-        with st.sidebar.expander("プロンプトの表示"):
-            # マークダウンを表示する
-            st.markdown(promptall)
-
-        #Json形式のmessagestemp変数にroleをuserとして、promptallを代入する
-        messagestemp = []
-        messagestemp.append({"role": "system", "content": promptall})
-        messagestemp.append({"role": "user", "content": user_input})
-
-        with st.chat_message("assistant"):
-            output = client.chat.completions.create(
-                model=AZURE_OPENAI_CHAT_MODEL,
-                messages=messagestemp,
-                temperature=Temperature_temp,
-                max_tokens=AZURE_OPENAI_CHAT_MAX_TOKENS,
-                stream=True,
+        # ターン全体をスパンとして記録し、ステージごとの処理時間をサイドバーに表示する(PROFILE_ENABLED=true の場合はプロファイルも行う)
+        with profile("chat_turn"), span("chat_turn", index=",".join(index_names), search_type=search_type, top_k=int(top_k_parameter)) as turn:
+            turn_start = time.time()
+
+            # 同じインデックス・検索設定で意味の近い質問に回答済みの場合は、キャッシュした回答と参照元を返す
+            # 回答は会話履歴にも依存する(「もっと詳しく」など)ため、キャッシュはセッションの最初の質問だけに使う
+            answer_scope = (tuple(index_names), search_type, str(top_k_parameter), (mmr_lambda, max_per_file) if use_mmr else None, Temperature_temp, SystemRole)
+            use_answer_cache = ANSWER_CACHE_ENABLED and not any(message['role'] != 'system' for message in st.session_state.messages)
+            if use_answer_cache:
+                cached = get_answer_cache().lookup(answer_scope, generate_embeddings(user_input))
+                if cached is not None:
+                    print(f"answer cache hit: similarity={cached['score']:.3f}, saved {cached['seconds']:.2f}s, question: {cached['question']}")
+                    with st.chat_message("user"):
+                        st.markdown(user_input)
+                    st.session_state.messages.append({"role": "user", "content": user_input})
+                    response = cached['answer']
+                    with st.chat_message("assistant"):
+                        st.markdown(response)
+                        st.caption(f"キャッシュされた回答です(類似度 {cached['score']:.3f}、元の質問: {cached['question']})")
+                        show_sources(response, cached['sources']['sourcetemp'])
+                    st.session_state.messages.append({"role": "assistant", "content": response})
+                    save_chat_turn(st.session_state['session_id'], user_input, response, cached['sources']['prompt_source'])
+                    st.sidebar.caption("Stages: " + format_stages(turn))
+                    return
+
+            # 検索する。search_fieldsはcontentを対象に検索する
+            results, failed_indexes = query_vector_index(index_names, user_input, search_type, top_k_parameter,
+                                                         mmr_lambda if use_mmr else None, max_per_file)
+
+            with st.chat_message("user"):
+                st.markdown(user_input)
+
+            # 全てのインデックスの検索がタイムアウト・エラーになった場合は回答しない(情報源なしで回答させない)
+            if len(failed_indexes) == len(index_names):
+                st.error(f"インデックス({', '.join(failed_indexes)})を検索できませんでした。時間をおいて再度お試しください。")
+                st.sidebar.caption("Stages: " + format_stages(turn))
+                return
+            if failed_indexes:
+                st.warning(f"インデックス({', '.join(failed_indexes)})を検索できなかったため、他のインデックスの結果で回答します。")
+
+            # トークン数の上限を守ってプロンプトを作成する
+            # 情報源は重複を除いてスコアの高い順に入れ、会話履歴(RoleがSystemのものを除く)は古いものを要約にまとめる
+            history_messages = [message for message in st.session_state.messages if message['role'] != 'system']
+            promptall, sources, prompt_tokens = build_prompt(
+                SystemRole, sources_from_results(results), history_messages, st.session_state['history_summary'], summarize_history,
+            )
+            print("prompt tokens:", prompt_tokens)
+            count("tokens.prompt", prompt_tokens["total"])
+
+            # prompt_sourceにはプロンプトに入れた情報源を、sourcetempには参照元として表示する情報源をmarkdown形式で格納する
+            prompt_source = "".join(format_source(source) for source in sources)
+            sourcetemp = [format_display_source(source) for source in sources]
+            file_names = {source['fileName'] for source in sources}
+            st.session_state.messages.append({"role": "user", "content": user_input})
+
+            # プロンプトのトークン数の内訳を表示する
+            st.sidebar.caption(
+                f"Prompt tokens: {prompt_tokens['total']}/{prompt_tokens['budget']} "
+                f"(system {prompt_tokens['system']}, sources {prompt_tokens['sources']}, history {prompt_tokens['history']}), "
+                f"sources: {len(sources)}/{prompt_tokens['sources_retrieved']} "
+                f"(duplicated {prompt_tokens['sources_duplicated']}, truncated {prompt_tokens['sources_truncated']}, dropped {prompt_tokens['sources_dropped']})"
             )
-            response = st.write_stream(output)
-
-
-            #output内に[]形式がある場合は、[]内のファイル名を取得し、sourcetemp内のfilenameと一致するものを探索する
-            #一致するものがあれば、sourcetemp内の内容を表示する。既に1回表示されている場合は、2回目以降は表示しない
-            with st.expander("参照元"):
-                displayed_files = []  # 既に表示されたファイル名を追跡するためのリスト
-                if "[" in response:
-                    filename = re.findall(r'\[(.*?)\]', response)
-                    for i in range(len(filename)):
-                        for j in range(len(sourcetemp)):
-                            if filename[i] in sourcetemp[j] and filename[i] not in displayed_files:  # ファイル名が既に表示されていないことを確認
-                                with st.popover(filename[i]):
-                                    st.write(sourcetemp[j])
-                                displayed_files.append(filename[i])  # ファイル名を追跡リストに追加
-                else:
-                    pass
-
-        # Add ChatGPT response to conversation
-        st.session_state.messages.append({"role": "assistant", "content": response})
-
-        # idにはランダム値を挿入する
-        id1 = randomname(20)
-        id2 = randomname(20)
-        id3 = randomname(20)
-        id4 = randomname(20)
-        
 
-        # チャット履歴を Cosmos DB に保存する。
-        add_to_cosmos({"id": id1, "session": st.session_state['session_id'], "role": "user", "content": user_input})
-        add_to_cosmos({"id": id2, "session": st.session_state['session_id'], "role": "assistant", "content": response})
-        add_to_cosmos({"id": id3, "session": st.session_state['session_id'], "role": "context", "content": prompt_source}) 
-        add_to_cosmos({"id": id4, "session": st.session_state['session_id'], "role": "eval", "question": user_input, "answer": response, "context": prompt_source, "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}) 
-        
+            # expanderを作成する
+            with st.sidebar.expander("プロンプトの表示"):
+                # マークダウンを表示する
+                st.markdown(promptall)
+
+            #Json形式のmessagestemp変数にroleをuserとして、promptallを代入する
+            messagestemp = []
+            messagestemp.append({"role": "system", "content": promptall})
+            messagestemp.append({"role": "user", "content": user_input})
+
+            with st.chat_message("assistant"):
+                output = stream_answer(get_openai_client(), AZURE_OPENAI_CHAT_MODEL, messagestemp, Temperature_temp, AZURE_OPENAI_CHAT_MAX_TOKENS)
+                response = st.write_stream(output)
+
+                # 参照元を表示する
+                show_sources(response, sourcetemp)
+
+            # Add ChatGPT response to conversation
+            st.session_state.messages.append({"role": "assistant", "content": response})
+            count("tokens.completion", count_tokens(response))
+
+            # 回答と参照元をキャッシュする(一部のインデックスを検索できなかった場合はキャッシュしない)
+            if use_answer_cache and not failed_indexes:
+                get_answer_cache().store(
+                    answer_scope, generate_embeddings(user_input), user_input, response,
+                    {"prompt_source": prompt_source, "sourcetemp": sourcetemp}, file_names, time.time() - turn_start,
+                )
+
+            # チャット履歴を Cosmos DB に保存する。
+            save_chat_turn(st.session_state['session_id'], user_input, response, prompt_source, prompt_tokens)
+            st.sidebar.caption("Stages: " + format_stages(turn))
+
 if __name__ == '__main__':
     main()
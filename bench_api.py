@@ -0,0 +1,181 @@
+import json
+import time
+import asyncio
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+# 環境変数を読み込む
+load_dotenv()
+import os
+from bench_rag import AI_SEARCH_INDEX_NAME, run_query, summarize, load_queries
+from diversify import MMR_MAX_PER_FILE
+from promptbuilder import count_tokens
+from clients import RAG_BACKEND
+
+# API サーバー(api.py)の負荷テスト
+# 質問を指定した同時リクエスト数で流し、最初のトークンまでの時間(ttft)・全体の時間(total)・スループットを記録する
+#   --url を指定した場合: 起動中の API サーバーに HTTP で送り、SSE の応答を読む
+#   --url を省略した場合: API サーバーと同じ非同期の処理(rag.answer_events)をプロセス内で直接実行する
+# --compare を指定すると、同じ同時リクエスト数で Streamlit と同じスレッドごとの処理(bench_rag.py)も実行して比較する
+# 結果は bench_rag.py と同じ形式で eval/output/bench_api_<日時>.jsonl に出力する
+#   uvicorn api:app --port 8000 & python bench_api.py --url http://localhost:8000 --concurrency 64 --repeat 10
+#   RAG_BACKEND=local python bench_api.py --concurrency 64 --repeat 10 --compare
+
+
+# SSE の応答を読み、(イベント名, データ) を順に返す
+async def __read_sse(response):
+    event = None
+    async for line in response.aiter_lines():
+        if line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:") and event:
+            yield event, json.loads(line[len("data:"):].strip())
+            event = None
+
+
+# 質問を1件送り、最初のトークンまでの時間・全体の時間(ミリ秒)とトークン数を返す
+async def run_request(events, query, search_type, top_k, mmr_lambda):
+    record = {"query": query, "search_type": search_type, "top_k": top_k, "mmr_lambda": mmr_lambda}
+    start = time.perf_counter()
+    first_token = None
+    try:
+        async for event, data in events:
+            if event == "sources":
+                record["sources"] = len(data)
+            elif event == "token" and first_token is None:
+                first_token = time.perf_counter()
+            elif event == "done":
+                record.update({
+                    "source_tokens": data["prompt_tokens"]["sources"],
+                    "prompt_tokens": data["prompt_tokens"]["total"],
+                    "completion_tokens": count_tokens(data["answer"]),
+                })
+            elif event == "error":
+                raise RuntimeError(data["message"])
+        completed = time.perf_counter()
+        record.update({
+            "ttft_ms": ((first_token or completed) - start) * 1000,
+            "total_ms": (completed - start) * 1000,
+            "error": None,
+        })
+    except Exception as e:
+        record.update({"total_ms": (time.perf_counter() - start) * 1000, "error": str(e)})
+    return record
+
+
+# 全ての質問を同時リクエスト数 concurrency で実行し、(リクエストごとの結果, 経過秒数) を返す
+async def run_load(args, queries):
+    semaphore = asyncio.Semaphore(args.concurrency)
+    payload = {"search_type": args.search_type, "top_k": args.top_k, "mmr": args.mmr_lambda is not None,
+               "mmr_lambda": args.mmr_lambda, "max_per_file": args.max_per_file}
+    if args.index:
+        payload["index"] = args.index
+
+    if args.url:
+        import httpx
+        http_client = httpx.AsyncClient(
+            base_url=args.url, timeout=None,
+            limits=httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency),
+        )
+
+        async def events(query):
+            async with http_client.stream("POST", "/chat", json=dict(payload, query=query, stream=True)) as response:
+                response.raise_for_status()
+                async for event in __read_sse(response):
+                    yield event
+    else:
+        from rag import answer_events
+        from clients import get_async_openai_client, get_async_search_client
+
+        def events(query):
+            return answer_events(
+                get_async_openai_client(), get_async_search_client(args.index), args.index, query,
+                os.getenv("AZURE_OPENAI_CHAT_MODEL"), os.getenv("AZURE_OPENAI_EMBED_MODEL"),
+                search_type=args.search_type, top_k=args.top_k, mmr_lambda=args.mmr_lambda, max_per_file=args.max_per_file,
+                max_tokens=int(os.getenv("AZURE_OPENAI_CHAT_MAX_TOKENS", "1000")),
+            )
+
+    async def worker(query):
+        async with semaphore:
+            record = await run_request(events(query), query, args.search_type, args.top_k, args.mmr_lambda)
+            if record["error"]:
+                print("error:", record["error"])
+            return record
+
+    start = time.perf_counter()
+    try:
+        records = await asyncio.gather(*(worker(query) for query in queries))
+    finally:
+        if args.url:
+            await http_client.aclose()
+        else:
+            from clients import close_async_clients
+            await close_async_clients()
+    return records, time.perf_counter() - start
+
+
+# Streamlit と同じ、1リクエストを1スレッドで処理する方法で実行し、(リクエストごとの結果, 経過秒数) を返す
+def run_threads(args, queries):
+    from clients import get_openai_client, get_search_client
+    openai_client = get_openai_client()
+    search_client = get_search_client(args.index)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        records = list(executor.map(
+            lambda query: run_query(openai_client, search_client, args.index, query, args.search_type, args.top_k,
+                                    args.mmr_lambda, args.max_per_file),
+            queries,
+        ))
+    return records, time.perf_counter() - start
+
+
+def print_summary(name, summary):
+    print(f"[{name}] throughput: {summary['throughput_rps']:.2f} req/s, errors: {summary['errors']}")
+    for stage in ["ttft", "total"]:
+        latency = summary["latency_ms"].get(stage)
+        if latency:
+            print(f"  {stage:6s} p50={latency['p50']:8.1f}ms p95={latency['p95']:8.1f}ms p99={latency['p99']:8.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test for the async API server.')
+    parser.add_argument('--url', type=str, default=None, help='Base URL of a running API server (omit to run in-process).')
+    parser.add_argument('--input', type=str, default='./eval/input/rag_input.jsonl', help='JSONL file with "query" fields.')
+    parser.add_argument('--output-dir', type=str, default='./eval/output', help='Directory to write the results.')
+    parser.add_argument('--index', type=str, default=AI_SEARCH_INDEX_NAME, help='Name of the search index.')
+    parser.add_argument('--search-type', type=str, default='Hybrid', choices=['Vector_only', 'Hybrid', 'Semantic_Hybrid'])
+    parser.add_argument('--top-k', type=int, default=10, help='Number of search results.')
+    parser.add_argument('--concurrency', type=int, default=32, help='Number of requests in flight.')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of times to replay the query set.')
+    parser.add_argument('--mmr-lambda', type=float, default=None, help='Diversify the search results with MMR (omit to disable).')
+    parser.add_argument('--max-per-file', type=int, default=MMR_MAX_PER_FILE, help='Maximum results per file when diversifying.')
+    parser.add_argument('--compare', action='store_true', help='Also run the thread-per-request path (bench_rag.py) for comparison.')
+    args = parser.parse_args()
+
+    queries = load_queries(args.input) * args.repeat
+    target = args.url or f"in-process, backend {RAG_BACKEND}"
+    print(f"{len(queries)} requests, concurrency {args.concurrency}, {args.search_type} top_k={args.top_k}, {target}")
+
+    runs = {}
+    records, elapsed = asyncio.run(run_load(args, queries))
+    runs["api"] = (records, summarize(records, elapsed, args.concurrency))
+    if args.compare:
+        records, elapsed = run_threads(args, queries)
+        runs["threads"] = (records, summarize(records, elapsed, args.concurrency))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_file_path = os.path.join(args.output_dir, f"bench_api_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl")
+    with open(output_file_path, 'w', encoding='utf-8') as f:
+        for name, (records, summary) in runs.items():
+            summary.update({"mode": name, "url": args.url, "search_type": args.search_type, "top_k": args.top_k,
+                            "mmr_lambda": args.mmr_lambda, "backend": RAG_BACKEND})
+            print_summary(name, summary)
+            for record in records:
+                f.write(json.dumps(dict(record, type="request", mode=name), ensure_ascii=False) + '\n')
+            f.write(json.dumps(summary, ensure_ascii=False) + '\n')
+    print("saved:", output_file_path)
+
+
+if __name__ == "__main__":
+    main()
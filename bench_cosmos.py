@@ -0,0 +1,73 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+from datetime import datetime
+
+# KB の Cosmos DB への書き込みのベンチマーク
+# ローカルのスタンドイン(RAG_BACKEND=local)に、インデックス作成と同じ形式のドキュメントを書き込み、
+# 並列数とベクトルの保存形式ごとに、処理時間・スループット・1件あたりのサイズ・ベクトルの復元誤差を比較する
+# 1件ずつ順に書き込む json 形式(--modes の先頭の json:1)が変更前の書き込み方法
+# Cosmos DB の書き込みの RU はドキュメントのサイズとインデックス対象のパスの数に比例して増える
+#   python bench_cosmos.py
+#   python bench_cosmos.py --docs 500 --modes json:1 json:8 float32:8 float16:8
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark KB writes to the local Cosmos DB stand-in.')
+    parser.add_argument('--docs', type=int, default=200, help='Number of documents.')
+    parser.add_argument('--dimensions', type=int, default=3072, help='Vector dimensions.')
+    parser.add_argument('--modes', type=str, nargs='+', default=['json:1', 'json:8', 'float32:8', 'float16:8'],
+                        help='Vector format and concurrency pairs (format:concurrency).')
+    parser.add_argument('--output', type=str, default=None, help='File to save the results to (JSONL).')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        # localbackends は読み込み時に環境変数を参照するため、読み込む前に設定する
+        os.environ.update({"RAG_BACKEND": "local", "LOCAL_BACKEND_DIR": work_dir, "TRACE_EXPORT_PATH": ""})
+        import numpy as np
+        from clients import get_cosmos_container
+        from cosmos_writer import upsert_items
+        from vectorcodec import encode_item, decode_item
+
+        rng = np.random.default_rng(0)
+        docs = []
+        for i in range(args.docs):
+            vector = rng.standard_normal(args.dimensions).astype(np.float32)
+            docs.append({
+                "id": f"doc_{i:05d}", "fileName": f"doc_{i // 10:04d}.pdf", "chunkNo": i % 10,
+                "content": "経費精算の手順について説明します。" * 40, "title": "経費精算の手順", "summary": "経費精算の手順の要約",
+                "keywords": ["経費", "精算", "申請"], "contentVector": (vector / np.linalg.norm(vector)).tolist(),
+            })
+
+        results = []
+        print(f"{'mode':12s} {'seconds':>8s} {'docs/s':>8s} {'KB/doc':>8s} {'max error':>10s}")
+        for mode in args.modes:
+            vector_format, concurrency = mode.split(":")
+            container = get_cosmos_container(f"bench_{vector_format}_{concurrency}")
+            start = time.perf_counter()
+            upsert_items(container, [encode_item(doc, vector_format) for doc in docs], max_workers=int(concurrency))
+            seconds = time.perf_counter() - start
+
+            # 読み出して復元したベクトルと元のベクトルの差の最大値
+            stored = decode_item(container.read_item(docs[0]["id"], docs[0]["id"]))
+            error = float(np.max(np.abs(np.asarray(stored["contentVector"]) - np.asarray(docs[0]["contentVector"]))))
+            result = {
+                "format": vector_format, "concurrency": int(concurrency), "docs": len(docs), "seconds": seconds,
+                "docs_per_second": len(docs) / seconds, "bytes_per_doc": container.bytes_written / len(docs), "max_error": error,
+            }
+            results.append(result)
+            print(f"{mode:12s} {seconds:8.2f} {result['docs_per_second']:8.1f} {result['bytes_per_doc'] / 1024:8.1f} {error:10.2e}")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with open(args.output, "a", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps(dict(result, date=date), ensure_ascii=False) + "\n")
+        print("saved:", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import time
+import argparse
+import tempfile
+import os
+import numpy as np
+from localindex import LocalVectorIndex, normalize, top_k_indices, unpack_vector
+from localbm25 import LocalBM25Index, decode_postings
+
+# ローカルのベクトルインデックスのベンチマーク
+# float32 の全件検索(正解)に対して、量子化の形式と再スコアリングの候補数ごとに検索時間と recall@k を比較する
+#   python bench_localindex.py --docs 20000
+#   python bench_localindex.py --index <ローカルインデックス名>   (作成済みのインデックスのベクトルを使う)
+#   python bench_localindex.py --bm25 --docs 5000   (BM25 インデックスの検索時間と、同じ id の再追加で削除済みの文書が残らないことを確認する)
+
+
+# ベンチマーク用のベクトルを作成する。似たチャンクが集まるよう、クラスタの中心にノイズを加える
+def make_vectors(count, dim, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(count // 50, 1), dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), count)] + 0.5 * rng.standard_normal((count, dim)).astype(np.float32)
+    return normalize(vectors)
+
+
+# 作成済みのローカルインデックスのベクトルを読み込む
+def load_vectors(index_name):
+    index = LocalVectorIndex(index_name)
+    rows = index.conn.execute("SELECT vector FROM docs").fetchall()
+    return normalize(np.array([unpack_vector(row[0]) for row in rows], dtype=np.float32))
+
+
+# ベンチマーク用のインデックスを一時ディレクトリに作成する
+def build_index(base_dir, vectors, dtype):
+    index = LocalVectorIndex("bench", base_dir=base_dir, dtype=dtype)
+    index.add_documents([{
+        "id": f"{i:08d}", "fileName": "bench", "chunkNo": i, "content": "", "title": "", "summary": "",
+        "keywords": [], "contentVector": vector.tolist(),
+    } for i, vector in enumerate(vectors)])
+    index.build()
+    return index
+
+
+# ベンチマーク用のドキュメントを作成する。語彙からランダムに選んだ語を並べた本文にする
+def make_texts(count, seed=0):
+    rng = np.random.default_rng(seed)
+    vocabulary = [f"{a}{b}" for a in "規程申請経費承認休暇出張契約保守" for b in "手続期限上限対象範囲"] + [f"term{i}" for i in range(200)]
+    return [" ".join(rng.choice(vocabulary, 40)) for _ in range(count)]
+
+
+# BM25 インデックスの検索時間と、同じ id のドキュメントを再追加した後の削除済みの文書の数・ポスティングリストの長さを表示する
+# 再追加を繰り返しても削除済みの文書と文書番号が増え続けないことを確認する
+def bench_bm25(args):
+    texts = make_texts(args.docs)
+    with tempfile.TemporaryDirectory() as base_dir:
+        index = LocalBM25Index(os.path.join(base_dir, "bm25.sqlite"))
+        start = time.perf_counter()
+        index.add_documents([{"id": f"{i:08d}", "content": text} for i, text in enumerate(texts)])
+        print(f"bm25 add: {args.docs} docs in {time.perf_counter() - start:.2f}s")
+
+        queries = make_texts(args.queries, seed=1)
+        index.search(queries[0], args.top_k)
+        seconds = []
+        for query in queries:
+            start = time.perf_counter()
+            index.search(query[:20], args.top_k)
+            seconds.append(time.perf_counter() - start)
+        p50, p95 = percentiles(seconds)
+        print(f"{'bm25 search':24s} p50={p50:7.2f}ms p95={p95:7.2f}ms")
+
+        # 先頭の readd_docs 件を readd 回再追加する(ファイルの再処理で同じ id のドキュメントを置き換える場合と同じ)
+        readd_docs = min(args.docs, 50)
+        for _ in range(args.readd):
+            index.add_documents([{"id": f"{i:08d}", "content": texts[i]} for i in range(readd_docs)])
+        index.search(queries[0], args.top_k)
+        deleted = index.conn.execute("SELECT COUNT(*) FROM bm25_deleted").fetchone()[0]
+        max_postings = max(count for count, _ in index.conn.execute("SELECT count, data FROM bm25_postings"))
+        live_postings = max(
+            int(np.count_nonzero(index.lengths[decode_postings(data, count)[0]] >= 0))
+            for count, data in index.conn.execute("SELECT count, data FROM bm25_postings")
+        )
+        print(f"bm25 re-add x{args.readd} ({readd_docs} docs): live={index.count()} deleted={deleted} "
+              f"max postings={max_postings} (live {live_postings}) lengths={len(index.lengths)}")
+        # 削除済みの文書は COMPACT_DELETED_RATE を超える前に取り除かれ、文書番号は振り直される
+        if deleted > args.docs or len(index.lengths) > 2 * args.docs + 1:
+            raise RuntimeError("deleted documents are not compacted on re-add")
+        index.conn.close()
+
+
+# 処理時間の p50 / p95 をミリ秒で返す
+def percentiles(seconds):
+    return np.percentile(seconds, 50) * 1000, np.percentile(seconds, 95) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the local vector index against exact float32 search.')
+    parser.add_argument('--index', type=str, help='Use the vectors of an existing local index.')
+    parser.add_argument('--docs', type=int, default=20000, help='Number of generated vectors.')
+    parser.add_argument('--dim', type=int, default=1536, help='Dimension of generated vectors.')
+    parser.add_argument('--queries', type=int, default=100, help='Number of queries.')
+    parser.add_argument('--top-k', type=int, default=10, help='Number of results per query.')
+    parser.add_argument('--bm25', action='store_true', help='Benchmark the local BM25 index instead of the vector index.')
+    parser.add_argument('--readd', type=int, default=20, help='Number of times to re-add the same documents to the BM25 index.')
+    args = parser.parse_args()
+
+    if args.bm25:
+        bench_bm25(args)
+        return
+
+    vectors = load_vectors(args.index) if args.index else make_vectors(args.docs, args.dim)
+    rng = np.random.default_rng(1)
+    # クエリはドキュメントのベクトルにノイズを加えたもの
+    noise = rng.standard_normal((args.queries, vectors.shape[1])).astype(np.float32) / np.sqrt(vectors.shape[1])
+    queries = normalize(vectors[rng.integers(0, len(vectors), args.queries)] + noise)
+    print(f"vectors: {vectors.shape[0]} x {vectors.shape[1]}, queries: {args.queries}, top_k: {args.top_k}")
+
+    # float32 の全件検索(正解)
+    seconds = []
+    expected = []
+    for query in queries:
+        start = time.perf_counter()
+        expected.append(set(top_k_indices(vectors @ query, args.top_k).tolist()))
+        seconds.append(time.perf_counter() - start)
+    p50, p95 = percentiles(seconds)
+    print(f"{'float32 exact':24s} size={vectors.nbytes / 1024 / 1024:8.1f}MB p50={p50:7.2f}ms p95={p95:7.2f}ms recall@{args.top_k}=1.000")
+
+    with tempfile.TemporaryDirectory() as base_dir:
+        for dtype in ["float16", "int8"]:
+            index = build_index(base_dir, vectors, dtype)
+            index.search(queries[0], args.top_k)
+            size = index.matrix.nbytes + (index.scales.nbytes if index.scales is not None else 0)
+            for rescore_factor in [1, 4]:
+                seconds = []
+                recalls = []
+                for query, expected_ids in zip(queries, expected):
+                    start = time.perf_counter()
+                    results = index.search(query, args.top_k, rescore_factor=rescore_factor)
+                    seconds.append(time.perf_counter() - start)
+                    recalls.append(len({doc["chunkNo"] for doc in results} & expected_ids) / args.top_k)
+                p50, p95 = percentiles(seconds)
+                name = f"{dtype} rescore={rescore_factor}"
+                print(f"{name:24s} size={size / 1024 / 1024:8.1f}MB p50={p50:7.2f}ms p95={p95:7.2f}ms recall@{args.top_k}={np.mean(recalls):.3f}")
+            index.conn.close()
+
+
+if __name__ == "__main__":
+    main()
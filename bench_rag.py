@@ -0,0 +1,171 @@
+import json
+import time
+import argparse
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from dotenv import load_dotenv
+# 環境変数を読み込む
+load_dotenv()
+import os
+from rag import SystemPrompt, normalize_query, embed_query, search_documents, stream_answer
+from diversify import MMR_FETCH_FACTOR, MMR_MAX_PER_FILE, diversify
+from promptbuilder import build_prompt, sources_from_results, count_tokens
+from clients import RAG_BACKEND, get_openai_client, get_search_client
+
+# RAG のリクエスト処理(質問のベクトル化 → 検索 → 回答の生成)の負荷・レイテンシのベンチマーク
+# JSONL の質問(query)を指定した並列数で app.py と同じ処理に流し、ステージごとの処理時間とトークン数を記録する
+# 結果はリクエストごとの行と集計(type=summary)の行を eval/output/bench_rag_<日時>.jsonl に出力する
+#   python bench_rag.py --concurrency 4 --search-type Hybrid --top-k 5
+#   RAG_BACKEND=local python bench_rag.py --concurrency 16 --repeat 10   (Azure を使わずにローカルのスタンドインで実行)
+
+AZURE_OPENAI_CHAT_MODEL = os.getenv("AZURE_OPENAI_CHAT_MODEL")
+AZURE_OPENAI_EMBED_MODEL = os.getenv("AZURE_OPENAI_EMBED_MODEL")
+AZURE_OPENAI_CHAT_MAX_TOKENS = int(os.getenv("AZURE_OPENAI_CHAT_MAX_TOKENS", "1000"))
+AI_SEARCH_INDEX_NAME = os.getenv("AI_SEARCH_INDEX_NAME")
+
+# ttft はリクエストの開始から最初のトークンまでの時間(bench_api.py の結果と比較する)
+STAGES = ["embedding", "search", "prompt", "first_token", "completion", "ttft", "total"]
+
+
+# 質問を1件処理して、ステージごとの処理時間(ミリ秒)とトークン数を返す
+# mmr_lambda を指定した場合は、app.py と同様に検索結果を MMR で多様化する(多様化の時間は search に含める)
+def run_query(openai_client, search_client, index_name, query, search_type, top_k, mmr_lambda=None, max_per_file=MMR_MAX_PER_FILE):
+    record = {"query": query, "search_type": search_type, "top_k": top_k, "mmr_lambda": mmr_lambda}
+    start = time.perf_counter()
+    try:
+        text = normalize_query(query)
+        vector = embed_query(openai_client, AZURE_OPENAI_EMBED_MODEL, text)
+        embedded = time.perf_counter()
+        if mmr_lambda is None:
+            results = search_documents(search_client, index_name, query, vector, search_type, top_k)
+        else:
+            results = search_documents(search_client, index_name, query, vector, search_type, top_k * MMR_FETCH_FACTOR, with_vectors=True)
+            results = diversify(results, top_k, mmr_lambda, max_per_file)
+        searched = time.perf_counter()
+        prompt, sources, stats = build_prompt(SystemPrompt, sources_from_results(results), [], {"summary": "", "count": 0}, None)
+        messages = [{"role": "system", "content": prompt}, {"role": "user", "content": query}]
+        prompted = time.perf_counter()
+        first_token = None
+        answer = ""
+        for content in stream_answer(openai_client, AZURE_OPENAI_CHAT_MODEL, messages, 0.0, AZURE_OPENAI_CHAT_MAX_TOKENS):
+            if first_token is None:
+                first_token = time.perf_counter()
+            answer += content
+        completed = time.perf_counter()
+        first_token = first_token or completed
+        record.update({
+            "embedding_ms": (embedded - start) * 1000,
+            "search_ms": (searched - embedded) * 1000,
+            "prompt_ms": (prompted - searched) * 1000,
+            "first_token_ms": (first_token - prompted) * 1000,
+            "completion_ms": (completed - prompted) * 1000,
+            "ttft_ms": (first_token - start) * 1000,
+            "total_ms": (completed - start) * 1000,
+            "results": len(results),
+            "sources": len(sources),
+            "source_tokens": stats["sources"],
+            "embedding_tokens": count_tokens(text),
+            "prompt_tokens": count_tokens(prompt) + count_tokens(query),
+            "completion_tokens": count_tokens(answer),
+            "error": None,
+        })
+    except Exception as e:
+        record.update({"total_ms": (time.perf_counter() - start) * 1000, "error": str(e)})
+    return record
+
+
+# リクエストごとの結果を集計する(記録されていないステージとトークン数は集計しない)
+def summarize(records, elapsed, concurrency):
+    succeeded = [record for record in records if record["error"] is None]
+    summary = {
+        "type": "summary",
+        "requests": len(records),
+        "errors": len(records) - len(succeeded),
+        "concurrency": concurrency,
+        "elapsed_seconds": elapsed,
+        "throughput_rps": len(succeeded) / elapsed if elapsed > 0 else 0.0,
+        "latency_ms": {},
+        "tokens": {},
+    }
+    for stage in STAGES:
+        values = [record[stage + "_ms"] for record in succeeded if stage + "_ms" in record]
+        if values:
+            summary["latency_ms"][stage] = {
+                "p50": float(np.percentile(values, 50)),
+                "p95": float(np.percentile(values, 95)),
+                "p99": float(np.percentile(values, 99)),
+                "mean": float(np.mean(values)),
+            }
+    for name in ["embedding_tokens", "source_tokens", "prompt_tokens", "completion_tokens"]:
+        summary["tokens"][name] = sum(record.get(name, 0) for record in succeeded)
+    summary["tokens"]["completion_tokens_per_second"] = summary["tokens"]["completion_tokens"] / elapsed if elapsed > 0 else 0.0
+    return summary
+
+
+# 質問を読み込む
+def load_queries(path):
+    queries = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                query = json.loads(line).get('query')
+                if query:
+                    queries.append(query)
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load/latency benchmark for the RAG request path.')
+    parser.add_argument('--input', type=str, default='./eval/input/rag_input.jsonl', help='JSONL file with "query" fields.')
+    parser.add_argument('--output-dir', type=str, default='./eval/output', help='Directory to write the results.')
+    parser.add_argument('--index', type=str, default=AI_SEARCH_INDEX_NAME, help='Name of the search index.')
+    parser.add_argument('--search-type', type=str, default='Vector_only', choices=['Vector_only', 'Hybrid', 'Semantic_Hybrid'])
+    parser.add_argument('--top-k', type=int, default=10, help='Number of search results.')
+    parser.add_argument('--concurrency', type=int, default=1, help='Number of requests in flight.')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of times to replay the query set.')
+    parser.add_argument('--mmr-lambda', type=float, default=None, help='Diversify the search results with MMR (omit to disable).')
+    parser.add_argument('--max-per-file', type=int, default=MMR_MAX_PER_FILE, help='Maximum results per file when diversifying.')
+    args = parser.parse_args()
+
+    openai_client = get_openai_client()
+    search_client = get_search_client(args.index)
+
+    queries = load_queries(args.input) * args.repeat
+    print(f"{len(queries)} requests, concurrency {args.concurrency}, {args.search_type} top_k={args.top_k}" + f", backend {RAG_BACKEND}")
+
+    records = []
+    lock = threading.Lock()
+
+    def worker(query):
+        record = run_query(openai_client, search_client, args.index, query, args.search_type, args.top_k, args.mmr_lambda, args.max_per_file)
+        with lock:
+            records.append(record)
+            if record["error"]:
+                print("error:", record["error"])
+        return record
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(worker, queries))
+    elapsed = time.perf_counter() - start
+    summary = summarize(records, elapsed, args.concurrency)
+    summary.update({"search_type": args.search_type, "top_k": args.top_k, "mmr_lambda": args.mmr_lambda, "backend": RAG_BACKEND})
+
+    for stage, latency in summary["latency_ms"].items():
+        print(f"{stage:12s} p50={latency['p50']:8.1f}ms p95={latency['p95']:8.1f}ms p99={latency['p99']:8.1f}ms")
+    print(f"throughput: {summary['throughput_rps']:.2f} req/s, errors: {summary['errors']}, tokens: {summary['tokens']}")
+
+    # 既存の評価結果と同じ場所に、日時を付けたファイル名で保存する
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_file_path = os.path.join(args.output_dir, f"bench_rag_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl")
+    with open(output_file_path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(dict(record, type="request"), ensure_ascii=False) + '\n')
+        f.write(json.dumps(summary, ensure_ascii=False) + '\n')
+    print("saved:", output_file_path)
+
+
+if __name__ == "__main__":
+    main()
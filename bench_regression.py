@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+import statistics
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# 性能の回帰テスト
+# ローカルのスタンドイン(RAG_BACKEND=local)で、生成した文書のインデックス作成と質問への回答を end-to-end で実行し、
+# インデックス作成のスループットと質問のステージごとのレイテンシを eval/output/perf_history.jsonl に追記する
+# 同じ設定の直近の実行結果(中央値)と比べて、許容範囲(--tolerance)を超えて悪化した指標があれば終了コード 1 で終了する
+# スタンドインの遅延などは LOCAL_<サービス>_LATENCY_MS などの環境変数で変更できる(localbackends.py を参照)
+#   python bench_regression.py
+#   python bench_regression.py --docs 200 --workers 4 --concurrency 8
+
+# 比較する指標と、値が大きいほど良いか
+METRICS = [
+    ("ingest.chunks_per_second", True),
+    ("requests.throughput_rps", True),
+    ("requests.latency_ms.embedding.p95", False),
+    ("requests.latency_ms.search.p95", False),
+    ("requests.latency_ms.first_token.p95", False),
+    ("requests.latency_ms.total.p95", False),
+]
+
+WORDS = [
+    "経費", "精算", "申請", "承認", "出張", "旅費", "規程", "勤怠", "休暇", "残業", "給与", "賞与", "研修", "評価",
+    "契約", "購買", "発注", "請求", "支払", "予算", "監査", "情報", "セキュリティ", "パスワード", "アカウント",
+    "ネットワーク", "サーバー", "バックアップ", "障害", "対応", "手順", "問い合わせ", "窓口", "システム", "利用",
+    "Azure", "Teams", "VPN", "PC", "ログイン",
+]
+
+
+# 文書を生成する。文書ごとにテーマとなる語を多めに含める
+def make_documents(count, sentences, seed=0):
+    rng = random.Random(seed)
+    docs = []
+    for i in range(count):
+        topics = rng.sample(WORDS, 3)
+        lines = [f"# {''.join(topics)}について"]
+        for _ in range(sentences):
+            words = topics + rng.sample(WORDS, 4)
+            rng.shuffle(words)
+            lines.append("、".join(words) + "について説明します。")
+        docs.append((f"doc_{i:04d}.txt", "\n".join(lines), topics))
+    return docs
+
+
+# 現在のコミットを返す(git がない場合は None)
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+# "a.b.c" 形式のキーで入れ子の dict の値を取得する
+def get_metric(entry, key):
+    value = entry
+    for part in key.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+# 同じ設定の直近の実行結果の中央値と比べ、悪化した指標のリストを返す
+def compare(entry, history, tolerance, baseline_runs):
+    previous = [h for h in history if h.get("config") == entry["config"]][-baseline_runs:]
+    regressions = []
+    print(f"{'metric':40s} {'value':>10s} {'baseline':>10s} {'change':>8s}")
+    for key, higher_is_better in METRICS:
+        value = get_metric(entry, key)
+        baselines = [get_metric(h, key) for h in previous if get_metric(h, key) is not None]
+        if value is None or not baselines:
+            print(f"{key:40s} {value if value is not None else float('nan'):10.2f} {'-':>10s}")
+            continue
+        baseline = statistics.median(baselines)
+        change = (value - baseline) / baseline if baseline else 0.0
+        regressed = change < -tolerance if higher_is_better else change > tolerance
+        print(f"{key:40s} {value:10.2f} {baseline:10.2f} {change * 100:+7.1f}%" + ("  REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Performance regression suite on the local stand-in backends.')
+    parser.add_argument('--docs', type=int, default=50, help='Number of generated documents.')
+    parser.add_argument('--sentences', type=int, default=30, help='Number of sentences per document.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of files processed in parallel per ingest stage.')
+    parser.add_argument('--queries', type=int, default=50, help='Number of queries.')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of queries in flight.')
+    parser.add_argument('--search-type', type=str, default='Hybrid', choices=['Vector_only', 'Hybrid', 'Semantic_Hybrid'])
+    parser.add_argument('--top-k', type=int, default=5, help='Number of search results.')
+    parser.add_argument('--history', type=str, default='./eval/output/perf_history.jsonl', help='File to append the results to.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed change from the baseline (0.25 = 25%%).')
+    parser.add_argument('--baseline-runs', type=int, default=5, help='Number of previous runs used as the baseline.')
+    args = parser.parse_args()
+    history_path = os.path.abspath(args.history)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        # 各モジュールは読み込み時に環境変数を参照するため、読み込む前にローカルのスタンドインとキャッシュなしの設定にする
+        os.environ.update({
+            "RAG_BACKEND": "local",
+            "LOCAL_BACKEND_DIR": os.path.join(work_dir, "backend"),
+            "LOCAL_INDEX_DIR": os.path.join(work_dir, "localindex"),
+            "VECTOR_SEARCH_BACKEND": "azure",
+            "MANIFEST_PATH": os.path.join(work_dir, "manifest.sqlite"),
+            "ENRICH_CACHE_MAX_MB": "0",
+            "OCR_CACHE_ENABLED": "false",
+            "TRACE_EXPORT_PATH": "",
+            "AI_SEARCH_INDEX_NAME": "perf",
+            "COSMOS_CONTAINER_NAME_KB": "kb",
+            "BLOB_CONTAINER_NAME": "perf",
+        })
+        import preparedata
+        from bench_rag import run_query, summarize
+        from clients import get_openai_client, get_search_client, get_cosmos_container
+
+        random.seed(0)
+        docs = make_documents(args.docs, args.sentences)
+        file_paths = []
+        os.makedirs(os.path.join(work_dir, "docs"))
+        for file_name, text, _ in docs:
+            file_paths.append(os.path.join(work_dir, "docs", file_name))
+            with open(file_paths[-1], "w", encoding="utf-8") as f:
+                f.write(text)
+
+        # インデックス作成
+        ingest_args = argparse.Namespace(incremental=False, blob=False)
+        start = time.perf_counter()
+        if args.workers > 1:
+            preparedata.process_files_parallel(file_paths, "perf", ingest_args, args.workers)
+        else:
+            for file_path in file_paths:
+                preparedata.process_file(file_path, "perf", ingest_args)
+        ingest_seconds = time.perf_counter() - start
+        chunks = sum(1 for _ in get_cosmos_container("kb").query_items("SELECT c.id FROM c", enable_cross_partition_query=True))
+
+        # 質問への回答。質問は文書のテーマの語から作成する
+        rng = random.Random(1)
+        queries = [f"{'と'.join(rng.choice(docs)[2][:2])}について教えてください" for _ in range(args.queries)]
+        openai_client = get_openai_client()
+        search_client = get_search_client("perf")
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            records = list(executor.map(
+                lambda query: run_query(openai_client, search_client, "perf", query, args.search_type, args.top_k), queries,
+            ))
+        summary = summarize(records, time.perf_counter() - start, args.concurrency)
+
+    entry = {
+        "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "commit": git_commit(),
+        "config": {
+            "docs": args.docs, "sentences": args.sentences, "workers": args.workers, "queries": args.queries,
+            "concurrency": args.concurrency, "search_type": args.search_type, "top_k": args.top_k,
+            "latency": {key: value for key, value in sorted(os.environ.items()) if key.startswith("LOCAL_") and key != "LOCAL_BACKEND_DIR" and key != "LOCAL_INDEX_DIR"},
+        },
+        "ingest": {
+            "files": len(file_paths),
+            "chunks": chunks,
+            "seconds": ingest_seconds,
+            "chunks_per_second": chunks / ingest_seconds if ingest_seconds > 0 else 0.0,
+        },
+        "requests": {
+            "count": summary["requests"],
+            "errors": summary["errors"],
+            "throughput_rps": summary["throughput_rps"],
+            "latency_ms": summary["latency_ms"],
+            "tokens": summary["tokens"],
+        },
+    }
+
+    history = []
+    if os.path.exists(history_path):
+        with open(history_path, "r", encoding="utf-8") as f:
+            history = [json.loads(line) for line in f if line.strip()]
+    regressions = compare(entry, history, args.tolerance, args.baseline_runs)
+    entry["regressions"] = regressions
+
+    os.makedirs(os.path.dirname(history_path), exist_ok=True)
+    with open(history_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    print("saved:", history_path)
+    if summary["errors"]:
+        print("errors:", summary["errors"])
+    if regressions or summary["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+import os
+import time
+import threading
+from dotenv import load_dotenv
+# 環境変数を読み込む
+load_dotenv()
+from startup import record
+
+# 各サービスのクライアントをプロセス内で1つだけ生成して使い回すためのレジストリ
+# Streamlit の再実行やリクエストごとにクライアントを作り直すと、その都度 TLS 接続が張り直されるため、
+# コネクションプールを持つ長寿命のクライアントをエンドポイント・インデックスごとに共有する
+# RAG_BACKEND=local の場合は、Azure の代わりにローカルのスタンドイン(localbackends.py)を返す
+# 起動を速くするため、各サービスの SDK は初めてクライアントを生成するときに読み込む
+# クライアントの生成(SDK の読み込みを含む)にかかった時間は起動時間のレポート(startup.py)に記録する
+# コンテナやインデックスの作成はここでは行わない(provision.py で事前に1回だけ実行する)
+
+# 使用するバックエンド(azure | local)
+RAG_BACKEND = os.getenv("RAG_BACKEND", "azure")
+
+# コネクションプールの最大接続数と、アイドル接続を保持する秒数
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "20"))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", "60"))
+# 非同期のクライアント(api.py)の最大接続数。1プロセスで多数のリクエストを同時に処理するため多めにする
+ASYNC_POOL_MAXSIZE = int(os.getenv("ASYNC_POOL_MAXSIZE", "100"))
+
+__lock = threading.RLock()
+__clients = {}
+__sessions = {}
+__openai_stats = {"requests": 0, "connections": 0}
+
+
+# キーに対応するクライアントがなければ factory() で生成して登録する
+def __get_or_create(key, factory):
+    client = __clients.get(key)
+    if client is not None:
+        return client
+    with __lock:
+        if key not in __clients:
+            start = time.perf_counter()
+            __clients[key] = factory()
+            record("client." + key[0], time.perf_counter() - start)
+        return __clients[key]
+
+
+# サービスごとの requests セッション(コネクションプール)を取得する
+def get_http_session(name="default"):
+    import requests
+    from requests.adapters import HTTPAdapter
+    with __lock:
+        if name not in __sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_MAXSIZE, pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            __sessions[name] = session
+        return __sessions[name]
+
+
+# Azure SDK 用に、共有セッションを使うトランスポートを作成する
+def __transport(name):
+    from azure.core.pipeline.transport import RequestsTransport
+    return RequestsTransport(session=get_http_session(name), session_owner=False)
+
+
+# httpx のトレースで新規接続数を数える
+def __trace_openai(event_name, info):
+    if event_name == "connection.connect_tcp.complete":
+        with __lock:
+            __openai_stats["connections"] += 1
+
+
+# httpx のリクエストごとに件数を数え、トレースを設定する
+def __on_openai_request(request):
+    with __lock:
+        __openai_stats["requests"] += 1
+    request.extensions["trace"] = __trace_openai
+
+
+# Azure OpenAI のクライアントを取得する
+# max_retries を指定した場合は、同じコネクションプールを使い、再実行回数だけを変えたクライアントを返す
+def get_openai_client(max_retries=None):
+    if max_retries is not None:
+        return __get_or_create(("openai", max_retries), lambda: get_openai_client().with_options(max_retries=max_retries))
+    if RAG_BACKEND == "local":
+        from localbackends import LocalOpenAI
+        return __get_or_create(("openai",), LocalOpenAI)
+
+    def factory():
+        import httpx
+        from openai import AzureOpenAI
+        http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=HTTP_POOL_MAXSIZE,
+                max_keepalive_connections=HTTP_POOL_MAXSIZE,
+                keepalive_expiry=HTTP_KEEPALIVE_SECONDS,
+            ),
+            event_hooks={"request": [__on_openai_request]},
+        )
+        return AzureOpenAI(
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+            api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
+            http_client=http_client,
+        )
+    return __get_or_create(("openai",), factory)
+
+
+# Azure AI Search のインデックス管理用クライアントを取得する
+def get_search_index_client():
+    if RAG_BACKEND == "local":
+        from localbackends import LocalSearchIndexClient
+        return __get_or_create(("search_index",), LocalSearchIndexClient)
+
+    def factory():
+        from azure.core.credentials import AzureKeyCredential
+        from azure.search.documents.indexes import SearchIndexClient
+        return SearchIndexClient(
+            endpoint=os.getenv("AI_SEARCH_ENDPOINT"),
+            credential=AzureKeyCredential(os.getenv("AI_SEARCH_KEY")),
+            transport=__transport("search"),
+        )
+    return __get_or_create(("search_index",), factory)
+
+
+# Azure AI Search の検索・登録用クライアントをインデックスごとに取得する
+def get_search_client(index_name):
+    if RAG_BACKEND == "local":
+        from localbackends import LocalSearchClient
+        return __get_or_create(("search", index_name), lambda: LocalSearchClient(index_name))
+
+    def factory():
+        from azure.core.credentials import AzureKeyCredential
+        from azure.search.documents import SearchClient
+        return SearchClient(
+            endpoint=os.getenv("AI_SEARCH_ENDPOINT"),
+            index_name=index_name,
+            credential=AzureKeyCredential(os.getenv("AI_SEARCH_KEY")),
+            transport=__transport("search"),
+        )
+    return __get_or_create(("search", index_name), factory)
+
+
+# Cosmos DB のデータベースクライアントを取得する
+def get_cosmos_database():
+    def factory():
+        from azure.cosmos.cosmos_client import CosmosClient
+        cosmos_client = CosmosClient.from_connection_string(
+            os.getenv("COSMOS_CONNECTION_STRING"), transport=__transport("cosmos")
+        )
+        return cosmos_client.get_database_client(os.getenv("COSMOS_DB_NAME"))
+    return __get_or_create(("cosmos",), factory)
+
+
+# Cosmos DB のコンテナクライアントを取得する(コンテナは provision.py で作成しておく)
+def get_cosmos_container(container_name):
+    if RAG_BACKEND == "local":
+        from localbackends import LocalCosmosContainer
+        return __get_or_create(("cosmos_container", container_name), lambda: LocalCosmosContainer(container_name))
+    return __get_or_create(("cosmos_container", container_name), lambda: get_cosmos_database().get_container_client(container_name))
+
+
+# Blob Storage のコンテナクライアントを取得する(コンテナは provision.py で作成しておく)
+def get_blob_container_client():
+    if RAG_BACKEND == "local":
+        from localbackends import LocalBlobContainerClient
+        return __get_or_create(("blob",), lambda: LocalBlobContainerClient(os.getenv("BLOB_CONTAINER_NAME")))
+
+    def factory():
+        from azure.storage.blob import BlobServiceClient
+        blob_service_client = BlobServiceClient.from_connection_string(
+            os.getenv("BLOB_STORAGE_CONNECTION_STRING"), transport=__transport("blob")
+        )
+        return blob_service_client.get_container_client(os.getenv("BLOB_CONTAINER_NAME"))
+    return __get_or_create(("blob",), factory)
+
+
+# Document Intelligence のクライアントを取得する
+def get_document_intelligence_client():
+    if RAG_BACKEND == "local":
+        from localbackends import LocalDocumentIntelligenceClient
+        return __get_or_create(("document_intelligence",), LocalDocumentIntelligenceClient)
+
+    def factory():
+        from azure.core.credentials import AzureKeyCredential
+        from azure.ai.documentintelligence import DocumentIntelligenceClient
+        return DocumentIntelligenceClient(
+            os.getenv("DOCUMENT_INTELLIGENCE_ENDPOINT"),
+            AzureKeyCredential(os.getenv("DOCUMENT_INTELLIGENCE_KEY")),
+            transport=__transport("document_intelligence"),
+        )
+    return __get_or_create(("document_intelligence",), factory)
+
+
+# 非同期のクライアント(api.py 用)
+# 非同期のクライアントはイベントループに結び付くため、サーバーのイベントループ内で生成し、終了時に close_async_clients() で閉じる
+# Azure SDK の非同期クライアントは aiohttp を使う
+
+# Azure OpenAI の非同期クライアントを取得する
+def get_async_openai_client():
+    if RAG_BACKEND == "local":
+        from localbackends import LocalAsyncOpenAI
+        return __get_or_create(("async_openai",), LocalAsyncOpenAI)
+
+    def factory():
+        import httpx
+        from openai import AsyncAzureOpenAI
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=ASYNC_POOL_MAXSIZE,
+                max_keepalive_connections=ASYNC_POOL_MAXSIZE,
+                keepalive_expiry=HTTP_KEEPALIVE_SECONDS,
+            ),
+        )
+        return AsyncAzureOpenAI(
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+            api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
+            http_client=http_client,
+        )
+    return __get_or_create(("async_openai",), factory)
+
+
+# Azure AI Search の非同期の検索用クライアントをインデックスごとに取得する
+def get_async_search_client(index_name):
+    if RAG_BACKEND == "local":
+        from localbackends import LocalAsyncSearchClient
+        return __get_or_create(("async_search", index_name), lambda: LocalAsyncSearchClient(index_name))
+
+    def factory():
+        from azure.core.credentials import AzureKeyCredential
+        from azure.search.documents.aio import SearchClient
+        return SearchClient(
+            endpoint=os.getenv("AI_SEARCH_ENDPOINT"),
+            index_name=index_name,
+            credential=AzureKeyCredential(os.getenv("AI_SEARCH_KEY")),
+        )
+    return __get_or_create(("async_search", index_name), factory)
+
+
+# Cosmos DB の非同期のコンテナクライアントを取得する
+def get_async_cosmos_container(container_name):
+    if RAG_BACKEND == "local":
+        from localbackends import LocalAsyncCosmosContainer
+        return __get_or_create(("async_cosmos_container", container_name), lambda: LocalAsyncCosmosContainer(container_name))
+
+    def factory():
+        from azure.cosmos.aio import CosmosClient
+        cosmos_client = __get_or_create(
+            ("async_cosmos",), lambda: CosmosClient.from_connection_string(os.getenv("COSMOS_CONNECTION_STRING"))
+        )
+        return cosmos_client.get_database_client(os.getenv("COSMOS_DB_NAME")).get_container_client(container_name)
+    return __get_or_create(("async_cosmos_container", container_name), factory)
+
+
+# 非同期のクライアントを閉じて、レジストリから削除する
+async def close_async_clients():
+    with __lock:
+        keys = [key for key in __clients if key[0].startswith("async_")]
+        clients = [__clients.pop(key) for key in keys]
+    for client in clients:
+        close = getattr(client, "close", None)
+        if close is not None:
+            result = close()
+            if hasattr(result, "__await__"):
+                await result
+
+
+# 接続の再利用状況を返す。{名前: {"requests": リクエスト数, "connections": 新規接続数, "reuse_rate": 再利用率(%)}}
+def connection_stats():
+    stats = {}
+    with __lock:
+        counts = {"openai": dict(__openai_stats)}
+        for name, session in __sessions.items():
+            counts[name] = {"requests": 0, "connections": 0}
+            for adapter in set(session.adapters.values()):
+                for key in adapter.poolmanager.pools.keys():
+                    pool = adapter.poolmanager.pools[key]
+                    counts[name]["requests"] += pool.num_requests
+                    counts[name]["connections"] += pool.num_connections
+    for name, count in counts.items():
+        reused = max(count["requests"] - count["connections"], 0)
+        reuse_rate = reused / count["requests"] * 100 if count["requests"] else 0.0
+        stats[name] = dict(count, reuse_rate=reuse_rate)
+    return stats
+
+
+# 接続の再利用状況を1行の文字列にする
+def format_connection_stats():
+    return ", ".join(
+        f"{name}: {s['requests']} req / {s['connections']} conn ({s['reuse_rate']:.0f}% reused)"
+        for name, s in connection_stats().items()
+    )
@@ -0,0 +1,108 @@
+import time
+import queue
+import atexit
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tracing import count, propagate
+
+# 再実行の対象とする Cosmos DB のステータスコード
+TRANSIENT_STATUS_CODES = {408, 429, 449, 500, 503}
+
+
+# アイテムを書き込む。一時的なエラーの場合は待ってから再実行し、それでも失敗した場合は例外を送出する
+def upsert_with_retry(container, item, max_retries=5):
+    for attempt in range(max_retries + 1):
+        try:
+            return container.upsert_item(item)
+        except Exception as e:
+            status_code = getattr(e, "status_code", None)
+            if status_code not in TRANSIENT_STATUS_CODES or attempt == max_retries:
+                raise
+            count("retries.cosmos")
+            time.sleep(min(30, 0.5 * 2 ** attempt) + random.uniform(0, 0.5))
+
+
+# 複数のアイテムを max_workers 並列で書き込み、全件の完了を待つ(インデックス作成の一括書き込み用)
+# Cosmos DB の一括操作(トランザクションバッチ)は同じパーティションキーのアイテムに限られるため、
+# /id をパーティションキーとする KB のコンテナでは1件ずつの書き込みを並列に行う。失敗したアイテムがあれば最初の例外を送出する
+def upsert_items(container, items, max_workers=8, max_retries=5):
+    if max_workers <= 1 or len(items) <= 1:
+        for item in items:
+            upsert_with_retry(container, item, max_retries)
+        return
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        futures = [executor.submit(propagate(upsert_with_retry), container, item, max_retries) for item in items]
+        for future in futures:
+            future.result()
+
+
+# Cosmos DB への書き込みをバックグラウンドのスレッドで行うライター
+# put() はキューに積むだけで戻るため、リクエスト処理のスレッドは書き込みの完了を待たない
+class BackgroundWriter:
+    def __init__(self, container, max_queue_size=1000, batch_size=50, max_retries=5, put_timeout=5.0):
+        self.container = container
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.__run, name="cosmos-writer", daemon=True)
+        self.thread.start()
+        # プロセス終了時にキューに残っている分を書き込む
+        atexit.register(self.close)
+
+    # 書き込むアイテムをキューに積む。キューが一杯の場合は put_timeout 秒まで待ち、それでも空かなければ破棄する
+    def put(self, item):
+        if self.closed:
+            raise RuntimeError("writer is closed")
+        try:
+            self.queue.put(item, timeout=self.put_timeout)
+        except queue.Full:
+            self.dropped += 1
+            print("cosmos writer queue is full, dropped item:", item.get("id"))
+
+    # キューに残っているアイテムを全て書き込んでスレッドを終了する
+    def close(self, timeout=30):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    # キューからアイテムをまとめて取り出して書き込む
+    def __run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in batch:
+                if item is None:
+                    continue
+                self.__upsert_with_retry(item)
+            if None in batch:
+                return
+
+    # 一時的なエラーの場合は待ってから再実行する
+    def __upsert_with_retry(self, item):
+        try:
+            upsert_with_retry(self.container, item, self.max_retries)
+            self.written += 1
+        except Exception as e:
+            self.failed += 1
+            print("failed to write to cosmos db:", item.get("id"), e)
+
+    # 書き込み状況を返す
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "written": self.written,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,123 @@
+import os
+import numpy as np
+from promptbuilder import overlap_length
+from tracing import count
+
+# 検索結果の多様化(MMR: Maximal Marginal Relevance)
+# 検索結果を多め(top_k * MMR_FETCH_FACTOR 件)に取得し、関連度が高く、選択済みの結果と似ていないものから順に top_k 件を選ぶ
+#   スコア = λ * 関連度 - (1 - λ) * 選択済みの結果とのコサイン類似度の最大値
+#   関連度は検索のスコア(セマンティックランカーを使う場合はリランカーのスコア)を 0〜1 に正規化したもの
+# 選択済みの結果とのコサイン類似度が MMR_DUPLICATE_THRESHOLD 以上の結果はほぼ同じ内容とみなして除外し、
+# 同じファイルから選ぶ件数は max_per_file 件までとする。選んだ結果のうち同じファイルの連続するチャンクは1つにまとめる
+# 複数のインデックスの結果(fanout.py)では、インデックス名(indexName)が異なる同名のファイルは別のファイルとして扱う
+
+# 多様化には候補のベクトル(3072次元で1件あたり約60KBの JSON)が必要なため、top_k=10 では1回の検索で約1.8MBを受信する
+# 検索の転送量と処理時間が増えるため、既定では無効にする
+MMR_ENABLED = os.getenv("MMR_ENABLED", "false").lower() in ("1", "true", "yes")
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))
+MMR_FETCH_FACTOR = int(os.getenv("MMR_FETCH_FACTOR", "3"))
+MMR_MAX_PER_FILE = int(os.getenv("MMR_MAX_PER_FILE", "3"))
+MMR_DUPLICATE_THRESHOLD = float(os.getenv("MMR_DUPLICATE_THRESHOLD", "0.97"))
+
+
+# 関連度とベクトルの行列から MMR で k 件を選び、選んだ順の行番号のリストを返す
+# files を指定した場合は、同じ値の行を max_per_file 件まで(0の場合は制限なし)選ぶ
+def mmr(relevance, vectors, k, mmr_lambda=MMR_LAMBDA, duplicate_threshold=MMR_DUPLICATE_THRESHOLD, files=None, max_per_file=0):
+    relevance = np.asarray(relevance, dtype=np.float32)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    similarity = vectors @ vectors.T
+    available = np.ones(len(relevance), dtype=bool)
+    max_similarity = np.zeros(len(relevance), dtype=np.float32)
+    file_counts = {}
+    selected = []
+    while len(selected) < k and available.any():
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity
+        i = int(np.argmax(np.where(available, scores, -np.inf)))
+        selected.append(i)
+        available[i] = False
+        max_similarity = np.maximum(max_similarity, similarity[i])
+        # ほぼ同じ内容の結果は以降の候補から外す
+        duplicates = available & (similarity[i] >= duplicate_threshold)
+        if duplicates.any():
+            count("mmr.duplicates", int(duplicates.sum()))
+            available &= ~duplicates
+        if files is not None and max_per_file > 0:
+            file_counts[files[i]] = file_counts.get(files[i], 0) + 1
+            if file_counts[files[i]] >= max_per_file:
+                available &= np.array([file != files[i] for file in files])
+    return selected
+
+
+# 検索結果のスコアを 0〜1 に正規化した関連度にする
+def __relevance(results):
+    scores = np.array([
+        result.get("@search.reranker_score") if result.get("@search.reranker_score") is not None else result["@search.score"]
+        for result in results
+    ], dtype=np.float32)
+    spread = scores.max() - scores.min()
+    return (scores - scores.min()) / spread if spread > 0 else np.ones_like(scores)
+
+
+# 検索結果を MMR で top_k 件に絞り、同じファイルの連続するチャンクをまとめて返す
+# 結果にベクトル(contentVector)がない場合は MMR を行わず、検索の順位のまま件数の上限と結合だけを行う
+def diversify(results, top_k, mmr_lambda=MMR_LAMBDA, max_per_file=MMR_MAX_PER_FILE):
+    if not results:
+        return []
+    files = [file_key(result) for result in results]
+    if all(result.get("contentVector") is not None for result in results):
+        selected = mmr(__relevance(results), [result["contentVector"] for result in results], top_k, mmr_lambda,
+                       files=files, max_per_file=max_per_file)
+    else:
+        selected = []
+        file_counts = {}
+        for i, file in enumerate(files):
+            if len(selected) >= top_k:
+                break
+            if max_per_file <= 0 or file_counts.get(file, 0) < max_per_file:
+                selected.append(i)
+                file_counts[file] = file_counts.get(file, 0) + 1
+    picked = [{key: value for key, value in results[i].items() if key != "contentVector"} for i in selected]
+    merged = merge_adjacent_chunks(picked)
+    count("mmr.merged", len(picked) - len(merged))
+    return merged
+
+
+# 結果のファイルを区別するキー(インデックス名, ファイル名)。インデックス名がない場合は None
+def file_key(result):
+    return (result.get("indexName"), result["fileName"])
+
+
+# 同じファイルの連続するチャンクを1つの結果にまとめる。まとめた結果は先に選ばれたチャンクの位置に置く
+# まとめた結果の chunkNo は先頭のチャンクの番号、chunkNos は全チャンクの番号、スコアは最大値とする
+# リランカーのスコア(@search.reranker_score)も、スコアと同じく全チャンクの最大値とする
+def merge_adjacent_chunks(results):
+    by_chunk = {(file_key(result), result["chunkNo"]): result for result in results}
+    merged = []
+    used = set()
+    for result in results:
+        file = file_key(result)
+        if (file, result["chunkNo"]) in used:
+            continue
+        first = last = result["chunkNo"]
+        while (file, first - 1) in by_chunk and (file, first - 1) not in used:
+            first -= 1
+        while (file, last + 1) in by_chunk and (file, last + 1) not in used:
+            last += 1
+        group = [by_chunk[(file, chunk_no)] for chunk_no in range(first, last + 1)]
+        used.update((file, chunk_no) for chunk_no in range(first, last + 1))
+        if len(group) == 1:
+            merged.append(result)
+            continue
+        content = group[0]["content"]
+        for chunk in group[1:]:
+            content += chunk["content"][overlap_length(content, chunk["content"]):]
+        reranker_scores = [chunk["@search.reranker_score"] for chunk in group if chunk.get("@search.reranker_score") is not None]
+        merged.append(dict(
+            group[0],
+            content=content,
+            chunkNos=list(range(first, last + 1)),
+            **{"@search.score": max(chunk["@search.score"] for chunk in group),
+               "@search.reranker_score": max(reranker_scores) if reranker_scores else None},
+        ))
+    return merged
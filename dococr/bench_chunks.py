@@ -0,0 +1,132 @@
+import io
+import time
+import random
+import argparse
+import contextlib
+from dococr.create_chunks import chunk_content, get_tiktoken_encoding
+
+# chunk_content のベンチマーク
+# 大きな日本語 Markdown ドキュメントに対して、従来の実装(結合した文字列を都度トークン化する実装)と
+# 現在の実装の処理時間を比較し、全てのオーバラップ設定で同じチャンクが得られることを確認する
+#   python -m dococr.bench_chunks --pages 300
+#   python -m dococr.bench_chunks --file <OCR済みのMarkdownファイル>
+
+SENTENCES = [
+    "本システムは社内のナレッジを検索するためのアプリケーションです",
+    "管理者は設定画面からユーザーの権限を変更できます",
+    "ファイルをアップロードすると、自動的にインデックスに登録されます",
+    "エラーが発生した場合は、ログを確認してサポート窓口に連絡してください",
+    "検索結果には参照元のファイル名とチャンク番号が表示されます",
+    "Azure OpenAI Service の API キーは環境変数で設定します",
+    "詳細な手順については、第3章の「運用手順」を参照してください",
+]
+
+
+# ベンチマーク用の日本語 Markdown ドキュメントを作成する
+def make_document(pages, seed=0):
+    rng = random.Random(seed)
+    lines = []
+    for page in range(pages):
+        lines.append(f"# 第{page + 1}章 運用マニュアル")
+        for section in range(3):
+            lines.append(f"## {page + 1}.{section + 1} 手順")
+            for _ in range(rng.randint(3, 8)):
+                sentences = [rng.choice(SENTENCES) for _ in range(rng.randint(1, 4))]
+                lines.append("、".join(sentences) + "。")
+            lines.append("| 項目 | 内容 |\n| --- | --- |\n| 設定 | " + rng.choice(SENTENCES) + " |")
+    return "\n".join(lines)
+
+
+# 従来の実装(比較用)
+def legacy_chunk_content(content, max_chunk_token_size, overlap_token_rate, overlap_type):
+    calc_tokens = lambda s: len(get_tiktoken_encoding().encode(s))
+    chunks = [content]
+    for tag in ["##", "#"]:
+        staging_chunks = []
+        for chunk in chunks:
+            if calc_tokens(chunk) > max_chunk_token_size:
+                staging_chunks += [tag + c for c in chunk.split(tag)]
+            else:
+                staging_chunks.append(chunk)
+        chunks = staging_chunks
+    for tag in ["\n", "。", "、", " "]:
+        staging_chunks = []
+        for chunk in chunks:
+            if calc_tokens(chunk) > max_chunk_token_size:
+                parts = chunk.split(tag)
+                staging_chunks += [part + tag for part in parts[:-1] if len(part) > 0]
+                if parts[-1]:
+                    staging_chunks.append(parts[-1])
+            else:
+                staging_chunks.append(chunk)
+        chunks = staging_chunks
+
+    if calc_tokens("".join(chunks)) <= max_chunk_token_size:
+        return ["".join(chunks)]
+    overlap_token_size = int(max_chunk_token_size * overlap_token_rate)
+    if overlap_type == "PRE" or overlap_type == "POST":
+        chunk_token_size = max_chunk_token_size - overlap_token_size
+    elif overlap_type == "PREPOST":
+        chunk_token_size = max_chunk_token_size - overlap_token_size * 2
+    else:
+        chunk_token_size = max_chunk_token_size
+    processed_chunks = []
+    staging_chunk = ""
+    pre_overlap_chunk = ""
+    post_overlap_chunk = ""
+    for i in range(0, len(chunks)):
+        chunk = chunks[i]
+        if calc_tokens(staging_chunk) + calc_tokens(chunk) > chunk_token_size:
+            if overlap_type == "POST" or overlap_type == "PREPOST":
+                post_overlap_chunk = ""
+                for j in range(i, len(chunks)):
+                    if calc_tokens(chunks[j]) + calc_tokens(post_overlap_chunk) > overlap_token_size:
+                        break
+                    post_overlap_chunk += chunks[j]
+            processed_chunks.append(pre_overlap_chunk + staging_chunk + post_overlap_chunk)
+            staging_chunk = chunk
+            if overlap_type == "PRE" or overlap_type == "PREPOST":
+                pre_overlap_chunk = ""
+                for j in range(i - 1, 0, -1):
+                    if calc_tokens(chunks[j]) + calc_tokens(pre_overlap_chunk) > overlap_token_size:
+                        break
+                    pre_overlap_chunk = chunks[j] + pre_overlap_chunk
+        else:
+            staging_chunk += chunk
+    processed_chunks.append(pre_overlap_chunk + staging_chunk)
+    return processed_chunks
+
+
+# 関数を実行して処理時間と結果を返す(chunk_content が表示する内容は捨てる)
+def measure(func, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+    return elapsed, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark chunk_content against the legacy implementation.')
+    parser.add_argument('--file', type=str, help='Path to a markdown file to chunk.')
+    parser.add_argument('--pages', type=int, default=300, help='Number of pages of the generated document.')
+    parser.add_argument('--max-tokens', type=int, default=2048, help='max_chunk_token_size')
+    parser.add_argument('--overlap-rate', type=float, default=0.1, help='overlap_token_rate')
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, 'r', encoding='utf-8') as f:
+            content = f.read()
+    else:
+        content = make_document(args.pages)
+    print(f"document: {len(content)} chars, {len(get_tiktoken_encoding().encode(content))} tokens")
+
+    for overlap_type in ["NONE", "PRE", "POST", "PREPOST"]:
+        legacy_seconds, legacy_chunks = measure(legacy_chunk_content, content, args.max_tokens, args.overlap_rate, overlap_type)
+        seconds, chunks = measure(chunk_content, content, args.max_tokens, args.overlap_rate, overlap_type)
+        print(f"{overlap_type:8s} chunks={len(chunks):5d} legacy={legacy_seconds:8.3f}s current={seconds:8.3f}s "
+              f"speedup={legacy_seconds / max(seconds, 1e-9):6.1f}x same={chunks == legacy_chunks}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,25 @@
 import re
+from bisect import bisect_right
+from functools import lru_cache
+import regex
 import tiktoken
+from tracing import traced, count
 
-# TikTokenの初期化
-tiktoken_encoding = tiktoken.encoding_for_model("gpt-4")
+# TikToken のエンコーディング。読み込みに時間がかかるため、最初に使う時に読み込む
+@lru_cache(maxsize=None)
+def get_tiktoken_encoding():
+    return tiktoken.encoding_for_model("gpt-4")
+
+
+# TikToken がトークン化の前にテキストを分割する正規表現(プレトークナイザ)
+# トークン数はこの正規表現で分割した各ピースのトークン数の合計になる
+@lru_cache(maxsize=None)
+def get_tiktoken_pattern():
+    return regex.compile(get_tiktoken_encoding()._pat_str)
 
 
 # コンテンツをチャンクに分割する
+@traced("chunk_content")
 def chunk_content(
     content: str,
     max_chunk_token_size: int,  # ex) 4096
@@ -13,12 +27,20 @@ def chunk_content(
     overlap_type: str,  # PREPOST | PRE | POST | NONE
 ):
 
+    # 分割されなかったチャンクを次の段階で再計算しないよう、トークン数をキャッシュする
+    token_cache = {}
+
+    def calc_tokens(chunk):
+        if chunk not in token_cache:
+            token_cache[chunk] = __calc_tokens(chunk)
+        return token_cache[chunk]
+
     # 見出しでチャンクを分割する
     chunks = [content]
     for tag in ["##", "#"]:
         staging_chunks = []
         for chunk in chunks:
-            if __calc_tokens(chunk) > max_chunk_token_size:
+            if calc_tokens(chunk) > max_chunk_token_size:
                 # tagを残したままチャンクを分割
                 split_chunks = __split_content_by_markdown_tag(chunk, tag)
                 staging_chunks += split_chunks
@@ -26,15 +48,11 @@ def chunk_content(
                 staging_chunks.append(chunk)
         chunks = staging_chunks
 
-    # chunksの内容とそのナンバーを表示
-    for i, chunk in enumerate(chunks):
-        print(f"Chunk Number: {i}, Content: {chunk}")
-
     # 改行、句読点、スペースでチャンクを分割する
     for tag in ["\n", "。", "、", " "]:
         staging_chunks = []
         for chunk in chunks:
-            if __calc_tokens(chunk) > max_chunk_token_size:
+            if calc_tokens(chunk) > max_chunk_token_size:
                 staging_chunks += __split_content_by_delimiter(chunk, tag)
             else:
                 staging_chunks.append(chunk)
@@ -43,6 +61,7 @@ def chunk_content(
 
     # 分割したチャンクを定義したチャンクサイズとオーバラップ設定に合わせて結合する
     chunks = __merge_chunks(chunks, max_chunk_token_size, overlap_token_rate, overlap_type)
+    count("chunks", len(chunks))
 
     return chunks
 
@@ -69,13 +88,25 @@ def __split_content_by_delimiter(content, delimiter):
 
 
 # 分割したチャンク同士を指定した chunk_token_size に合わせて適切なサイズに結合する
+# チャンクを結合したテキストを一度だけトークン化し、ステージングチャンクやオーバラップ分のトークン数は
+# チャンクの範囲(開始番号, 終了番号)から TokenIndex で求める(結合した文字列を都度トークン化しない)
 def __merge_chunks(chunks, max_chunk_token_size, overlap_token_rate, overlap_type="PREPOST"):
 
+    joined = "".join(chunks)
+    offsets = [0]
+    for chunk in chunks:
+        offsets.append(offsets[-1] + len(chunk))
+    token_index = TokenIndex(joined)
+
+    # chunks[start:end] を結合した文字列のトークン数を返す
+    def calc_range_tokens(start, end):
+        return token_index.count(offsets[start], offsets[end])
+
     # 入力されたチャンクを全て結合したもののトークン数が最大チャンクトークン数以下の場合は全て結合して返す
     # (無駄にオーバラップ処理を行わないための処理)
-    total_tokens = __calc_tokens("".join(chunks))
+    total_tokens = calc_range_tokens(0, len(chunks))
     if total_tokens <= max_chunk_token_size:
-        return ["".join(chunks)]
+        return [joined]
 
     # オーバラップ設定に合わせてオーバラップトークン数を計算する
     overlap_token_size = int(max_chunk_token_size * overlap_token_rate)
@@ -88,56 +119,102 @@ def __merge_chunks(chunks, max_chunk_token_size, overlap_token_rate, overlap_typ
     else:
         chunk_token_size = max_chunk_token_size
 
+    # 各チャンクのトークン数
+    chunk_tokens_list = [calc_range_tokens(i, i + 1) for i in range(len(chunks))]
+
+    # ステージングチャンク・前後オーバラップ分はチャンクの範囲で保持する
+    # 前オーバラップ分とステージングチャンクは連続しているため、pre_overlap_start から staging_end までが確定対象になる
     processed_chunks = []
-    staging_chunk = ""
-    pre_overlap_chunk = ""
-    post_overlap_chunk = ""
+    pre_overlap_start = 0
+    staging_start = 0
+    staging_end = 0
     for i in range(0, len(chunks)):
         # ステージングチャンクと処理対象のチャンクのトークン数を計算する
-        chunk = chunks[i]
-        staging_chunk_tokens = __calc_tokens(staging_chunk)
-        chunk_tokens = __calc_tokens(chunk)
+        staging_chunk_tokens = calc_range_tokens(staging_start, staging_end)
+        chunk_tokens = chunk_tokens_list[i]
 
         # 指定トークン数を超える場合は、前後オーバラップ分を作成＆付与してチャンクとして確定する
         if staging_chunk_tokens + chunk_tokens > chunk_token_size:
 
             # 後オーバラップ分を作成
+            post_overlap_end = i
             if overlap_type == "POST" or overlap_type == "PREPOST":
-                post_overlap_chunk = ""
                 for j in range(i, len(chunks)):
-                    overlap_chunk = chunks[j]
-                    overlap_chunk_tokens = __calc_tokens(overlap_chunk)
-                    post_overlap_chunk_tokens = __calc_tokens(post_overlap_chunk)
+                    overlap_chunk_tokens = chunk_tokens_list[j]
+                    post_overlap_chunk_tokens = calc_range_tokens(i, post_overlap_end)
                     if overlap_chunk_tokens + post_overlap_chunk_tokens > overlap_token_size:
                         break
-                    post_overlap_chunk += overlap_chunk
+                    post_overlap_end = j + 1
 
             # ステージングチャンクに前後オーバラップ分を付与してチャンクとして確定する
-            processed_chunk = pre_overlap_chunk + staging_chunk + post_overlap_chunk
+            processed_chunk = joined[offsets[pre_overlap_start]:offsets[staging_end]] + joined[offsets[i]:offsets[post_overlap_end]]
             processed_chunks.append(processed_chunk)
-            staging_chunk = chunk
+            staging_start = i
+            staging_end = i + 1
 
             # 前オーバラップ分を作成
+            pre_overlap_start = staging_start
             if overlap_type == "PRE" or overlap_type == "PREPOST":
-                pre_overlap_chunk = ""
                 for j in range(i - 1, 0, -1):
-                    overlap_chunk = chunks[j]
-                    overlap_chunk_tokens = __calc_tokens(overlap_chunk)
-                    pre_overlap_chunk_tokens = __calc_tokens(pre_overlap_chunk)
+                    overlap_chunk_tokens = chunk_tokens_list[j]
+                    pre_overlap_chunk_tokens = calc_range_tokens(pre_overlap_start, i)
                     if overlap_chunk_tokens + pre_overlap_chunk_tokens > overlap_token_size:
                         break
-                    pre_overlap_chunk = overlap_chunk + pre_overlap_chunk
+                    pre_overlap_start = j
         else:
             # 指定トークン数を超えない場合は、ステージングチャンクに追加する
-            staging_chunk += chunk
+            staging_end = i + 1
 
     # 最後のチャンクに前オーバラップ分を付与してチャンクとして確定する
-    processed_chunk = pre_overlap_chunk + staging_chunk
+    processed_chunk = joined[offsets[pre_overlap_start]:offsets[staging_end]]
     processed_chunks.append(processed_chunk)
 
     return processed_chunks
 
 
+# テキストの部分文字列のトークン数を求めるためのインデックス
+# テキスト全体をプレトークナイザで一度だけ分割し、ピースごとのトークン数の累積和を保持する。
+# 部分文字列の両端付近のみ再分割し、それ以外は累積和の差で求めるため、1回あたりの計算量は部分文字列の長さに依存しない
+class TokenIndex:
+    def __init__(self, text):
+        self.text = text
+        self.starts = []  # 各ピースの開始位置
+        self.prefix_tokens = [0]  # ピースごとのトークン数の累積和
+        for match in get_tiktoken_pattern().finditer(text):
+            self.starts.append(match.start())
+            self.prefix_tokens.append(self.prefix_tokens[-1] + self.calc_piece_tokens(match.group()))
+        self.start_numbers = {start: number for number, start in enumerate(self.starts)}
+
+    # text[start:end] のトークン数を返す
+    def count(self, start, end):
+        if start >= end:
+            return 0
+
+        # 末尾を含むピースとその1つ前のピースは、末尾で切ると分割結果が変わり得るため再分割する
+        rescan_start = self.starts[max(bisect_right(self.starts, end - 1) - 2, 0)]
+        if rescan_start <= start:
+            return self.__scan_tokens(start, end)
+
+        # 先頭から分割していき、全体の分割位置と一致したらそれ以降は累積和を使う
+        tokens = 0
+        for match in get_tiktoken_pattern().finditer(self.text, start, end):
+            if match.start() <= rescan_start and match.start() in self.start_numbers:
+                tokens += self.prefix_tokens[self.start_numbers[rescan_start]] - self.prefix_tokens[self.start_numbers[match.start()]]
+                return tokens + self.__scan_tokens(rescan_start, end)
+            tokens += self.calc_piece_tokens(match.group())
+        return tokens
+
+    # text[start:end] を分割し直してトークン数を計算する
+    def __scan_tokens(self, start, end):
+        return sum(self.calc_piece_tokens(match.group()) for match in get_tiktoken_pattern().finditer(self.text, start, end))
+
+    # プレトークナイザで分割した1ピースのトークン数を計算する(同じピースは頻出するためキャッシュする)
+    @staticmethod
+    @lru_cache(maxsize=65536)
+    def calc_piece_tokens(piece):
+        return len(get_tiktoken_encoding().encode_ordinary(piece))
+
+
 # 指定した文字列のトークン数を計算する
 def __calc_tokens(s):
-    return len(tiktoken_encoding.encode(s))
+    return len(get_tiktoken_encoding().encode(s))
@@ -0,0 +1,142 @@
+import os
+import gzip
+import json
+import time
+import hashlib
+import argparse
+import threading
+from datetime import datetime
+from tracing import count
+
+# Document Intelligence の OCR 結果(後処理済みの Markdown)のディスクキャッシュ
+# キーはファイルの SHA-256 とモデル・オプションから作成し、gzip 圧縮して保存する
+#   python -m dococr.ocr_cache inspect
+#   python -m dococr.ocr_cache purge [--older-than-days N] [--file <ファイル名>]
+
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", os.path.join(".ragcache", "ocr"))
+OCR_CACHE_ENABLED = os.getenv("OCR_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+
+__lock = threading.Lock()
+__stats = {"hits": 0, "misses": 0}
+
+
+# ファイルの SHA-256 とモデル・オプションからキャッシュのキーを作成する
+# source にはファイルのパスか、メモリ上のファイルの内容(bytes / memoryview)を指定する
+def make_cache_key(source, options):
+    sha256 = hashlib.sha256()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        sha256.update(source)
+    else:
+        with open(source, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(block)
+    sha256.update(json.dumps(options, sort_keys=True).encode("utf-8"))
+    return sha256.hexdigest()
+
+
+# キャッシュされた Markdown を取得する。存在しない場合は None
+def load(key):
+    path = os.path.join(OCR_CACHE_DIR, key + ".md.gz")
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            content = f.read()
+    except FileNotFoundError:
+        with __lock:
+            __stats["misses"] += 1
+        count("cache.ocr.misses")
+        return None
+    with __lock:
+        __stats["hits"] += 1
+    count("cache.ocr.hits")
+    return content
+
+
+# Markdown を圧縮して保存する。元のファイル名などのメタ情報は別ファイルに保存する
+def save(key, content, file_name, options):
+    os.makedirs(OCR_CACHE_DIR, exist_ok=True)
+    path = os.path.join(OCR_CACHE_DIR, key + ".md.gz")
+    # 書き込み途中のファイルを読まないよう、一時ファイルに書いてから置き換える
+    with gzip.open(path + ".tmp", "wt", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(path + ".tmp", path)
+    with open(os.path.join(OCR_CACHE_DIR, key + ".json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "file_name": os.path.basename(file_name),
+            "options": options,
+            "chars": len(content),
+            "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }, f, ensure_ascii=False)
+
+
+# ヒット・ミスの件数を文字列で返す
+def stats():
+    with __lock:
+        return f"hits={__stats['hits']} misses={__stats['misses']}"
+
+
+# キャッシュの一覧を返す
+def list_entries():
+    entries = []
+    if not os.path.isdir(OCR_CACHE_DIR):
+        return entries
+    for name in sorted(os.listdir(OCR_CACHE_DIR)):
+        if not name.endswith(".md.gz"):
+            continue
+        key = name[:-len(".md.gz")]
+        path = os.path.join(OCR_CACHE_DIR, name)
+        meta = {}
+        try:
+            with open(os.path.join(OCR_CACHE_DIR, key + ".json"), encoding="utf-8") as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass
+        entries.append({
+            "key": key,
+            "file_name": meta.get("file_name", ""),
+            "chars": meta.get("chars", 0),
+            "bytes": os.path.getsize(path),
+            "mtime": os.path.getmtime(path),
+        })
+    return entries
+
+
+# キャッシュを削除する。older_than_days, file_name を指定した場合は条件に合うものだけ削除する
+def purge(older_than_days=None, file_name=None):
+    removed = 0
+    for entry in list_entries():
+        if older_than_days is not None and time.time() - entry["mtime"] < older_than_days * 86400:
+            continue
+        if file_name is not None and entry["file_name"] != file_name:
+            continue
+        for suffix in (".md.gz", ".json"):
+            try:
+                os.remove(os.path.join(OCR_CACHE_DIR, entry["key"] + suffix))
+            except FileNotFoundError:
+                pass
+        removed += 1
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or purge the OCR result cache.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('inspect', help='List cached OCR results.')
+    purge_parser = subparsers.add_parser('purge', help='Delete cached OCR results.')
+    purge_parser.add_argument('--older-than-days', type=float, help='Only delete entries older than N days.')
+    purge_parser.add_argument('--file', type=str, help='Only delete entries of the given file name.')
+    args = parser.parse_args()
+
+    if args.command == 'inspect':
+        entries = list_entries()
+        for entry in entries:
+            created = datetime.fromtimestamp(entry["mtime"]).strftime("%Y-%m-%d %H:%M:%S")
+            print(f"{entry['key'][:16]}  {created}  {entry['bytes'] / 1024:8.1f}KB  {entry['chars']:8d} chars  {entry['file_name']}")
+        total = sum(entry["bytes"] for entry in entries)
+        print(f"{len(entries)} entries, {total / 1024 / 1024:.1f}MB in {OCR_CACHE_DIR}")
+    else:
+        removed = purge(args.older_than_days, args.file)
+        print(f"removed {removed} entries from {OCR_CACHE_DIR}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,145 @@
 import os
 import re
+import io
 import json
 from base64 import b64encode
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.documentintelligence import DocumentIntelligenceClient
-from azure.ai.documentintelligence.models import DocumentAnalysisFeature, ContentFormat
+from concurrent.futures import ThreadPoolExecutor
+from dococr import ocr_cache
+from tracing import traced, span, propagate, count
+from clients import get_document_intelligence_client
 from dotenv import load_dotenv  
 # 環境変数を読み込む  
 load_dotenv() 
 
-# 環境変数から Azure Document Intelligence のエンドポイントとキーを取得する
-DOCUMENT_INTELLIGENCE_ENDPOINT = os.getenv("DOCUMENT_INTELLIGENCE_ENDPOINT")
-DOCUMENT_INTELLIGENCE_KEY = os.getenv("DOCUMENT_INTELLIGENCE_KEY")
+# OCR のモデルとオプション。OCR 結果のキャッシュのキーにも使う
+# OCR 結果の後処理(__get_content_from_ocr_result)を変更した場合は postprocess_version を変更する
+# 読み込み時に SDK を読み込まないよう、features は DocumentAnalysisFeature.OCR_HIGH_RESOLUTION の値(文字列)で指定する
+# pypdf も PDF のページ数を数えるときに読み込む
+OCR_OPTIONS = {
+    "model_id": "prebuilt-layout",
+    "locale": "ja-JP",
+    "features": ["ocrHighResolution"],
+    "output_content_format": "markdown",
+    "postprocess_version": 1,
+}
 
-# Document Intelligence クライアントを生成する
-credential = AzureKeyCredential(DOCUMENT_INTELLIGENCE_KEY)
-client = DocumentIntelligenceClient(DOCUMENT_INTELLIGENCE_ENDPOINT, credential)
+# ページ数の多い PDF はページ範囲ごとに分割し、複数の OCR ジョブを並列に実行する
+# OCR_PARALLEL_MIN_PAGES ページ以上の PDF を OCR_PAGES_PER_JOB ページずつ、最大 OCR_MAX_CONCURRENT_JOBS 並列で処理する
+OCR_PARALLEL_MIN_PAGES = int(os.getenv("OCR_PARALLEL_MIN_PAGES", "100"))
+OCR_PAGES_PER_JOB = int(os.getenv("OCR_PAGES_PER_JOB", "50"))
+OCR_MAX_CONCURRENT_JOBS = int(os.getenv("OCR_MAX_CONCURRENT_JOBS", "4"))
+
+# ページ範囲ごとの OCR 結果を結合する際の区切り(Document Intelligence がページ間に出力するものと同じ)
+PAGE_BREAK = "\n<!-- PageBreak -->\n"
 
 
 # 指定したドキュメントを Document Intelligence で OCR 処理してHTML変換して返す
-def get_content_from_document(file_path):
-    result = __get_ocr_result(file_path)
-    result = result.as_dict()
-    return __get_content_from_ocr_result(result)
+# 同じファイル・オプションの OCR 結果はキャッシュから返す
+# source にはファイルのパスか、メモリ上のファイルの内容(bytes / memoryview)を指定する。後者の場合は file_name も指定する
+@traced("get_content_from_document")
+def get_content_from_document(source, file_name=None):
+    if file_name is None:
+        file_name = os.path.basename(source)
+    if ocr_cache.OCR_CACHE_ENABLED:
+        cache_key = ocr_cache.make_cache_key(source, OCR_OPTIONS)
+        content = ocr_cache.load(cache_key)
+        if content is not None:
+            print("ocr cache hit:", file_name)
+            return content
+
+    count("bytes.ocr_input", len(source) if isinstance(source, (bytes, bytearray, memoryview)) else os.path.getsize(source))
+    page_count = __count_pages(source, file_name)
+    count("ocr.pages", page_count)
+    if page_count >= OCR_PARALLEL_MIN_PAGES:
+        result = __get_ocr_result_by_page_ranges(source, file_name, page_count)
+    else:
+        result = __get_ocr_result(source)
+        result = result.as_dict()
+    content = __get_content_from_ocr_result(result)
+
+    if ocr_cache.OCR_CACHE_ENABLED:
+        ocr_cache.save(cache_key, content, file_name, OCR_OPTIONS)
+    return content
+
+
+# ファイルのパスまたはメモリ上のファイルの内容を、読み込み用のファイルオブジェクトにする
+def __open_source(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    return open(source, "rb")
 
 
 # 指定したドキュメントを Document Intelligence で OCR 処理して結果を返す
-def __get_ocr_result(file_path):
-    with open(file_path, "rb") as f:
-        poller = client.begin_analyze_document(
-            "prebuilt-layout",
+def __get_ocr_result(source):
+    with __open_source(source) as f:
+        poller = get_document_intelligence_client().begin_analyze_document(
+            OCR_OPTIONS["model_id"],
             analyze_request=f,
-            locale="ja-JP",
-            features=[DocumentAnalysisFeature.OCR_HIGH_RESOLUTION],
-            output_content_format="markdown",
+            locale=OCR_OPTIONS["locale"],
+            features=OCR_OPTIONS["features"],
+            output_content_format=OCR_OPTIONS["output_content_format"],
             content_type="application/octet-stream",
         )
     return poller.result()
 
 
+# PDF のページ数を返す。PDF 以外の場合は 0
+# pypdf で読み込めない PDF や暗号化された PDF もページ範囲に分割せずに Document Intelligence で処理できるため、0 を返す
+def __count_pages(source, file_name):
+    if not file_name.lower().endswith(".pdf"):
+        return 0
+    from pypdf import PdfReader
+    try:
+        with __open_source(source) as f:
+            reader = PdfReader(f)
+            if reader.is_encrypted:
+                print("encrypted pdf, ocr without splitting:", file_name)
+                return 0
+            return len(reader.pages)
+    except Exception as e:
+        print("failed to count pages, ocr without splitting:", file_name, e)
+        return 0
+
+
+# PDF をページ範囲ごとに分割して並列に OCR 処理し、ページ順に結合した結果を返す
+def __get_ocr_result_by_page_ranges(source, file_name, page_count):
+    page_ranges = [
+        (start, min(start + OCR_PAGES_PER_JOB - 1, page_count))
+        for start in range(1, page_count + 1, OCR_PAGES_PER_JOB)
+    ]
+    print(f"ocr {page_count} pages in {len(page_ranges)} jobs:", file_name)
+    with ThreadPoolExecutor(max_workers=OCR_MAX_CONCURRENT_JOBS) as executor:
+        # executor.map は入力順に結果を返すため、ページ順は保たれる
+        contents = list(executor.map(propagate(lambda page_range: __get_ocr_content_for_pages(source, file_name, *page_range)), page_ranges))
+    return {"content": PAGE_BREAK.join(contents)}
+
+
+# 指定したページ範囲(1始まり、両端を含む)だけの PDF を作成して OCR 処理し、Markdown を返す
+def __get_ocr_content_for_pages(source, file_name, start_page, end_page):
+    from pypdf import PdfReader, PdfWriter
+    writer = PdfWriter()
+    with __open_source(source) as f:
+        reader = PdfReader(f)
+        for page in reader.pages[start_page - 1:end_page]:
+            writer.add_page(page)
+        buffer = io.BytesIO()
+        writer.write(buffer)
+    buffer.seek(0)
+
+    with span("ocr_pages", start_page=start_page, end_page=end_page):
+        poller = get_document_intelligence_client().begin_analyze_document(
+            OCR_OPTIONS["model_id"],
+            analyze_request=buffer,
+            locale=OCR_OPTIONS["locale"],
+            features=OCR_OPTIONS["features"],
+            output_content_format=OCR_OPTIONS["output_content_format"],
+            content_type="application/octet-stream",
+        )
+        content = poller.result().as_dict()['content']
+    print(f"ocr pages {start_page}-{end_page} done:", file_name)
+    return content
+
+
 # Document Intelligence で処理した結果を変換する
 def __get_content_from_ocr_result(result):
     content = result['content']
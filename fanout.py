@@ -0,0 +1,80 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+from tracing import span, count, propagate
+
+# 複数のインデックスへの同時検索(ファンアウト)と結果の統合
+# 部署ごとのインデックスなど、複数のインデックスに同じ質問のベクトルで同時に検索し、結果を1つの順位にまとめる
+# 処理時間は最も遅いインデックスの検索時間に近くなる。FANOUT_TIMEOUT_SECONDS 以内に応答がないインデックスの結果は使わない
+#   rrf:   Reciprocal Rank Fusion。各インデックスでの順位から 1 / (FANOUT_RRF_K + 順位) をスコアにする
+#   score: 各インデックスのスコア(セマンティックランカーを使う場合はリランカーのスコア)を 0〜1 に正規化して比べる
+
+FANOUT_TIMEOUT_SECONDS = float(os.getenv("FANOUT_TIMEOUT_SECONDS", "5"))
+FANOUT_MERGE = os.getenv("FANOUT_MERGE", "rrf")
+FANOUT_RRF_K = int(os.getenv("FANOUT_RRF_K", "60"))
+FANOUT_MAX_WORKERS = int(os.getenv("FANOUT_MAX_WORKERS", "16"))
+
+
+# カンマ区切りのインデックス名をリストにする(空白と重複は除く)
+def parse_index_names(text):
+    names = []
+    for name in text.split(","):
+        name = name.strip()
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+# search(インデックス名, timeout) を全てのインデックスに同時に実行し、{インデックス名: 検索結果のリスト} を返す
+# timeout 秒以内に終わらなかったインデックスとエラーになったインデックスは結果に含めない
+# search には同じ timeout を渡し、応答のないリクエストを通信のタイムアウトで終わらせる
+# スレッドプールは呼び出しごとに作成し、終わらない検索が残っても後の質問の検索を待たせないようにする
+def search_indexes(index_names, search, timeout=FANOUT_TIMEOUT_SECONDS):
+    with span("fanout", indexes=len(index_names)) as s:
+        executor = ThreadPoolExecutor(max_workers=max(1, min(len(index_names), FANOUT_MAX_WORKERS)), thread_name_prefix="fanout")
+        futures = {executor.submit(propagate(search), index_name, timeout): index_name for index_name in index_names}
+        done, not_done = wait(futures, timeout=timeout)
+        # タイムアウトした検索の終了は待たない
+        executor.shutdown(wait=False)
+        results = {}
+        for future in futures:
+            index_name = futures[future]
+            if future in not_done:
+                future.cancel()
+                print(f"search timed out after {timeout}s: {index_name}")
+                count("fanout.timeouts")
+            elif future.exception() is not None:
+                print(f"search failed: {index_name} {future.exception()}")
+                count("fanout.errors")
+            else:
+                results[index_name] = future.result()
+        s.set_attribute("succeeded", len(results))
+        return results
+
+
+# 各インデックスの検索結果を1つの順位にまとめて上位 top_k 件を返す
+# 結果には検索したインデックス名(indexName)を加え、@search.score を統合後のスコアにする
+def merge_results(results_by_index, top_k, method=FANOUT_MERGE):
+    merged = []
+    for index_name, results in results_by_index.items():
+        if method == "rrf":
+            scores = [1.0 / (FANOUT_RRF_K + rank) for rank in range(1, len(results) + 1)]
+        elif method == "score":
+            scores = __normalized_scores(results)
+        else:
+            raise ValueError(f"unknown merge method: {method}")
+        for result, score in zip(results, scores):
+            merged.append(dict(result, indexName=index_name, **{"@search.score": score, "@search.reranker_score": None}))
+    merged.sort(key=lambda result: result["@search.score"], reverse=True)
+    return merged[:top_k]
+
+
+# 検索結果のスコアを 0〜1 に正規化する
+def __normalized_scores(results):
+    scores = [
+        result.get("@search.reranker_score") if result.get("@search.reranker_score") is not None else result["@search.score"]
+        for result in results
+    ]
+    if not scores:
+        return []
+    low, high = min(scores), max(scores)
+    return [(score - low) / (high - low) if high > low else 1.0 for score in scores]
@@ -0,0 +1,193 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from tracing import count
+
+
+# SQLite を使ったディスクキャッシュ。値はバイト列で保持し、合計サイズが上限を超えたら
+# 最終アクセスが古いものから削除する(LRU)
+class SqliteLRUCache:
+    def __init__(self, path, max_bytes):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)")
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    # キーに対応する値を取得する。存在しない場合は None
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.conn:
+                self.conn.execute("UPDATE cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            return bytes(row[0])
+
+    # 値を保存し、上限を超えた場合は古いものから削除する
+    def set(self, key, value):
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.total_bytes -= row[0]
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (key, sqlite3.Binary(value), len(value), time.time()),
+            )
+            self.total_bytes += len(value)
+            if self.total_bytes > self.max_bytes:
+                self.__evict()
+
+    # 合計サイズが上限の9割以下になるまで、最終アクセスが古いものから削除する
+    def __evict(self):
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute("SELECT key, size FROM cache ORDER BY last_access").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        self.conn.executemany("DELETE FROM cache WHERE key = ?", evicted)
+
+    # キャッシュを全て削除する
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM cache")
+            self.total_bytes = 0
+
+    # 件数とサイズを取得する
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    # ヒット率などの統計情報を文字列で返す
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        return (f"hits={self.hits} misses={self.misses} hit_rate={hit_rate:.1f}% "
+                f"size={self.total_bytes / 1024 / 1024:.1f}MB/{self.max_bytes / 1024 / 1024:.0f}MB")
+
+
+# プロセス内のメモリキャッシュ。件数の上限を超えたら最終アクセスが古いものから削除し(LRU)、
+# TTL(秒)を過ぎたものは無効とする
+class MemoryLRUCache:
+    def __init__(self, max_items, ttl):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.items = OrderedDict()  # key: (保存時刻, 値)
+
+    # キーに対応する値を取得する。存在しないか期限切れの場合は None
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or (self.ttl and time.time() - item[0] > self.ttl):
+                self.items.pop(key, None)
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    # 値を保存し、上限を超えた場合は古いものから削除する
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (time.time(), value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    # キャッシュを全て削除する
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+# ベクトルのキャッシュ。メモリキャッシュと、任意でアプリ再起動後も残るディスクキャッシュの2段構成
+# ヒット率と、キャッシュにより短縮できた時間(ミス時の平均生成時間 × ヒット数)を記録する
+class EmbeddingCache:
+    def __init__(self, memory, disk=None):
+        self.memory = memory
+        self.disk = disk
+        self.hits = 0
+        self.misses = 0
+        self.miss_seconds = 0.0
+        self.lock = threading.Lock()
+
+    # キャッシュにあればそれを返し、なければ generate() で生成して保存する
+    def get_or_generate(self, key, generate):
+        vector = self.memory.get(key)
+        if vector is None and self.disk is not None:
+            data = self.disk.get(key)
+            if data is not None:
+                vector = unpack_vector(data)
+                self.memory.set(key, vector)
+        if vector is not None:
+            with self.lock:
+                self.hits += 1
+            count("cache.embedding.hits")
+            return vector
+
+        start = time.time()
+        vector = generate()
+        elapsed = time.time() - start
+        with self.lock:
+            self.misses += 1
+            self.miss_seconds += elapsed
+        count("cache.embedding.misses")
+        self.memory.set(key, vector)
+        if self.disk is not None:
+            self.disk.set(key, pack_vector(vector))
+        return vector
+
+    # ヒット率(%)と短縮できた時間(秒)を返す
+    def metrics(self):
+        with self.lock:
+            total = self.hits + self.misses
+            hit_rate = self.hits / total * 100 if total else 0.0
+            avg_miss_seconds = self.miss_seconds / self.misses if self.misses else 0.0
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": hit_rate,
+                "saved_seconds": self.hits * avg_miss_seconds,
+            }
+
+
+# キャッシュのキーを作成する。各要素を区切って SHA-256 を計算する
+def make_key(*parts):
+    return hashlib.sha256("\0".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+# ベクトルを float32 のバイト列に変換する
+def pack_vector(vector):
+    return array("f", vector).tobytes()
+
+
+# float32 のバイト列をベクトル(floatのリスト)に戻す
+def unpack_vector(data):
+    vector = array("f")
+    vector.frombytes(data)
+    return vector.tolist()
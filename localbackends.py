@@ -0,0 +1,474 @@
+import os
+import io
+import codecs
+import re
+import json
+import time
+import random
+import asyncio
+import shutil
+import sqlite3
+import hashlib
+import threading
+from collections import Counter, deque
+from types import SimpleNamespace
+import numpy as np
+from pypdf import PdfReader
+from azure.core.exceptions import ResourceNotFoundError
+from localindex import LocalVectorIndex
+from localbm25 import tokenize
+from dococr.create_chunks import get_tiktoken_encoding
+
+# Azure の各サービスのローカルの代替(スタンドイン)
+# RAG_BACKEND=local の場合に clients.py が返すクライアントで、Azure なしでインデックス作成とチャットを end-to-end で実行できる
+# データは LOCAL_BACKEND_DIR 以下に保存する(検索は LocalVectorIndex、Cosmos DB は SQLite、Blob はファイル)
+# サービスごとに遅延・スループットの上限・429 の発生率を環境変数で指定できる
+#   LOCAL_<サービス>_LATENCY_MS  1リクエストあたりの遅延(ミリ秒、±20% のゆらぎを加える)
+#   LOCAL_<サービス>_MAX_RPS     1秒あたりのリクエスト数の上限。超えた場合は Retry-After 付きの 429 を返す(0 は無制限)
+#   LOCAL_<サービス>_429_RATE    ランダムに 429 を返す割合(0〜1)
+# サービスは EMBED, CHAT, SEARCH, COSMOS, BLOB, DOCINTEL
+# api.py 用の非同期クライアント(LocalAsync*)は、同じ遅延をスレッドを止めずに asyncio.sleep で再現する
+
+LOCAL_BACKEND_DIR = os.getenv("LOCAL_BACKEND_DIR", os.path.join(".ragcache", "localbackend"))
+# 埋め込みの次元数(index.json の contentVector と同じ)
+LOCAL_EMBED_DIMENSIONS = int(os.getenv("LOCAL_EMBED_DIMENSIONS", "3072"))
+# チャットの出力速度(トークン/秒)と、Document Intelligence の1ページあたりの処理時間・Blob の転送速度
+LOCAL_CHAT_TOKENS_PER_SECOND = float(os.getenv("LOCAL_CHAT_TOKENS_PER_SECOND", "80"))
+LOCAL_DOCINTEL_MS_PER_PAGE = float(os.getenv("LOCAL_DOCINTEL_MS_PER_PAGE", "100"))
+LOCAL_BLOB_MB_PER_SECOND = float(os.getenv("LOCAL_BLOB_MB_PER_SECOND", "0"))
+
+# サービスごとの遅延の既定値(ミリ秒)。チャットは最初のトークンまでの時間
+DEFAULT_LATENCY_MS = {"embed": 50, "chat": 400, "search": 80, "cosmos": 10, "blob": 30, "docintel": 1000}
+
+PAGE_BREAK = "\n<!-- PageBreak -->\n"
+
+
+# スタンドインが返す 429。openai / Azure SDK の例外と同じく status_code と Retry-After ヘッダを持つ
+class LocalRateLimitError(Exception):
+    def __init__(self, service, retry_after):
+        super().__init__(f"429 Too Many Requests ({service}), retry after {retry_after:.2f}s")
+        self.status_code = 429
+        self.response = SimpleNamespace(status_code=429, headers={"retry-after-ms": str(int(retry_after * 1000))})
+
+
+# サービスの遅延・スループットの上限・429 を再現する
+class SimulatedService:
+    def __init__(self, name):
+        prefix = f"LOCAL_{name.upper()}_"
+        self.name = name
+        self.latency = float(os.getenv(prefix + "LATENCY_MS", str(DEFAULT_LATENCY_MS[name]))) / 1000
+        self.max_rps = float(os.getenv(prefix + "MAX_RPS", "0"))
+        self.error_rate = float(os.getenv(prefix + "429_RATE", "0"))
+        self.lock = threading.Lock()
+        self.recent = deque()
+        self.requests = 0
+        self.throttled = 0
+
+    # リクエストを受け付ける。上限を超えた場合・429 を発生させる場合は LocalRateLimitError を送出し、それ以外は遅延させる
+    # extra_seconds には処理量に応じた時間(出力トークン数・ページ数など)を指定する
+    def call(self, extra_seconds=0.0):
+        self.sleep(self.admit(extra_seconds))
+
+    # call() の非同期版
+    async def acall(self, extra_seconds=0.0):
+        await asyncio.sleep(jitter(self.admit(extra_seconds)))
+
+    # リクエストを受け付け、遅延させる秒数を返す。受け付けない場合は LocalRateLimitError を送出する
+    def admit(self, extra_seconds=0.0):
+        now = time.monotonic()
+        with self.lock:
+            self.requests += 1
+            while self.recent and now - self.recent[0] >= 1.0:
+                self.recent.popleft()
+            retry_after = None
+            if self.max_rps > 0 and len(self.recent) >= self.max_rps:
+                retry_after = 1.0 - (now - self.recent[0])
+            elif self.error_rate > 0 and random.random() < self.error_rate:
+                retry_after = random.uniform(0.1, 1.0)
+            if retry_after is not None:
+                self.throttled += 1
+            else:
+                self.recent.append(now)
+        if retry_after is not None:
+            raise LocalRateLimitError(self.name, retry_after)
+        return self.latency + extra_seconds
+
+    # ±20% のゆらぎを加えて待つ
+    @staticmethod
+    def sleep(seconds):
+        if seconds > 0:
+            time.sleep(jitter(seconds))
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "throttled": self.throttled}
+
+
+# 遅延に ±20% のゆらぎを加える
+def jitter(seconds):
+    return seconds * random.uniform(0.8, 1.2) if seconds > 0 else 0.0
+
+
+# テキストの埋め込み。トークンのハッシュで次元と符号を決めて足し合わせる(feature hashing)
+# 同じ語を含むテキストほどコサイン類似度が高くなるため、検索結果が内容に沿ったものになる
+def embed_text(text, dimensions=LOCAL_EMBED_DIMENSIONS):
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for token, tf in Counter(tokenize(text)).items():
+        digest = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+        vector[digest % dimensions] += (1.0 if digest >> 63 else -1.0) * (1 + np.log(tf))
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        vector[0] = 1.0
+        norm = 1.0
+    return (vector / norm).tolist()
+
+
+# Azure OpenAI のスタンドイン(embeddings.create / chat.completions.create)
+class LocalOpenAI:
+    def __init__(self):
+        self.embed_service = SimulatedService("embed")
+        self.chat_service = SimulatedService("chat")
+        self.embeddings = SimpleNamespace(create=self.__create_embeddings)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.__create_completion))
+
+    # 自動リトライなどのオプションは使わないため、そのまま返す
+    def with_options(self, **kwargs):
+        return self
+
+    def __create_embeddings(self, model, input, **kwargs):
+        self.embed_service.call()
+        return self.embedding_response(input)
+
+    def __create_completion(self, model, messages, temperature=None, max_tokens=1000, stream=False, response_format=None, **kwargs):
+        tokens, usage = self.completion_tokens(messages, max_tokens, response_format)
+        if stream:
+            self.chat_service.call()
+            return self.__stream(tokens)
+        self.chat_service.call(len(tokens) / LOCAL_CHAT_TOKENS_PER_SECOND)
+        message = SimpleNamespace(role="assistant", content=get_tiktoken_encoding().decode(tokens))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="stop")], usage=usage)
+
+    # 出力速度に合わせてトークンを1つずつ返す
+    def __stream(self, tokens):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        for i, token in enumerate(tokens):
+            if i > 0:
+                SimulatedService.sleep(1 / LOCAL_CHAT_TOKENS_PER_SECOND)
+            yield stream_chunk(decoder, token, i == len(tokens) - 1)
+
+    # embeddings.create の応答を作成する
+    @staticmethod
+    def embedding_response(input):
+        inputs = [input] if isinstance(input, str) else list(input)
+        tokens = sum(len(get_tiktoken_encoding().encode(text)) for text in inputs)
+        return SimpleNamespace(
+            data=[SimpleNamespace(index=i, embedding=embed_text(text)) for i, text in enumerate(inputs)],
+            usage=SimpleNamespace(prompt_tokens=tokens, total_tokens=tokens),
+        )
+
+    # chat.completions.create の回答のトークンと使用量を作成する
+    def completion_tokens(self, messages, max_tokens, response_format=None):
+        prompt = "".join(message["content"] for message in messages)
+        if response_format is not None and response_format.get("type") == "json_object":
+            answer = json.dumps(self.__extract_info(messages[-1]["content"]), ensure_ascii=False)
+        else:
+            answer = self.__answer(messages)
+        tokens = get_tiktoken_encoding().encode(answer)[:max_tokens]
+        usage = SimpleNamespace(
+            prompt_tokens=len(get_tiktoken_encoding().encode(prompt)),
+            completion_tokens=len(tokens),
+            total_tokens=0,
+        )
+        usage.total_tokens = usage.prompt_tokens + usage.completion_tokens
+        return tokens, usage
+
+    # get_info の出力形式(title, summary, Keywords)を、コンテキストの先頭と頻出語から作成する
+    @staticmethod
+    def __extract_info(request):
+        context = request.split("###コンテキスト", 1)[-1].strip()
+        keywords = [token for token, _ in Counter(tokenize(context)).most_common(10)]
+        return {"title": context[:40], "summary": context[:300], "Keywords": keywords}
+
+    # プロンプトの最初の情報源を引用した回答を作成する
+    @staticmethod
+    def __answer(messages):
+        system = messages[0]["content"]
+        match = re.search(r"## filename: (.+?)\n\n.*?### content: \n\n (.*?)(?:\n\n## filename: |\n\n# )", system, re.S)
+        if match is None:
+            return "情報源に十分な情報がないため、わかりません。"
+        return f"[{match.group(1)}] によると、" + re.sub(r"\s+", " ", match.group(2))[:200]
+
+
+# ストリーミングの1チャンクを作成する。マルチバイト文字の途中で切れたトークンは次のトークンとまとめて返す
+def stream_chunk(decoder, token, final):
+    content = decoder.decode(get_tiktoken_encoding().decode_single_token_bytes(token), final=final)
+    delta = SimpleNamespace(role="assistant", content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=None)])
+
+
+# AsyncAzureOpenAI のスタンドイン。応答は LocalOpenAI と同じで、待ち時間は asyncio.sleep で再現する
+class LocalAsyncOpenAI:
+    def __init__(self):
+        self.local = LocalOpenAI()
+        self.embeddings = SimpleNamespace(create=self.__create_embeddings)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.__create_completion))
+
+    async def __create_embeddings(self, model, input, **kwargs):
+        await self.local.embed_service.acall()
+        return self.local.embedding_response(input)
+
+    async def __create_completion(self, model, messages, temperature=None, max_tokens=1000, stream=False, response_format=None, **kwargs):
+        tokens, usage = self.local.completion_tokens(messages, max_tokens, response_format)
+        if stream:
+            await self.local.chat_service.acall()
+            return self.__stream(tokens)
+        await self.local.chat_service.acall(len(tokens) / LOCAL_CHAT_TOKENS_PER_SECOND)
+        message = SimpleNamespace(role="assistant", content=get_tiktoken_encoding().decode(tokens))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="stop")], usage=usage)
+
+    async def __stream(self, tokens):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        for i, token in enumerate(tokens):
+            if i > 0:
+                await asyncio.sleep(jitter(1 / LOCAL_CHAT_TOKENS_PER_SECOND))
+            yield stream_chunk(decoder, token, i == len(tokens) - 1)
+
+    async def close(self):
+        pass
+
+
+# 非同期のイテレータにする(非同期クライアントの検索結果用)
+async def async_iter(items):
+    for item in items:
+        yield item
+
+
+# ローカルインデックスの保存先
+def search_dir():
+    return os.path.join(LOCAL_BACKEND_DIR, "search")
+
+
+__search_lock = threading.Lock()
+__search_indexes = {}
+
+
+# インデックス名ごとに LocalVectorIndex を1つだけ生成して使い回す
+def get_search_index(index_name):
+    with __search_lock:
+        if index_name not in __search_indexes:
+            __search_indexes[index_name] = LocalVectorIndex(index_name, base_dir=search_dir())
+        return __search_indexes[index_name]
+
+
+def drop_search_index(index_name):
+    with __search_lock:
+        index = __search_indexes.pop(index_name, None)
+    if index is not None:
+        index.conn.close()
+
+
+# Azure AI Search のインデックス管理のスタンドイン。インデックスの定義は index.json として保存する
+class LocalSearchIndexClient:
+    def get_index(self, name):
+        path = os.path.join(search_dir(), name, "index.json")
+        if not os.path.exists(path):
+            raise ResourceNotFoundError(f"index not found: {name}")
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    # index.json と同じ形式の定義(dict)でインデックスを作成する
+    def create_index(self, definition):
+        path = os.path.join(search_dir(), definition["name"])
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "index.json"), "w", encoding="utf-8") as f:
+            json.dump(definition, f, ensure_ascii=False)
+        return definition
+
+    def delete_index(self, name):
+        drop_search_index(name)
+        shutil.rmtree(os.path.join(search_dir(), name), ignore_errors=True)
+
+
+# Azure AI Search の検索・登録のスタンドイン。ベクトル検索とハイブリッド検索(BM25 + RRF)を LocalVectorIndex で行う
+# セマンティック検索(query_type='semantic')はハイブリッド検索として扱う
+class LocalSearchClient:
+    def __init__(self, index_name):
+        self.index_name = index_name
+        self.service = SimulatedService("search")
+
+    def upload_documents(self, documents):
+        self.service.call()
+        get_search_index(self.index_name).add_documents(documents)
+        return [SimpleNamespace(key=doc["id"], succeeded=True, status_code=201) for doc in documents]
+
+    def delete_documents(self, documents):
+        self.service.call()
+        get_search_index(self.index_name).delete_documents([doc["id"] for doc in documents])
+        return [SimpleNamespace(key=doc["id"], succeeded=True, status_code=200) for doc in documents]
+
+    def get_document_count(self):
+        self.service.call()
+        return get_search_index(self.index_name).count()
+
+    def search(self, search_text=None, vector_queries=None, top=50, **kwargs):
+        self.service.call()
+        return self.query(search_text, vector_queries, top, **kwargs)
+
+    # 遅延なしで検索する
+    def query(self, search_text=None, vector_queries=None, top=50, **kwargs):
+        index = get_search_index(self.index_name)
+        vector = vector_queries[0].vector if vector_queries else embed_text(search_text or "")
+        # ベクトルは select で指定した場合だけ返す
+        with_vectors = "contentVector" in (kwargs.get("select") or [])
+        if search_text:
+            return index.hybrid_search(search_text, vector, top, with_vectors=with_vectors)
+        return index.search(vector, top, with_vectors=with_vectors)
+
+
+# Cosmos DB のコンテナのスタンドイン。アイテムは JSON のまま SQLite に保存する
+class LocalCosmosContainer:
+    def __init__(self, container_name):
+        self.container_name = container_name
+        self.service = SimulatedService("cosmos")
+        os.makedirs(os.path.join(LOCAL_BACKEND_DIR, "cosmos"), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(LOCAL_BACKEND_DIR, "cosmos", container_name + ".sqlite"), check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS items (id TEXT PRIMARY KEY, body TEXT NOT NULL)")
+        self.bytes_written = 0
+
+    def read(self):
+        self.service.call()
+        return {"id": self.container_name}
+
+    def upsert_item(self, item):
+        self.service.call()
+        return self.write(item)
+
+    # 遅延なしで書き込む
+    def write(self, item):
+        body = json.dumps(item, ensure_ascii=False)
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO items VALUES (?, ?)", (item["id"], body))
+            self.bytes_written += len(body.encode("utf-8"))
+        return item
+
+    def read_item(self, item, partition_key):
+        self.service.call()
+        with self.lock:
+            row = self.conn.execute("SELECT body FROM items WHERE id = ?", (item,)).fetchone()
+        if row is None:
+            raise ResourceNotFoundError(f"item not found: {item}")
+        return json.loads(row[0])
+
+    def delete_item(self, item, partition_key):
+        self.service.call()
+        with self.lock, self.conn:
+            if self.conn.execute("DELETE FROM items WHERE id = ?", (item,)).rowcount == 0:
+                raise ResourceNotFoundError(f"item not found: {item}")
+
+    # "SELECT c.a, c.b FROM c" 形式の射影と、"WHERE c.a = @p AND ..." 形式の等値の条件のみ対応する
+    def query_items(self, query, parameters=None, enable_cross_partition_query=None, **kwargs):
+        self.service.call()
+        match = re.match(r"\s*SELECT\s+(.+?)\s+FROM\s+c\b(?:\s+WHERE\s+(.+))?", query, re.I | re.S)
+        fields = None
+        if match and match.group(1).strip() not in ("*", "c"):
+            fields = [field.strip().split(".", 1)[-1] for field in match.group(1).split(",")]
+        values = {parameter["name"]: parameter["value"] for parameter in parameters or []}
+        conditions = re.findall(r"c\.(\w+)\s*=\s*(@\w+)", match.group(2) or "") if match else []
+        with self.lock:
+            rows = self.conn.execute("SELECT body FROM items").fetchall()
+        for row in rows:
+            item = json.loads(row[0])
+            if any(item.get(field) != values.get(name) for field, name in conditions):
+                continue
+            yield item if fields is None else {field: item.get(field) for field in fields}
+
+
+# 非同期の SearchClient(azure.search.documents.aio)のスタンドイン
+class LocalAsyncSearchClient:
+    def __init__(self, index_name):
+        self.local = LocalSearchClient(index_name)
+
+    async def search(self, search_text=None, vector_queries=None, top=50, **kwargs):
+        await self.local.service.acall()
+        return async_iter(self.local.query(search_text, vector_queries, top, **kwargs))
+
+    async def close(self):
+        pass
+
+
+# 非同期の Cosmos DB のコンテナ(azure.cosmos.aio)のスタンドイン
+class LocalAsyncCosmosContainer:
+    def __init__(self, container_name):
+        self.local = LocalCosmosContainer(container_name)
+
+    async def upsert_item(self, item):
+        await self.local.service.acall()
+        return self.local.write(item)
+
+
+# Blob Storage のコンテナのスタンドイン。Blob はファイルとして保存する
+class LocalBlobContainerClient:
+    def __init__(self, container_name):
+        self.dir = os.path.join(LOCAL_BACKEND_DIR, "blob", container_name or "default")
+        self.service = SimulatedService("blob")
+
+    def get_container_properties(self):
+        if not os.path.isdir(self.dir):
+            raise ResourceNotFoundError(f"container not found: {self.dir}")
+        return {"name": os.path.basename(self.dir)}
+
+    def create_container(self):
+        os.makedirs(self.dir, exist_ok=True)
+
+    def list_blobs(self):
+        if not os.path.isdir(self.dir):
+            return []
+        return [SimpleNamespace(name=name) for name in sorted(os.listdir(self.dir))]
+
+    def get_blob_client(self, name):
+        return LocalBlobClient(self, name)
+
+
+class LocalBlobClient:
+    def __init__(self, container, name):
+        self.container = container
+        self.path = os.path.join(container.dir, name)
+
+    def upload_blob(self, data, overwrite=False, **kwargs):
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = data.read()
+        self.container.service.call(self.__transfer_seconds(len(data)))
+        if not overwrite and os.path.exists(self.path):
+            raise FileExistsError(f"blob already exists: {self.path}")
+        os.makedirs(self.container.dir, exist_ok=True)
+        with open(self.path, "wb") as f:
+            f.write(data)
+
+    def download_blob(self, **kwargs):
+        if not os.path.exists(self.path):
+            raise ResourceNotFoundError(f"blob not found: {self.path}")
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.container.service.call(self.__transfer_seconds(len(data)))
+        return SimpleNamespace(readall=lambda: data)
+
+    @staticmethod
+    def __transfer_seconds(size):
+        return size / (LOCAL_BLOB_MB_PER_SECOND * 1024 * 1024) if LOCAL_BLOB_MB_PER_SECOND > 0 else 0.0
+
+
+# Document Intelligence のスタンドイン。PDF のテキストを pypdf で抽出し、ページ区切りを入れた Markdown として返す
+class LocalDocumentIntelligenceClient:
+    def __init__(self):
+        self.service = SimulatedService("docintel")
+
+    def begin_analyze_document(self, model_id, analyze_request, **kwargs):
+        data = analyze_request.read() if hasattr(analyze_request, "read") else bytes(analyze_request)
+        if data[:5] == b"%PDF-":
+            pages = [page.extract_text() or "" for page in PdfReader(io.BytesIO(data)).pages]
+        else:
+            pages = [data.decode("utf-8", errors="replace")]
+        self.service.call(len(pages) * LOCAL_DOCINTEL_MS_PER_PAGE / 1000)
+        result = {"content": PAGE_BREAK.join(pages)}
+        return SimpleNamespace(result=lambda: SimpleNamespace(as_dict=lambda: result))
@@ -0,0 +1,223 @@
+import os
+import zlib
+import sqlite3
+import unicodedata
+import threading
+from collections import Counter, defaultdict
+import regex
+import numpy as np
+
+# ローカルの BM25 インデックス(キーワード検索)
+# Azure AI Search のインデックス(index.json)で ja.lucene を指定している content, title, summary, keywords を対象にする
+# 日本語(漢字・ひらがな・カタカナ)は文字 bigram、英数字は単語単位でトークン化する
+# ポスティングリストは文書番号の差分(uint32)と出現回数(uint16)を zlib で圧縮して SQLite に保存する
+# 削除と置き換えは削除済みの文書番号を記録するだけで行い、削除済みの割合が COMPACT_DELETED_RATE を超えたらポスティングリストを作り直す
+
+# BM25 のパラメータ
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# フィールドごとの重み(出現回数に掛ける)
+FIELD_WEIGHTS = {"content": 1, "title": 2, "summary": 1, "keywords": 2}
+COMPACT_DELETED_RATE = 0.2
+
+# 日本語の文字の連続と、英数字(ラテン文字・数字)の連続
+__token_pattern = regex.compile(r"[\p{Han}\p{Hiragana}\p{Katakana}ー]+|[\p{Latin}\p{N}]+")
+__japanese_pattern = regex.compile(r"[\p{Han}\p{Hiragana}\p{Katakana}ー]")
+
+
+# テキストをトークンのリストにする
+def tokenize(text):
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for match in __token_pattern.finditer(text):
+        word = match.group()
+        if __japanese_pattern.match(word):
+            if len(word) == 1:
+                tokens.append(word)
+            else:
+                tokens += [word[i:i + 2] for i in range(len(word) - 1)]
+        else:
+            tokens.append(word)
+    return tokens
+
+
+# ポスティングリストを圧縮する。doc_nos は昇順
+def encode_postings(doc_nos, tfs):
+    deltas = np.diff(np.asarray(doc_nos, dtype=np.int64), prepend=0).astype(np.uint32)
+    return zlib.compress(deltas.tobytes() + np.asarray(tfs, dtype=np.uint16).tobytes())
+
+
+# 圧縮したポスティングリストを (doc_nos, tfs) に戻す
+def decode_postings(data, count):
+    raw = zlib.decompress(data)
+    doc_nos = np.cumsum(np.frombuffer(raw, dtype=np.uint32, count=count), dtype=np.int64)
+    tfs = np.frombuffer(raw, dtype=np.uint16, offset=count * 4, count=count)
+    return doc_nos, tfs
+
+
+class LocalBM25Index:
+    def __init__(self, path):
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS bm25_docs (
+                doc_no INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT NOT NULL UNIQUE,
+                length INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS bm25_deleted (
+                doc_no INTEGER PRIMARY KEY,
+                length INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS bm25_postings (
+                term TEXT PRIMARY KEY,
+                count INTEGER NOT NULL,
+                data BLOB NOT NULL
+            );
+        """)
+        self.cache_key = None
+        self.lengths = None
+
+    # ドキュメントを追加する。同じ id のドキュメントがある場合は置き換える
+    def add_documents(self, docs):
+        postings = defaultdict(lambda: ([], []))
+        with self.lock, self.conn:
+            self.__delete(doc["id"] for doc in docs)
+            for doc in docs:
+                counts = Counter()
+                for field, weight in FIELD_WEIGHTS.items():
+                    value = doc.get(field) or ""
+                    if isinstance(value, list):
+                        value = " ".join(value)
+                    for token in tokenize(str(value)):
+                        counts[token] += weight
+                doc_no = self.conn.execute(
+                    "INSERT INTO bm25_docs (id, length) VALUES (?, ?)", (doc["id"], sum(counts.values()))
+                ).lastrowid
+                for term, tf in counts.items():
+                    postings[term][0].append(doc_no)
+                    postings[term][1].append(min(tf, 65535))
+            # 文書番号は増える一方なので、既存のポスティングリストの末尾に追加すれば昇順が保たれる
+            for term, (doc_nos, tfs) in postings.items():
+                row = self.conn.execute("SELECT count, data FROM bm25_postings WHERE term = ?", (term,)).fetchone()
+                if row is not None:
+                    old_doc_nos, old_tfs = decode_postings(row[1], row[0])
+                    doc_nos = np.concatenate([old_doc_nos, doc_nos])
+                    tfs = np.concatenate([old_tfs, tfs])
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO bm25_postings VALUES (?, ?, ?)",
+                    (term, len(doc_nos), sqlite3.Binary(encode_postings(doc_nos, tfs))),
+                )
+        self.__compact_if_needed()
+
+    # ドキュメントを削除する
+    def delete_documents(self, doc_ids):
+        with self.lock, self.conn:
+            self.__delete(doc_ids)
+        self.__compact_if_needed()
+
+    # ドキュメント数を返す
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM bm25_docs").fetchone()[0]
+
+    # クエリに対するスコアの上位 top_k 件を [(id, score), ...] で返す
+    def search(self, query, top_k):
+        terms = set(tokenize(query))
+        with self.lock:
+            lengths = self.__load()
+            live_count = int(np.count_nonzero(lengths >= 0))
+            if not terms or live_count == 0:
+                return []
+            avg_length = max(float(lengths[lengths >= 0].mean()), 1.0)
+            scores = np.zeros(len(lengths), dtype=np.float32)
+            rows = self.conn.execute(
+                f"SELECT count, data FROM bm25_postings WHERE term IN ({', '.join('?' * len(terms))})", list(terms)
+            ).fetchall()
+            for count, data in rows:
+                doc_nos, tfs = decode_postings(data, count)
+                live = lengths[doc_nos] >= 0
+                doc_nos, tfs = doc_nos[live], tfs[live].astype(np.float32)
+                if len(doc_nos) == 0:
+                    continue
+                idf = np.log(1 + (live_count - len(doc_nos) + 0.5) / (len(doc_nos) + 0.5))
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[doc_nos] / avg_length)
+                scores[doc_nos] += idf * tfs * (BM25_K1 + 1) / (tfs + norm)
+            candidates = np.flatnonzero(scores)
+            if len(candidates) == 0:
+                return []
+            top = candidates[np.argsort(-scores[candidates])[:top_k]]
+            ids = dict(self.conn.execute(
+                f"SELECT doc_no, id FROM bm25_docs WHERE doc_no IN ({', '.join('?' * len(top))})", [int(n) for n in top]
+            ).fetchall())
+        return [(ids[int(doc_no)], float(scores[doc_no])) for doc_no in top]
+
+    # 文書番号ごとの長さを読み込む(削除済みは -1)。追加・削除があった場合のみ読み直す
+    def __load(self):
+        key = self.conn.execute(
+            "SELECT (SELECT COALESCE(MAX(doc_no), 0) FROM bm25_docs), (SELECT COUNT(*) FROM bm25_docs), "
+            "(SELECT COUNT(*) FROM bm25_deleted)"
+        ).fetchone()
+        if key != self.cache_key:
+            max_doc_no = max(key[0], self.conn.execute("SELECT COALESCE(MAX(doc_no), 0) FROM bm25_deleted").fetchone()[0])
+            lengths = np.full(max_doc_no + 1, -1, dtype=np.float32)
+            for doc_no, length in self.conn.execute("SELECT doc_no, length FROM bm25_docs"):
+                lengths[doc_no] = length
+            self.lengths = lengths
+            self.cache_key = key
+        return self.lengths
+
+    def __delete(self, doc_ids):
+        for doc_id in doc_ids:
+            row = self.conn.execute("SELECT doc_no, length FROM bm25_docs WHERE id = ?", (doc_id,)).fetchone()
+            if row is None:
+                continue
+            self.conn.execute("DELETE FROM bm25_docs WHERE doc_no = ?", (row[0],))
+            self.conn.execute("INSERT OR REPLACE INTO bm25_deleted VALUES (?, ?)", row)
+
+    # 削除済みの割合が大きくなったら、ポスティングリストから削除済みの文書を取り除く
+    # 文書番号も 1 から振り直し、置き換えを繰り返しても文書番号(__load の lengths の長さ)が増え続けないようにする
+    def __compact_if_needed(self):
+        with self.lock:
+            live_count = self.count()
+            deleted_count = self.conn.execute("SELECT COUNT(*) FROM bm25_deleted").fetchone()[0]
+            if deleted_count == 0 or deleted_count < (live_count + deleted_count) * COMPACT_DELETED_RATE:
+                return
+            live = np.array([row[0] for row in self.conn.execute("SELECT doc_no FROM bm25_docs ORDER BY doc_no")], dtype=np.int64)
+            max_doc_no = max(int(live[-1]) if len(live) else 0,
+                             self.conn.execute("SELECT MAX(doc_no) FROM bm25_deleted").fetchone()[0])
+            # 古い文書番号から新しい文書番号への対応(削除済みは -1)。昇順を保つので振り直してもポスティングリストは昇順のまま
+            new_doc_nos = np.full(max_doc_no + 1, -1, dtype=np.int64)
+            new_doc_nos[live] = np.arange(1, len(live) + 1)
+            with self.conn:
+                for term, count, data in self.conn.execute("SELECT term, count, data FROM bm25_postings").fetchall():
+                    doc_nos, tfs = decode_postings(data, count)
+                    doc_nos = new_doc_nos[doc_nos]
+                    keep = doc_nos >= 0
+                    if not keep.any():
+                        self.conn.execute("DELETE FROM bm25_postings WHERE term = ?", (term,))
+                        continue
+                    self.conn.execute(
+                        "UPDATE bm25_postings SET count = ?, data = ? WHERE term = ?",
+                        (int(keep.sum()), sqlite3.Binary(encode_postings(doc_nos[keep], tfs[keep])), term),
+                    )
+                # 小さい番号から順に振り直すため、振り直し先の番号が他の文書と重なることはない
+                self.conn.executemany(
+                    "UPDATE bm25_docs SET doc_no = ? WHERE doc_no = ?",
+                    [(int(new_doc_nos[doc_no]), int(doc_no)) for doc_no in live],
+                )
+                self.conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'bm25_docs'", (len(live),))
+                self.conn.execute("DELETE FROM bm25_deleted")
+            # 件数が作り直す前と同じになる場合があるため、文書番号ごとの長さは必ず読み直す
+            self.cache_key = None
+            print(f"bm25 postings compacted: removed {deleted_count} deleted docs")
+
+
+# 複数の検索結果のランキングを Reciprocal Rank Fusion で統合する
+# rankings は [[id, ...], ...](それぞれスコアの高い順)。戻り値は [(id, score), ...] をスコアの高い順に並べたもの
+def reciprocal_rank_fusion(rankings, k=60):
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] += 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,298 @@
+import os
+import json
+import sqlite3
+import argparse
+import threading
+import numpy as np
+from kvcache import pack_vector, unpack_vector
+from vectorcodec import decode_item
+from localbm25 import LocalBM25Index, reciprocal_rank_fusion
+
+# プロセス内で検索するローカルのベクトルインデックス
+# ベクトルは正規化して float16 または int8 に量子化した行列としてファイルに保存し、検索時はメモリマップで読み込む
+# ドキュメントの内容と元の float32 のベクトルは別の SQLite のテーブル(メタデータ)に保持し、上位候補の再スコアリングに使う
+#   python -m localindex build --index <インデックス名>   (KB の Cosmos DB コンテナから作成)
+#   python -m localindex inspect --index <インデックス名>
+
+# 検索のバックエンド。azure: Azure AI Search、local: Vector_only と Hybrid をローカルのインデックスで検索する
+VECTOR_SEARCH_BACKEND = os.getenv("VECTOR_SEARCH_BACKEND", "azure")
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", os.path.join(".ragcache", "localindex"))
+# 量子化の形式(float16 | int8)
+LOCAL_INDEX_DTYPE = os.getenv("LOCAL_INDEX_DTYPE", "float16")
+# 再スコアリングする候補数(top_k の何倍か)。1 以上で、1 の場合は候補を広げずに上位 top_k 件のスコアだけを計算し直す
+LOCAL_INDEX_RESCORE_FACTOR = max(1, int(os.getenv("LOCAL_INDEX_RESCORE_FACTOR", "4")))
+# ハイブリッド検索で、ベクトル検索とキーワード検索からそれぞれ何件の候補を取得して統合するか
+LOCAL_HYBRID_CANDIDATES = int(os.getenv("LOCAL_HYBRID_CANDIDATES", "50"))
+
+# 検索結果として返すフィールド(Azure AI Search の検索結果と同じ名前にする)
+DOC_FIELDS = ["id", "fileName", "chunkNo", "content", "title", "summary", "keywords"]
+
+__lock = threading.Lock()
+__indexes = {}
+
+
+# ローカルのベクトルインデックス
+# add_documents / delete_documents はメタデータとキーワード検索用の BM25 インデックスを更新し、build() で量子化した行列を作り直す
+class LocalVectorIndex:
+    def __init__(self, index_name, base_dir=LOCAL_INDEX_DIR, dtype=LOCAL_INDEX_DTYPE):
+        if dtype not in ("float16", "int8"):
+            raise ValueError(f"unsupported dtype: {dtype}")
+        self.index_name = index_name
+        self.dir = os.path.join(base_dir, index_name)
+        self.dtype = dtype
+        os.makedirs(self.dir, exist_ok=True)
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(os.path.join(self.dir, "meta.sqlite"), check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS docs (
+                id TEXT PRIMARY KEY,
+                fileName TEXT NOT NULL,
+                chunkNo INTEGER NOT NULL,
+                content TEXT NOT NULL,
+                title TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                keywords TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                row_no INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS docs_row_no ON docs (row_no);
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        """)
+        self.matrix = None
+        self.scales = None
+        self.loaded_version = None
+        self.bm25 = LocalBM25Index(os.path.join(self.dir, "meta.sqlite"))
+        # BM25 インデックスがない状態で作成済みのインデックスは、メタデータから BM25 インデックスを作成する
+        if self.bm25.count() == 0 and self.count() > 0:
+            self.__build_bm25()
+
+    # ドキュメントを追加・更新する。docs は preparedata の generate_index_docs が作成する形式
+    def add_documents(self, docs):
+        rows = [(
+            doc["id"], doc["fileName"], doc["chunkNo"], doc["content"], doc["title"], doc["summary"],
+            json.dumps(doc["keywords"], ensure_ascii=False), sqlite3.Binary(pack_vector(doc["contentVector"])),
+        ) for doc in docs]
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL)", rows)
+            self.__set_state("dirty", 1)
+        self.bm25.add_documents(docs)
+
+    # ドキュメントを削除する
+    def delete_documents(self, doc_ids):
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM docs WHERE id = ?", [(doc_id,) for doc_id in doc_ids])
+            self.__set_state("dirty", 1)
+        self.bm25.delete_documents(doc_ids)
+
+    # ドキュメント数を返す
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    # メタデータから量子化した行列を作り直す
+    def build(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT id, vector FROM docs ORDER BY id").fetchall()
+            vectors = np.array([unpack_vector(row[1]) for row in rows], dtype=np.float32)
+            if len(rows) == 0:
+                vectors = vectors.reshape(0, 0)
+            matrix, scales = quantize(normalize(vectors), self.dtype)
+            version = self.__get_state("version") + 1
+            # 検索中の他プロセスが読み込んでいるファイルを上書きしないよう、バージョンごとに別のファイルに保存する
+            np.save(self.__matrix_path(version), matrix)
+            if scales is not None:
+                np.save(self.__scales_path(version), scales)
+            with self.conn:
+                self.conn.executemany("UPDATE docs SET row_no = ? WHERE id = ?", [(row_no, row[0]) for row_no, row in enumerate(rows)])
+                self.__set_state("version", version)
+                self.__set_state("dirty", 0)
+            self.__remove_old_files(version)
+            print(f"local index built: {self.index_name} {len(rows)} docs ({self.dtype})")
+
+    # クエリのベクトルに近いドキュメントを top_k 件返す。スコアはコサイン類似度
+    # 量子化した行列で選んだ top_k * rescore_factor 件(rescore_factor は 1 以上にする)の候補を float32 のベクトルで再スコアリングする
+    # with_vectors=True の場合は、ドキュメントに float32 のベクトル(contentVector)を含める
+    def search(self, vector, top_k, rescore_factor=LOCAL_INDEX_RESCORE_FACTOR, with_vectors=False):
+        matrix, scales = self.__load()
+        if matrix.shape[0] == 0:
+            return []
+        query = normalize(np.asarray(vector, dtype=np.float32))
+        scores = score_matrix(matrix, scales, query)
+        row_nos = top_k_indices(scores, top_k * max(1, rescore_factor))
+        docs = self.__get_docs("row_no", [int(row_no) for row_no in row_nos], with_vector=True)
+        if docs:
+            # スコアは取得したドキュメント自身のベクトルから計算する(取得できなかった行があってもずれない)
+            vectors = normalize(np.array([doc["contentVector"] for doc in docs], dtype=np.float32))
+            for doc, score in zip(docs, vectors @ query):
+                doc["@search.score"] = float(score)
+        docs.sort(key=lambda doc: doc["@search.score"], reverse=True)
+        if not with_vectors:
+            for doc in docs:
+                doc.pop("contentVector", None)
+        return docs[:top_k]
+
+    # 量子化した行列を読み込み、行数を返す(最初の検索を待たせないためのウォームアップ用)
+    def load(self):
+        matrix, _ = self.__load()
+        return matrix.shape[0]
+
+    # キーワード検索(BM25)とベクトル検索の結果を Reciprocal Rank Fusion で統合し、上位 top_k 件を返す
+    # スコアは Azure AI Search のハイブリッド検索と同様に RRF のスコアになる
+    def hybrid_search(self, query, vector, top_k, candidates=LOCAL_HYBRID_CANDIDATES, with_vectors=False):
+        candidates = max(candidates, top_k)
+        vector_ids = [doc["id"] for doc in self.search(vector, candidates)]
+        keyword_ids = [doc_id for doc_id, _ in self.bm25.search(query, candidates)]
+        fused = reciprocal_rank_fusion([vector_ids, keyword_ids])[:top_k]
+        scores = dict(fused)
+        docs = self.__get_docs("id", list(scores), with_vector=with_vectors)
+        for doc in docs:
+            doc["@search.score"] = scores[doc["id"]]
+        return docs
+
+    # メタデータのドキュメントから BM25 インデックスを作成する
+    def __build_bm25(self):
+        with self.lock:
+            ids = [row[0] for row in self.conn.execute("SELECT id FROM docs ORDER BY id").fetchall()]
+        for start in range(0, len(ids), 500):
+            self.bm25.add_documents(self.__get_docs("id", ids[start:start + 500]))
+        print(f"bm25 index built: {self.index_name} {len(ids)} docs")
+
+    # 量子化した行列をメモリマップで読み込む。未反映の更新があれば先に作り直す
+    def __load(self):
+        with self.lock:
+            # 量子化の形式を変更した場合など、現在のバージョンのファイルがない場合も作り直す
+            if self.__get_state("dirty") or not os.path.exists(self.__matrix_path(self.__get_state("version"))):
+                self.build()
+            version = self.__get_state("version")
+            if version != self.loaded_version:
+                self.matrix = np.load(self.__matrix_path(version), mmap_mode="r")
+                self.scales = np.load(self.__scales_path(version)) if self.dtype == "int8" else None
+                self.loaded_version = version
+            return self.matrix, self.scales
+
+    # 行番号(row_no)または id を指定してドキュメントを指定した順に取得する。with_vector=True の場合はベクトル(contentVector)も取得する
+    def __get_docs(self, key, values, with_vector=False):
+        columns = DOC_FIELDS + (["row_no"] if key == "row_no" else []) + (["vector"] if with_vector else [])
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT {', '.join(columns)} FROM docs WHERE {key} IN ({', '.join('?' * len(values))})", values
+            ).fetchall()
+        docs = {}
+        for row in rows:
+            doc = dict(zip(columns, row))
+            doc["keywords"] = json.loads(doc["keywords"])
+            if with_vector:
+                doc["contentVector"] = unpack_vector(doc.pop("vector"))
+            docs[doc.pop("row_no") if key == "row_no" else doc["id"]] = doc
+        return [docs[value] for value in values if value in docs]
+
+    def __get_state(self, key):
+        row = self.conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def __set_state(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (key, value))
+
+    def __matrix_path(self, version):
+        return os.path.join(self.dir, f"vectors.{version}.{self.dtype}.npy")
+
+    def __scales_path(self, version):
+        return os.path.join(self.dir, f"scales.{version}.npy")
+
+    # 1つ前より古いバージョンのファイルを削除する
+    def __remove_old_files(self, version):
+        for name in os.listdir(self.dir):
+            parts = name.split(".")
+            if parts[0] in ("vectors", "scales") and parts[1].isdigit() and int(parts[1]) < version - 1:
+                os.remove(os.path.join(self.dir, name))
+
+
+# インデックス名ごとにローカルインデックスを1つだけ生成して使い回す
+def get_local_index(index_name):
+    with __lock:
+        if index_name not in __indexes:
+            __indexes[index_name] = LocalVectorIndex(index_name)
+        return __indexes[index_name]
+
+
+# ベクトル(または行列の各行)を長さ1に正規化する
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+# 正規化した行列を量子化する。int8 の場合は行ごとのスケールも返す
+def quantize(matrix, dtype):
+    if dtype == "float16":
+        return matrix.astype(np.float16), None
+    scales = np.maximum(np.abs(matrix).max(axis=1), 1e-12) / 127 if len(matrix) else np.zeros(0, dtype=np.float32)
+    quantized = np.round(matrix / scales[:, None]).astype(np.int8) if len(matrix) else matrix.astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+# 量子化した行列とクエリのベクトルの内積(コサイン類似度の近似値)を計算する
+# 行列全体を float32 に変換するとメモリを消費するため、SCORE_BLOCK_ROWS 行ずつ変換して計算する
+SCORE_BLOCK_ROWS = 8192
+def score_matrix(matrix, scales, query):
+    scores = np.empty(matrix.shape[0], dtype=np.float32)
+    for start in range(0, matrix.shape[0], SCORE_BLOCK_ROWS):
+        end = start + SCORE_BLOCK_ROWS
+        scores[start:end] = matrix[start:end].astype(np.float32) @ query
+    if scales is not None:
+        scores *= scales
+    return scores
+
+
+# スコアの上位 k 件の行番号をスコアの高い順に返す
+def top_k_indices(scores, k):
+    k = min(k, len(scores))
+    indices = np.argpartition(-scores, k - 1)[:k]
+    return indices[np.argsort(-scores[indices])]
+
+
+# KB の Cosmos DB コンテナのドキュメントのうち、インデックス名(indexName)が index_name のものからローカルインデックスを作成する
+# KB のコンテナは複数のインデックスで共有するため、インデックス名を記録する前に登録したドキュメントは含めない
+def build_from_cosmos(index_name, container):
+    index = get_local_index(index_name)
+    # ベクトルは base64 で保存されている場合があるため、形式のフィールドも取得して floatのリストに戻す
+    fields = ", ".join(f"c.{field}" for field in DOC_FIELDS + ["contentVector", "contentVectorFormat"])
+    batch = []
+    items = container.query_items(
+        f"SELECT {fields} FROM c WHERE c.indexName = @index",
+        parameters=[{"name": "@index", "value": index_name}],
+        enable_cross_partition_query=True,
+    )
+    for item in items:
+        batch.append(decode_item(item))
+        if len(batch) >= 500:
+            index.add_documents(batch)
+            batch = []
+    if batch:
+        index.add_documents(batch)
+    index.build()
+    return index.count()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or inspect the local vector index.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Build the local index from the KB Cosmos DB container.')
+    build_parser.add_argument('--index', type=str, required=True, help='Name of the local index.')
+    inspect_parser = subparsers.add_parser('inspect', help='Show the number of documents in the local index.')
+    inspect_parser.add_argument('--index', type=str, required=True, help='Name of the local index.')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        from clients import get_cosmos_container
+        count = build_from_cosmos(args.index, get_cosmos_container(os.getenv("COSMOS_CONTAINER_NAME_KB")))
+        print(f"built {args.index}: {count} docs")
+    else:
+        index = get_local_index(args.index)
+        print(f"{args.index}: {index.count()} docs ({index.dtype}) in {index.dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from datetime import datetime
+
+# マニフェストの保存先(SQLite)
+MANIFEST_PATH = os.getenv("MANIFEST_PATH", os.path.join(".ragcache", "manifest.sqlite"))
+
+
+# 差分インデックス作成用のマニフェスト
+# インデックス・ファイルごとにファイルのハッシュ、チャンク分割のパラメータ、取得元のパス、チャンクごとのハッシュとドキュメントIDを保持する
+# 取得元のパスはローカルのファイルの場合は絶対パス、Blob Storage の場合は blob://<コンテナ名>/<ファイル名>
+class Manifest:
+    def __init__(self, path=MANIFEST_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                index_name TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                file_hash TEXT NOT NULL,
+                params TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                source_path TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (index_name, file_name)
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                index_name TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                chunk_no INTEGER NOT NULL,
+                chunk_hash TEXT NOT NULL,
+                doc_id TEXT NOT NULL,
+                PRIMARY KEY (index_name, file_name, chunk_no)
+            );
+            CREATE TABLE IF NOT EXISTS progress (
+                index_name TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                file_hash TEXT NOT NULL,
+                params TEXT NOT NULL,
+                chunk_no INTEGER NOT NULL,
+                PRIMARY KEY (index_name, file_name, chunk_no)
+            );
+            CREATE TABLE IF NOT EXISTS ingest_log (
+                index_name TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                ingested_at REAL NOT NULL,
+                PRIMARY KEY (index_name, file_name)
+            );
+        """)
+        # 取得元のパスを記録する前のマニフェストには列を追加する(既存のファイルの取得元は空になる)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(files)")]
+        if "source_path" not in columns:
+            with self.conn:
+                self.conn.execute("ALTER TABLE files ADD COLUMN source_path TEXT NOT NULL DEFAULT ''")
+
+    # ファイルの登録内容を取得する。未登録の場合は None
+    def get_file(self, index_name, file_name):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT file_hash, params, source_path FROM files WHERE index_name = ? AND file_name = ?",
+                (index_name, file_name),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"file_hash": row[0], "params": row[1], "source_path": row[2]}
+
+    # ファイルのチャンクを {chunk_no: (chunk_hash, doc_id)} で取得する
+    def get_chunks(self, index_name, file_name):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT chunk_no, chunk_hash, doc_id FROM chunks WHERE index_name = ? AND file_name = ?",
+                (index_name, file_name),
+            ).fetchall()
+        return {chunk_no: (chunk_hash, doc_id) for chunk_no, chunk_hash, doc_id in rows}
+
+    # インデックスに登録済みで、取得元のパスが source_prefix で始まるファイルを {ファイル名: 取得元のパス} で取得する
+    # 取得元が記録されていないファイルは含めない
+    def list_files(self, index_name, source_prefix):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT file_name, source_path FROM files WHERE index_name = ? AND source_path != ''", (index_name,)
+            ).fetchall()
+        return {file_name: source_path for file_name, source_path in rows if source_path.startswith(source_prefix)}
+
+    # ファイルとチャンクの登録内容を置き換える。chunks は [(chunk_no, chunk_hash, doc_id), ...]
+    def update_file(self, index_name, file_name, file_hash, params, chunks, source_path=""):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (index_name, file_name, file_hash, params, updated_at, source_path) VALUES (?, ?, ?, ?, ?, ?)",
+                (index_name, file_name, file_hash, params, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), source_path),
+            )
+            self.conn.execute(
+                "DELETE FROM chunks WHERE index_name = ? AND file_name = ?", (index_name, file_name)
+            )
+            self.conn.executemany(
+                "INSERT INTO chunks VALUES (?, ?, ?, ?, ?)",
+                [(index_name, file_name, chunk_no, chunk_hash, doc_id) for chunk_no, chunk_hash, doc_id in chunks],
+            )
+
+    # ファイルの取得元のパスを更新する(内容が変わらないままファイルを移動した場合)
+    def set_source_path(self, index_name, file_name, source_path):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE files SET source_path = ? WHERE index_name = ? AND file_name = ?", (source_path, index_name, file_name)
+            )
+
+    # ファイルの登録内容を削除する
+    def remove_file(self, index_name, file_name):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM files WHERE index_name = ? AND file_name = ?", (index_name, file_name))
+            self.conn.execute("DELETE FROM chunks WHERE index_name = ? AND file_name = ?", (index_name, file_name))
+
+    # 処理途中のファイルでアップロード済みのチャンク番号を取得する
+    # ファイルの内容かチャンク分割のパラメータが変わっている場合は途中経過を破棄する
+    def get_progress(self, index_name, file_name, file_hash, params):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM progress WHERE index_name = ? AND file_name = ? AND (file_hash != ? OR params != ?)",
+                (index_name, file_name, file_hash, params),
+            )
+            rows = self.conn.execute(
+                "SELECT chunk_no FROM progress WHERE index_name = ? AND file_name = ?",
+                (index_name, file_name),
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    # アップロードが完了したチャンク番号を記録する
+    def add_progress(self, index_name, file_name, file_hash, params, chunk_nos):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO progress VALUES (?, ?, ?, ?, ?)",
+                [(index_name, file_name, file_hash, params, chunk_no) for chunk_no in chunk_nos],
+            )
+
+    # ファイルの処理が完了したら途中経過を削除する
+    def clear_progress(self, index_name, file_name):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM progress WHERE index_name = ? AND file_name = ?", (index_name, file_name))
+
+    # ファイルのドキュメントを登録・削除した時刻を記録する(回答キャッシュの無効化に使う)
+    def mark_ingested(self, index_name, file_name):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO ingest_log VALUES (?, ?, ?)", (index_name, file_name, time.time())
+            )
+
+    # ファイルのドキュメントを最後に登録・削除した時刻を返す。記録がない場合は 0
+    def get_ingested_at(self, index_name, file_names):
+        file_names = list(file_names)
+        if not file_names:
+            return 0.0
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT MAX(ingested_at) FROM ingest_log WHERE index_name = ? AND file_name IN ({', '.join('?' * len(file_names))})",
+                [index_name] + file_names,
+            ).fetchone()
+        return row[0] or 0.0
+
+
+# ファイルの SHA-256 を計算する
+def hash_file(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+# メモリ上のファイルの内容の SHA-256 を計算する
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# 文字列の SHA-256 を計算する
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# チャンク分割のパラメータを比較用の文字列にする
+def chunk_params(max_chunk_token_size, overlap_token_rate, overlap_type):
+    return json.dumps({
+        "max_chunk_token_size": max_chunk_token_size,
+        "overlap_token_rate": overlap_token_rate,
+        "overlap_type": overlap_type,
+    }, sort_keys=True)
@@ -0,0 +1,72 @@
+import time
+import queue
+import threading
+
+# 処理の終了を後続のステージに伝えるための目印
+_END = object()
+
+
+# 複数のステージをキューでつないで並列に実行するパイプライン
+# stages は [(ステージ名, 関数), ...]。各ステージは workers 個のスレッドで実行され、前のステージの結果を順に受け取る
+# 関数が None を返した場合、そのアイテムは以降のステージに渡さない(スキップ)
+# 戻り値はアイテムごとの状態 {item: {"stage", "status", "seconds", "error"}}
+def run_stages(items, stages, workers, queue_size=None, on_status=None):
+    queues = [queue.Queue(maxsize=queue_size or workers * 2) for _ in range(len(stages) + 1)]
+    statuses = {}
+    lock = threading.Lock()
+
+    def set_status(item, **status):
+        with lock:
+            statuses.setdefault(item, {}).update(status)
+            current = dict(statuses[item])
+        if on_status is not None:
+            on_status(item, current)
+
+    def stage_worker(stage_no, stage_name, func):
+        input_queue = queues[stage_no]
+        output_queue = queues[stage_no + 1]
+        while True:
+            entry = input_queue.get()
+            if entry is _END:
+                # 同じステージの他のスレッドにも終了を伝える
+                input_queue.put(_END)
+                return
+            item, value = entry
+            set_status(item, stage=stage_name, status="running")
+            start = time.time()
+            try:
+                result = func(value)
+            except Exception as e:
+                set_status(item, status="failed", error=str(e))
+                continue
+            finally:
+                with lock:
+                    statuses[item]["seconds"] = statuses[item].get("seconds", 0.0) + time.time() - start
+            if result is None:
+                set_status(item, status="skipped")
+            elif stage_no == len(stages) - 1:
+                set_status(item, status="done")
+            else:
+                output_queue.put((item, result))
+
+    stage_threads = []
+    for stage_no, (stage_name, func) in enumerate(stages):
+        threads = [
+            threading.Thread(target=stage_worker, args=(stage_no, stage_name, func), daemon=True)
+            for _ in range(workers)
+        ]
+        for thread in threads:
+            thread.start()
+        stage_threads.append(threads)
+
+    for item in items:
+        set_status(item, stage="queued", status="waiting")
+        queues[0].put((item, item))
+    queues[0].put(_END)
+
+    # 前のステージの全スレッドが終了してから次のステージに終了を伝える
+    for stage_no, threads in enumerate(stage_threads):
+        for thread in threads:
+            thread.join()
+        queues[stage_no + 1].put(_END)
+    return statuses
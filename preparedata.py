@@ -1,80 +1,106 @@
+import io
 import json
 import re
 import os
+import time
+import queue
 import hashlib
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from base64 import urlsafe_b64encode
-from openai import AzureOpenAI
 from dotenv import load_dotenv
 # 環境変数を読み込む
 load_dotenv()
-import requests
 from dococr.parse_doc import get_content_from_document
-from dococr.create_chunks import chunk_content
+from dococr import ocr_cache
+from dococr.create_chunks import chunk_content, get_tiktoken_encoding
+from ratelimit import RateLimiter, call_with_rate_limit
+from pipeline import run_stages
+from manifest import Manifest, hash_file, hash_bytes, hash_text, chunk_params
+from kvcache import SqliteLRUCache, make_key, pack_vector, unpack_vector
+from localindex import VECTOR_SEARCH_BACKEND, get_local_index
+from cosmos_writer import upsert_items
+from vectorcodec import encode_item, decode_item
+from tracing import traced, span, propagate, count, profile, format_counters
+from clients import RAG_BACKEND, get_openai_client, get_search_client, get_search_index_client, get_cosmos_container, get_blob_container_client, get_http_session, format_connection_stats
 from azure.core.exceptions import ResourceNotFoundError
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from azure.search.documents.indexes import SearchIndexClient
-from azure.cosmos import PartitionKey
-from azure.cosmos.cosmos_client import CosmosClient
-from azure.storage.blob import BlobServiceClient, ContainerClient
 
 max_chunk_token_size = 2048
 overlap_token_rate = 0
 overlap_type = "NONE"  # PREPOST | PRE | POST | NONE
 
-# envファイルから環境変数を取得
-client = AzureOpenAI(
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-    api_version=os.getenv("AZURE_OPENAI_API_VERSION")
-)
-
 # Azure OpenAI Service の情報を環境変数から取得する
 AZURE_OPENAI_CHAT_MODEL = os.getenv("AZURE_OPENAI_CHAT_MODEL")
 AZURE_OPENAI_EMBED_MODEL = os.getenv("AZURE_OPENAI_EMBED_MODEL")
 AZURE_OPENAI_CHAT_MAX_TOKENS = int(os.getenv("AZURE_OPENAI_CHAT_MAX_TOKENS", "1000"))
+# ベクトル生成を一括で行う際の1リクエストあたりの最大件数と最大トークン数
+AZURE_OPENAI_EMBED_BATCH_SIZE = int(os.getenv("AZURE_OPENAI_EMBED_BATCH_SIZE", "16"))
+AZURE_OPENAI_EMBED_BATCH_TOKENS = int(os.getenv("AZURE_OPENAI_EMBED_BATCH_TOKENS", "32000"))
+
+# チャンクの情報付与・ベクトル生成の同時実行数と、デプロイごとのレート制限(0の場合は制限なし)
+ENRICH_MAX_WORKERS = int(os.getenv("ENRICH_MAX_WORKERS", "8"))
+chat_limiter = RateLimiter(
+    "chat",
+    rpm=int(os.getenv("AZURE_OPENAI_CHAT_RPM", "0")),
+    tpm=int(os.getenv("AZURE_OPENAI_CHAT_TPM", "0")),
+)
+embed_limiter = RateLimiter(
+    "embedding",
+    rpm=int(os.getenv("AZURE_OPENAI_EMBED_RPM", "0")),
+    tpm=int(os.getenv("AZURE_OPENAI_EMBED_TPM", "0")),
+)
+# 429 と一時的なエラー(5xx・接続エラー・タイムアウト)の再実行はレートリミッタ側(call_with_rate_limit)で行うため、
+# SDK の自動リトライを無効にしたクライアントを使う
+def get_rate_limited_client():
+    return get_openai_client(max_retries=0)
+
+# チャンクを何件ずつ情報付与・アップロードするかと、アップロード待ちのバッチをいくつまで保持するか
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "32"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "2"))
+
+# get_info / get_vector の結果をチャンクの内容をキーにディスクにキャッシュする(0MBの場合は無効)
+ENRICH_CACHE_PATH = os.getenv("ENRICH_CACHE_PATH", os.path.join(".ragcache", "enrich.sqlite"))
+ENRICH_CACHE_MAX_MB = int(os.getenv("ENRICH_CACHE_MAX_MB", "1024"))
+__enrich_cache = None
+__enrich_cache_lock = threading.Lock()
+
+
+# get_info / get_vector のキャッシュを取得する(初回のみ開く。無効の場合は None)
+def get_enrich_cache():
+    global __enrich_cache
+    if ENRICH_CACHE_MAX_MB <= 0:
+        return None
+    with __enrich_cache_lock:
+        if __enrich_cache is None:
+            __enrich_cache = SqliteLRUCache(ENRICH_CACHE_PATH, ENRICH_CACHE_MAX_MB * 1024 * 1024)
+        return __enrich_cache
 
 # Azure AI Search の情報を環境変数から取得する
 AI_SEARCH_ENDPOINT = os.getenv("AI_SEARCH_ENDPOINT")
 AI_SEARCH_KEY = os.getenv("AI_SEARCH_KEY")
 AI_SEARCH_API_VERSION = os.getenv("AI_SEARCH_API_VERSION", "2023-10-01-Preview")
 
-# Azure AI Search のクライアントを作成する
-credential = AzureKeyCredential(AI_SEARCH_KEY)
-index_client = SearchIndexClient(
-    endpoint=AI_SEARCH_ENDPOINT,
-    credential=credential,
-)
-
 # 環境変数から Azure Cosmos DB の接続文字列とデータベース名を取得する
 COSMOS_CONNECTION_STRING = os.getenv("COSMOS_CONNECTION_STRING")
 COSMOS_DB_NAME = os.getenv("COSMOS_DB_NAME")
 COSMOS_CONTAINER_NAME_KB = os.getenv("COSMOS_CONTAINER_NAME_KB")
-
-# Cosmos DB クライアントを生成する
-cosmos_client = CosmosClient.from_connection_string(COSMOS_CONNECTION_STRING)
-database = cosmos_client.get_database_client(COSMOS_DB_NAME)
-database.create_container_if_not_exists(
-    id=COSMOS_CONTAINER_NAME_KB,
-    partition_key=PartitionKey(path=f"/id"),
-)
-container = database.get_container_client(COSMOS_CONTAINER_NAME_KB)
+# KB への書き込みの並列数と、ベクトルの保存形式(json | float32 | float16。vectorcodec.py を参照)
+COSMOS_WRITE_CONCURRENCY = int(os.getenv("COSMOS_WRITE_CONCURRENCY", "8"))
+COSMOS_VECTOR_FORMAT = os.getenv("COSMOS_VECTOR_FORMAT", "json")
 
 # Azure Blob Storage の情報を環境変数から取得する
 BLOB_STORAGE_CONNECTION_STRING = os.getenv("BLOB_STORAGE_CONNECTION_STRING")
 BLOB_CONTAINER_NAME = os.getenv("BLOB_CONTAINER_NAME")
 USE_BLOB_STORAGE = os.getenv("USE_BLOB_STORAGE")
+# Blob のアップロード・ダウンロードの並列数(大きなファイルはチャンクに分割して並列に転送する)
+BLOB_MAX_CONCURRENCY = int(os.getenv("BLOB_MAX_CONCURRENCY", "8"))
 
-# Blob Storage クライアントを作成
-blob_service_client = BlobServiceClient.from_connection_string(BLOB_STORAGE_CONNECTION_STRING)
-blob_container_client = blob_service_client.get_container_client(BLOB_CONTAINER_NAME)
-
-# ドキュメントの要約、キーワードを抽出する関数
-def get_info(context):
+# get_info のプロンプトのバージョン。プロンプトを変更した場合はキャッシュを無効にするため値を変更する
+INFO_PROMPT_VERSION = "1"
 
-    # systemコンテキストを定義
-    system_context = """あなたは優秀なアシスタントです。社内にあるドキュメントの内容を読み解き、わかりやすく要約し、キーワードを抽出します。\
+# get_info で使用する systemコンテキストを定義
+INFO_SYSTEM_CONTEXT = """あなたは優秀なアシスタントです。社内にあるドキュメントの内容を読み解き、わかりやすく要約し、キーワードを抽出します。\
 ナレッジベースを作成して、RAGに活用していきます。以下の制約条件と形式を守って、JSON形式で出力してください。\
 ###制約条件\
 - 与えられるコンテキストは、ドキュメントをチャンクした文章です。与えられたチャンクの部分を要約し、summaryの値として出力します。要約した内容には、重要なキーワードは含めるようにしてください。\
@@ -86,6 +112,20 @@ summary: <チャンクした部分を要約した内容>\
 title: <チャンクした部分のタイトル>\
 Keywords: ["keyword1", "Keyword2", ...]  """
 
+# ドキュメントの要約、キーワードを抽出する関数
+@traced("get_info")
+def get_info(context):
+
+    # キャッシュがあればそれを返す
+    cache_key = make_key("info", AZURE_OPENAI_CHAT_MODEL, INFO_PROMPT_VERSION, context)
+    enrich_cache = get_enrich_cache()
+    if enrich_cache is not None:
+        cached = enrich_cache.get(cache_key)
+        if cached is not None:
+            count("cache.enrich.hits")
+            return json.loads(cached)
+        count("cache.enrich.misses")
+
     # ユーザリクエストを定義
     user_request = "以下のコンテキストから制約条件と出力形式を必ず守って、JSON形式で出力をしてください。最初から最後まで注意深く読み込んでください。\
 最高の仕事をしましょう。あなたならできる！\
@@ -95,10 +135,13 @@ Keywords: ["keyword1", "Keyword2", ...]  """
     messages = []
  
     #messagesに要素を追加
-    messages.append({"role": "system", "content": system_context})
+    messages.append({"role": "system", "content": INFO_SYSTEM_CONTEXT})
     messages.append({"role": "user", "content": user_request})
 
-    response = client.chat.completions.create(
+    # TPM の見積もりはプロンプトのトークン数 + 最大出力トークン数とする
+    tokens = len(get_tiktoken_encoding().encode(INFO_SYSTEM_CONTEXT + user_request)) + AZURE_OPENAI_CHAT_MAX_TOKENS
+    response = call_with_rate_limit(
+        chat_limiter, tokens, get_rate_limited_client().chat.completions.create,
         model=AZURE_OPENAI_CHAT_MODEL, 
         messages=messages,
         temperature=0.0,
@@ -107,6 +150,9 @@ Keywords: ["keyword1", "Keyword2", ...]  """
     )
 
     print(response.choices[0].message.content)
+    if response.usage is not None:
+        count("tokens.chat.prompt", response.usage.prompt_tokens)
+        count("tokens.chat.completion", response.usage.completion_tokens)
  
     # Convert the content from JSON string to dictionary
     content = json.loads(response.choices[0].message.content)
@@ -116,33 +162,132 @@ Keywords: ["keyword1", "Keyword2", ...]  """
     doc_info['title'] = content['title']
     doc_info['summary'] = content['summary']
     doc_info['Keywords'] = content['Keywords']
-    
+
+    if enrich_cache is not None:
+        enrich_cache.set(cache_key, json.dumps(doc_info, ensure_ascii=False).encode('utf-8'))
     
     return doc_info
 
 # Azure OpenAI Service によるベクトル生成
+@traced("get_vector")
 def get_vector(content):
-    resp = client.embeddings.create(model=AZURE_OPENAI_EMBED_MODEL, input=content)
-    return resp.data[0].embedding
+    return get_vectors([content])[0]
+
+# ベクトルのキャッシュのキーを作成する
+def __vector_cache_key(content):
+    return make_key("vector", AZURE_OPENAI_EMBED_MODEL, content)
+
+# 複数のテキストのベクトルを件数・トークン数の上限に合わせてまとめて生成する
+# 戻り値は入力と同じ順番のベクトルのリスト
+@traced("get_vectors")
+def get_vectors(contents, executor=None):
+    # キャッシュにあるものはキャッシュから取得し、ないものだけ生成する
+    vectors = [None] * len(contents)
+    enrich_cache = get_enrich_cache()
+    if enrich_cache is not None:
+        for i, content in enumerate(contents):
+            cached = enrich_cache.get(__vector_cache_key(content))
+            if cached is not None:
+                vectors[i] = unpack_vector(cached)
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if enrich_cache is not None:
+        count("cache.vector.hits", len(contents) - len(missing))
+        count("cache.vector.misses", len(missing))
+
+    batches = __make_embed_batches([contents[i] for i in missing])
+    if executor is None:
+        results = map(__get_vectors_with_split, batches)
+    else:
+        results = executor.map(propagate(__get_vectors_with_split), batches)
+    generated = []
+    for batch_vectors in results:
+        generated += batch_vectors
+
+    for i, vector in zip(missing, generated):
+        vectors[i] = vector
+        if enrich_cache is not None:
+            enrich_cache.set(__vector_cache_key(contents[i]), pack_vector(vector))
+    return vectors
+
+# 入力を件数・トークン数の上限を超えないバッチに分割する
+def __make_embed_batches(contents):
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for content in contents:
+        tokens = len(get_tiktoken_encoding().encode(content))
+        if batch and (len(batch) >= AZURE_OPENAI_EMBED_BATCH_SIZE or batch_tokens + tokens > AZURE_OPENAI_EMBED_BATCH_TOKENS):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(content)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+# バッチ単位でベクトルを生成する。失敗した場合はバッチを半分に分割して再実行する
+def __get_vectors_with_split(batch):
+    tokens = sum(len(get_tiktoken_encoding().encode(content)) for content in batch)
+    try:
+        resp = call_with_rate_limit(
+            embed_limiter, tokens, get_rate_limited_client().embeddings.create,
+            model=AZURE_OPENAI_EMBED_MODEL, input=batch,
+        )
+    except Exception as e:
+        if len(batch) == 1:
+            raise
+        print(f"embedding batch failed ({len(batch)} items), split and retry:", e)
+        count("retries.embedding_split")
+        half = len(batch) // 2
+        return __get_vectors_with_split(batch[:half]) + __get_vectors_with_split(batch[half:])
+    if resp.usage is not None:
+        count("tokens.embedding", resp.usage.total_tokens)
+    # レスポンスの index で入力順に並べ替える
+    return [d.embedding for d in sorted(resp.data, key=lambda d: d.index)]
+
+# チャンクへの情報付与とベクトル生成を並列に実行する
+# 戻り値はチャンクと同じ順番(chunk_no順)の (docinfo, vector) のリスト
+def enrich_chunks(chunks):
+    start = time.time()
+    chat_tokens = chat_limiter.total_tokens
+    embed_tokens = embed_limiter.total_tokens
+    with ThreadPoolExecutor(max_workers=ENRICH_MAX_WORKERS) as executor:
+        # executor.map は入力順に結果を返すため、chunk_no の順番は保たれる
+        docinfos = list(executor.map(propagate(get_info), chunks))
+        print("generate vectors:", len(docinfos))
+        vectors = get_vectors([docinfo['summary'] for docinfo in docinfos], executor)
+
+    # スループットを表示
+    elapsed = max(time.time() - start, 1e-6)
+    tokens = chat_limiter.total_tokens - chat_tokens + embed_limiter.total_tokens - embed_tokens
+    print(f"enriched {len(chunks)} chunks in {elapsed:.1f}s "
+          f"({len(chunks) / elapsed:.2f} chunks/s, {tokens / elapsed:.0f} tokens/s, "
+          f"throttled: chat={chat_limiter.throttled} embedding={embed_limiter.throttled})")
+    return list(zip(docinfos, vectors))
 
 # インデックスが存在するか確認する
 def check_index_exists(name):
     try:
-        index_client.get_index(name)
+        get_search_index_client().get_index(name)
         return True
     except ResourceNotFoundError:
         return False
 
 # インデックスを削除する
 def delete_index(name):
-    index_client.delete_index(name)
+    get_search_index_client().delete_index(name)
 
 # インデックスを作成する
 def create_index(name, json_file_path):
     with open(json_file_path, "r", encoding='utf-8') as f:
         data = json.load(f)
     data["name"] = name
-    resp = requests.post(
+    # ローカルのスタンドインの場合は定義をそのまま登録する
+    if RAG_BACKEND == "local":
+        get_search_index_client().create_index(data)
+        return 201
+    resp = get_http_session("search").post(
         f"{AI_SEARCH_ENDPOINT}/indexes?api-version={AI_SEARCH_API_VERSION}",
         data=json.dumps(data),
         headers={"Content-Type": "application/json", "api-key": AI_SEARCH_KEY},
@@ -151,94 +296,414 @@ def create_index(name, json_file_path):
         raise Exception(resp.text)  # 2xx 以外の場合はエラー
     return resp.status_code
 
-# インデックスにドキュメントを追加する
+# インデックスにドキュメントを追加する。ローカルのベクトル検索を使う場合はローカルインデックスにも追加する
+@traced("add_documents")
 def add_documents(index_name, docs):
-    search_client = SearchClient(
-        endpoint=AI_SEARCH_ENDPOINT,
-        credential=credential,
-        index_name=index_name,
-    )
+    count("documents.indexed", len(docs))
+    search_client = get_search_client(index_name)
     search_client.upload_documents(documents=docs)
+    if VECTOR_SEARCH_BACKEND == "local":
+        get_local_index(index_name).add_documents(docs)
+
+# インデックスからドキュメントを削除する
+def delete_documents(index_name, doc_ids):
+    search_client = get_search_client(index_name)
+    search_client.delete_documents(documents=[{"id": doc_id} for doc_id in doc_ids])
+
+# Cosmos DB に複数のドキュメントを COSMOS_WRITE_CONCURRENCY 並列で追加する
+# KB のコンテナは複数のインデックスで共有するため、登録先のインデックス名(indexName)を付けて保存する
+@traced("add_to_cosmos")
+def add_to_cosmos(index_name, items):
+    count("cosmos.items", len(items))
+    upsert_items(
+        get_cosmos_container(COSMOS_CONTAINER_NAME_KB),
+        [encode_item(dict(item, indexName=index_name), COSMOS_VECTOR_FORMAT) for item in items],
+        max_workers=COSMOS_WRITE_CONCURRENCY,
+    )
 
-# Cosmos DB にドキュメントを追加する
-def add_to_cosmos(item):
-    container.upsert_item(item)
+# Cosmos DB からドキュメントを削除する
+def delete_from_cosmos(doc_id):
+    try:
+        get_cosmos_container(COSMOS_CONTAINER_NAME_KB).delete_item(item=doc_id, partition_key=doc_id)
+    except ResourceNotFoundError:
+        pass
+
+# Cosmos DB から登録済みのドキュメントを並列に読み込み、{doc_id: ドキュメント} で返す(見つからないものは含めない)
+@traced("load_from_cosmos")
+def load_from_cosmos(doc_ids):
+    container = get_cosmos_container(COSMOS_CONTAINER_NAME_KB)
+
+    def read(doc_id):
+        try:
+            return decode_item(container.read_item(item=doc_id, partition_key=doc_id))
+        except ResourceNotFoundError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=COSMOS_WRITE_CONCURRENCY) as executor:
+        docs = list(executor.map(propagate(read), doc_ids))
+    return {doc_id: doc for doc_id, doc in zip(doc_ids, docs) if doc is not None}
+
+# 存在しなくなったチャンクをインデックスと Cosmos DB から削除する
+def delete_chunks(index_name, doc_ids):
+    if not doc_ids:
+        return
+    print("delete documents:", len(doc_ids))
+    if check_index_exists(index_name):
+        delete_documents(index_name, doc_ids)
+    if VECTOR_SEARCH_BACKEND == "local":
+        get_local_index(index_name).delete_documents(doc_ids)
+    for doc_id in doc_ids:
+        delete_from_cosmos(doc_id)
+
+# ファイル名とチャンク番号からドキュメントIDを作成する
+def get_doc_id(file_name, chunk_no):
+    id_base = f"{file_name}_{chunk_no}"
+    return hashlib.sha256(id_base.encode('utf-8')).hexdigest()
 
 def process_file(file_path, index_name=None, args=None):
+    with span("process_file", file=file_path):
+        job = prepare_file(file_path, index_name, args)
+        if job is None:
+            return
+        job = extract_chunks(job)
+        if job is None:
+            return
+        ingest_chunks(job)
+
+# メモリ上のファイルの内容(Streamlit の UploadedFile.getbuffer() など)を、一時ファイルを作らずに処理する
+# upload_to_blob=True の場合は、Blob Storage へのアップロードを OCR・登録と並行して行う
+def process_buffer(data, file_name, index_name=None, args=None, upload_to_blob=False):
+    # BytesIO は bytes を複製せずに参照するため、memoryview などは最初に1度だけ bytes にする
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    print("process file:", file_name)
+    with span("process_buffer", file=file_name, bytes=len(data)), ThreadPoolExecutor(max_workers=1) as executor:
+        upload = executor.submit(propagate(upload_blob), data, file_name) if upload_to_blob else None
+        job = __make_job(file_name, file_name, index_name, data, hash_bytes(data), "", args)
+        if job is not None:
+            job = extract_chunks(job)
+        if job is not None:
+            ingest_chunks(job)
+        # アップロードでエラーが発生していれば例外を送出する
+        if upload is not None:
+            upload.result()
+    refresh_local_index(index_name or os.getenv("AI_SEARCH_INDEX_NAME"))
+
+# ローカルのベクトル検索を使う場合は、追加・削除したドキュメントを検索用の行列に反映する
+# 行列の作り直しは全てのベクトルを読み直すため、ファイルごとではなく処理の最後に1回だけ行う(未反映の更新がない場合は何もしない)
+def refresh_local_index(index_name):
+    if VECTOR_SEARCH_BACKEND == "local":
+        get_local_index(index_name).load()
+
+# Blob Storage にファイルの内容をアップロードする
+@traced("upload_blob")
+def upload_blob(data, file_name):
+    count("bytes.blob_upload", len(data))
+    blob_client = get_blob_container_client().get_blob_client(file_name)
+    blob_client.upload_blob(data, overwrite=True, max_concurrency=BLOB_MAX_CONCURRENCY)
+    print(f"Uploaded {file_name} to Blob Storage.")
+
+# Blob Storage からファイルの内容をメモリにダウンロードする。大きなファイルはチャンクに分割して並列にダウンロードする
+@traced("download_blob")
+def download_blob(file_name):
+    blob_client = get_blob_container_client().get_blob_client(file_name)
+    data = blob_client.download_blob(max_concurrency=BLOB_MAX_CONCURRENCY).readall()
+    count("bytes.blob_download", len(data))
+    print(f"Downloaded {file_name} from Blob Storage ({len(data) / 1024 / 1024:.1f}MB).")
+    return data
+
+# ファイルを処理対象として準備する(Blob Storage からのダウンロード、差分判定)
+# 処理不要の場合は None を返す
+@traced("prepare_file")
+def prepare_file(file_path, index_name=None, args=None):
     print("process file:", file_path)
 
+    # --blobオプションが指定されている場合は、Blob Storage からメモリ上にダウンロードして処理する
+    print("use_blob_storage:", USE_BLOB_STORAGE)
+    file_name = os.path.basename(file_path)
+    if USE_BLOB_STORAGE and getattr(args, "blob", False):
+        source = download_blob(file_name)
+        file_hash = hash_bytes(source)
+    else:
+        source = file_path
+        file_hash = hash_file(file_path)
+    return __make_job(file_path, file_name, index_name, source, file_hash, get_source_path(file_path, args), args)
+
+# ファイルの取得元のパスを返す(マニフェストに記録し、--incremental で取得元から削除されたファイルの判定に使う)
+def get_source_path(file_path, args=None):
+    if USE_BLOB_STORAGE and getattr(args, "blob", False):
+        return f"blob://{BLOB_CONTAINER_NAME}/{file_path}"
+    return os.path.abspath(file_path)
+
+# 処理対象のジョブを作成する。source はファイルのパスかメモリ上のファイルの内容、source_path は取得元のパス
+# ファイルとチャンク分割のパラメータが前回から変わっていない場合は None を返す
+def __make_job(file_path, file_name, index_name, source, file_hash, source_path, args):
     if index_name is None:
         index_name = os.getenv("AI_SEARCH_INDEX_NAME")
 
-    # ファイルがBlob Storageに存在するか確認。--blobオプションが指定されている場合のみ
-    print("use_blob_storage:", USE_BLOB_STORAGE)
-    download_file_path = file_path
-    if USE_BLOB_STORAGE and args.blob:
-        # ファイル名からBlobを取得
-        blob_client = blob_container_client.get_blob_client(os.path.basename(file_path))
-        download_file_path = os.path.join(os.getcwd(), os.path.basename(file_path))
-        with open(download_file_path, "wb") as download_file:
-            download_data = blob_client.download_blob()
-            download_data.readinto(download_file)
-        print(f"Downloaded {file_path} from Blob Storage to {download_file_path}.")
-
+    # --incremental オプションの場合はマニフェストと比較して変更分のみ処理する
+    # マニフェストには中断した処理を再開するための途中経過も記録する
+    incremental = getattr(args, "incremental", False)
+    manifest = Manifest()
+    params = chunk_params(max_chunk_token_size, overlap_token_rate, overlap_type)
+    if incremental:
+        registered = manifest.get_file(index_name, file_name)
+        if registered is not None and registered["file_hash"] == file_hash and registered["params"] == params:
+            print("unchanged, skip:", file_path)
+            # 内容が同じまま取得元が変わった場合は、取得元だけを更新する
+            if source_path and registered["source_path"] != source_path:
+                manifest.set_source_path(index_name, file_name, source_path)
+            return None
+
+    return {
+        "file_path": file_path,
+        "file_name": file_name,
+        "index_name": index_name,
+        "source": source,
+        "incremental": incremental,
+        "manifest": manifest,
+        "file_hash": file_hash,
+        "params": params,
+        "source_path": source_path,
+    }
+
+# ファイルからテキストを抽出してチャンクに分割する。対象外のファイル形式の場合は None を返す
+@traced("extract_chunks")
+def extract_chunks(job):
+    source = job["source"]
+    file_name = job["file_name"]
     # PDFファイルの場合、ドキュメントからテキストを抽出
-    if download_file_path.endswith(".pdf"):
+    if file_name.endswith(".pdf"):
         # ドキュメントから Document Intelligence でテキストを抽出する
-        print("extract content from document: ", download_file_path)
-        content = get_content_from_document(download_file_path)
+        print("extract content from document: ", job["file_path"])
+        content = get_content_from_document(source, file_name)
 
         # 抽出したテキストをチャンク分割
         print("chunk content:")
         chunks = chunk_content(content, max_chunk_token_size, overlap_token_rate, overlap_type)
     # txtファイルの場合、テキストを読み込む
-    elif download_file_path.endswith(".txt"):
-        with open(download_file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+    elif file_name.endswith(".txt"):
+        if isinstance(source, bytes):
+            # ファイルから読み込む場合と同じく改行コードを変換する
+            content = io.TextIOWrapper(io.BytesIO(source), encoding='utf-8').read()
+        else:
+            with open(source, 'r', encoding='utf-8') as f:
+                content = f.read()
         chunks = [content]
     # その他のファイルの場合、エラーメッセージを表示
     else:
-        print("unsupported file format:", download_file_path)
-        return
-
-    # ダウンロードした一時ファイルを削除。--blobオプションの場合のみ削除
-    if USE_BLOB_STORAGE and args.blob:
-        os.remove(download_file_path)
-
-
-    # 各チャンクに対して情報を付与
-    file_name = os.path.basename(file_path)
-    index_docs = []
-    for chunk_no, chunk in enumerate(chunks):
-        print("enrichment chunk:", f"{chunk_no+1}/{len(chunks)}")
-        docinfo = get_info(chunk)
-        id_base = f"{file_name}_{chunk_no}"
-        id_hash = hashlib.sha256(id_base.encode('utf-8')).hexdigest()
-        index_doc = {
-            "id": id_hash,
-            "fileName": os.path.basename(file_path),
-            "chunkNo": chunk_no,
-            "content": chunk,
-            "title": docinfo['title'],
-            "summary": docinfo['summary'],
-            "keywords": docinfo['Keywords'],
-            "contentVector": get_vector(docinfo['summary']),
+        print("unsupported file format:", job["file_path"])
+        return None
+
+    # メモリ上のファイルの内容は以降使わないため解放する
+    job["source"] = None
+    job["chunks"] = chunks
+    return job
+
+# チャンクに情報を付与し、Cosmos DB とインデックスに登録する
+@traced("ingest_chunks")
+def ingest_chunks(job):
+    index_name = job["index_name"]
+    file_name = job["file_name"]
+    file_hash = job["file_hash"]
+    params = job["params"]
+    manifest = job["manifest"]
+    chunks = job["chunks"]
+
+    # 差分処理の場合、前回から内容が変わったチャンクのみを対象にする
+    chunk_hashes = [hash_text(chunk) for chunk in chunks]
+    target_chunk_nos = list(range(len(chunks)))
+    removed_doc_ids = []
+    reused_docs = {}
+    if job["incremental"]:
+        registered_chunks = manifest.get_chunks(index_name, file_name)
+        target_chunk_nos = [
+            chunk_no for chunk_no in target_chunk_nos
+            if registered_chunks.get(chunk_no, (None,))[0] != chunk_hashes[chunk_no]
+        ]
+        removed_doc_ids = [
+            doc_id for chunk_no, (_, doc_id) in registered_chunks.items() if chunk_no >= len(chunks)
+        ]
+        # 前のチャンクの追加・削除で位置がずれただけのチャンクは、内容のハッシュで登録済みのドキュメントと対応付け、
+        # 情報付与の結果とベクトルを再利用する(チャンク番号とドキュメントIDだけを付け直して登録する)
+        # 同じドキュメントIDは登録で上書きされるため、登録を始める前に読み込んでおく
+        registered_doc_ids = {chunk_hash: doc_id for chunk_hash, doc_id in registered_chunks.values()}
+        moved = {
+            chunk_no: registered_doc_ids[chunk_hashes[chunk_no]]
+            for chunk_no in target_chunk_nos if chunk_hashes[chunk_no] in registered_doc_ids
         }
+        if moved:
+            loaded = load_from_cosmos(sorted(set(moved.values())))
+            reused_docs = {chunk_no: loaded[doc_id] for chunk_no, doc_id in moved.items() if doc_id in loaded}
+        print(f"changed chunks: {len(target_chunk_nos)}/{len(chunks)} (moved: {len(reused_docs)}), removed chunks: {len(removed_doc_ids)}")
 
-        index_docs.append(index_doc)
-
-        # Cosmos DB にドキュメントを追加
-        print("add to cosmos db")
-        add_to_cosmos(index_doc)
+    # 前回中断した処理の途中経過があれば、アップロード済みのチャンクを除外する
+    uploaded_chunk_nos = manifest.get_progress(index_name, file_name, file_hash, params)
+    if uploaded_chunk_nos:
+        print("resume from previous run, uploaded chunks:", len(uploaded_chunk_nos))
+        target_chunk_nos = [chunk_no for chunk_no in target_chunk_nos if chunk_no not in uploaded_chunk_nos]
 
     # Azure AI Search にインデックスを作成
-    if not check_index_exists(index_name):
-        print("create index:", index_name)
-        create_index(index_name, "index.json")
+    ensure_index(index_name)
+
+    # 各チャンクに対して情報を付与し、バッチごとに Cosmos DB とインデックスに追加する
+    upload_index_docs(
+        index_name,
+        generate_index_docs(file_name, chunks, target_chunk_nos, reused_docs),
+        on_uploaded=lambda chunk_nos: manifest.add_progress(index_name, file_name, file_hash, params, chunk_nos),
+    )
 
-    # インデックスにドキュメントを追加
-    print("upload documents to index:", index_name)
-    add_documents(index_name, index_docs) 
+    # 差分処理の場合、存在しなくなったチャンクを削除してマニフェストを更新する
+    if job["incremental"]:
+        delete_chunks(index_name, removed_doc_ids)
+        manifest.update_file(
+            index_name, file_name, file_hash, params,
+            [(chunk_no, chunk_hashes[chunk_no], get_doc_id(file_name, chunk_no)) for chunk_no in range(len(chunks))],
+            job["source_path"],
+        )
+    manifest.clear_progress(index_name, file_name)
+    manifest.mark_ingested(index_name, file_name)
+
+    job["uploaded_chunks"] = len(target_chunk_nos)
+    return job
+
+# インデックスが存在しない場合は作成する(並列処理時に二重に作成しないようロックする)
+index_lock = threading.Lock()
+def ensure_index(index_name):
+    with index_lock:
+        if not check_index_exists(index_name):
+            print("create index:", index_name)
+            create_index(index_name, "index.json")
+
+# 複数のファイルを並列に処理する
+# ダウンロード・差分判定、OCR・チャンク分割、情報付与・ベクトル生成・登録の各ステージを workers 個ずつのスレッドで実行し、
+# 異なるファイルの異なるステージを同時に進める
+def process_files_parallel(file_paths, index_name, args, workers):
+    start = time.time()
+    jobs = {}
+
+    def on_status(file_path, status):
+        print(f"[{status['status']}] {status['stage']}: {file_path}" + (f" ({status['error']})" if status.get('error') else ""))
+
+    def ingest_stage(job):
+        jobs[job["file_path"]] = ingest_chunks(job)
+        return job
+
+    statuses = run_stages(
+        file_paths,
+        [
+            ("download", lambda file_path: prepare_file(file_path, index_name, args)),
+            ("ocr/chunk", extract_chunks),
+            ("enrich/upload", ingest_stage),
+        ],
+        workers,
+        on_status=on_status,
+    )
+
+    # ファイルごとの状態と全体のスループットを表示する
+    elapsed = max(time.time() - start, 1e-6)
+    print("file status:")
+    for file_path, status in statuses.items():
+        chunks = jobs.get(file_path, {}).get("uploaded_chunks", 0)
+        print(f"  {status['status']:8s} {status.get('seconds', 0.0):8.1f}s chunks={chunks:5d} {file_path}"
+              + (f" error: {status['error']} (stage: {status['stage']})" if status.get('error') else ""))
+    done = sum(1 for status in statuses.values() if status['status'] == 'done')
+    failed = sum(1 for status in statuses.values() if status['status'] == 'failed')
+    total_chunks = sum(job.get("uploaded_chunks", 0) for job in jobs.values())
+    print(f"processed {done} files ({failed} failed, {len(statuses) - done - failed} skipped), {total_chunks} chunks "
+          f"in {elapsed:.1f}s: {done / elapsed:.3f} files/s, {total_chunks / elapsed:.2f} chunks/s")
+
+# 指定したチャンクを INGEST_BATCH_SIZE 件ずつ情報付与し、インデックス用のドキュメントのリストを順に返す
+# reused_docs({chunk_no: 登録済みのドキュメント})のチャンクは情報付与を行わず、登録済みのドキュメントの結果を使う
+def generate_index_docs(file_name, chunks, chunk_nos, reused_docs=None):
+    reused_docs = reused_docs or {}
+    for i in range(0, len(chunk_nos), INGEST_BATCH_SIZE):
+        batch_chunk_nos = chunk_nos[i:i + INGEST_BATCH_SIZE]
+        enrich_chunk_nos = [chunk_no for chunk_no in batch_chunk_nos if chunk_no not in reused_docs]
+        print("enrichment chunks:", f"{i + len(batch_chunk_nos)}/{len(chunk_nos)}, reused: {len(batch_chunk_nos) - len(enrich_chunk_nos)}")
+        enriched = {}
+        if enrich_chunk_nos:
+            enriched = dict(zip(enrich_chunk_nos, enrich_chunks([chunks[chunk_no] for chunk_no in enrich_chunk_nos])))
+        index_docs = []
+        for chunk_no in batch_chunk_nos:
+            if chunk_no in reused_docs:
+                doc = reused_docs[chunk_no]
+                title, summary, keywords, vector = doc['title'], doc['summary'], doc['keywords'], doc['contentVector']
+            else:
+                docinfo, vector = enriched[chunk_no]
+                title, summary, keywords = docinfo['title'], docinfo['summary'], docinfo['Keywords']
+            index_docs.append({
+                "id": get_doc_id(file_name, chunk_no),
+                "fileName": file_name,
+                "chunkNo": chunk_no,
+                "content": chunks[chunk_no],
+                "title": title,
+                "summary": summary,
+                "keywords": keywords,
+                "contentVector": vector,
+            })
+        yield index_docs
+
+# ドキュメントのバッチを Cosmos DB とインデックスに登録する
+# 登録は別スレッドで行い、情報付与と並行して進める。待ちキューが一杯になると情報付与側が待つ(バックプレッシャー)
+# バッチの登録が完了するたびに on_uploaded(チャンク番号のリスト) を呼び出す
+def upload_index_docs(index_name, batches, on_uploaded=None):
+    upload_queue = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+    errors = []
+
+    def upload_worker():
+        while True:
+            index_docs = upload_queue.get()
+            if index_docs is None:
+                return
+            if errors:
+                continue
+            try:
+                # Cosmos DB にドキュメントを追加
+                print("add to cosmos db:", len(index_docs))
+                add_to_cosmos(index_name, index_docs)
+                # インデックスにドキュメントを追加
+                print("upload documents to index:", index_name, len(index_docs))
+                add_documents(index_name, index_docs)
+                if on_uploaded is not None:
+                    on_uploaded([index_doc["chunkNo"] for index_doc in index_docs])
+            except Exception as e:
+                errors.append(e)
+
+    worker = threading.Thread(target=propagate(upload_worker), daemon=True)
+    worker.start()
+    try:
+        for index_docs in batches:
+            if errors:
+                break
+            upload_queue.put(index_docs)
+    finally:
+        upload_queue.put(None)
+        worker.join()
+    if errors:
+        raise errors[0]
+
+# キャッシュのヒット率を表示する
+def print_cache_stats():
+    enrich_cache = get_enrich_cache()
+    if enrich_cache is not None:
+        print("enrich cache:", enrich_cache.stats())
+    print("ocr cache:", ocr_cache.stats())
+    print("connections:", format_connection_stats())
+    print("counters:", format_counters())
+
+# マニフェストに登録済みで取得元のパスが source_prefix で始まり、今回の処理対象(source_paths)に存在しなくなったファイルのドキュメントを削除する
+# 他のディレクトリや Blob Storage から登録したファイルは削除しない
+def remove_missing_files(index_name, source_prefix, source_paths):
+    manifest = Manifest()
+    for file_name, source_path in manifest.list_files(index_name, source_prefix).items():
+        if source_path in source_paths:
+            continue
+        print("file removed, delete documents:", source_path)
+        registered_chunks = manifest.get_chunks(index_name, file_name)
+        delete_chunks(index_name, [doc_id for _, doc_id in registered_chunks.values()])
+        manifest.remove_file(index_name, file_name)
+        manifest.mark_ingested(index_name, file_name)
 
 def main():
     parser = argparse.ArgumentParser(description='Process files for RAG application.')
@@ -246,27 +711,41 @@ def main():
     parser.add_argument('--dir', type=str, help='Path to the directory containing files to process.')
     parser.add_argument('--blob', action='store_true', help='Process all files in Blob Storage.')
     parser.add_argument('--index', type=str, help='Name of the Azure Cognitive Search index.')
+    parser.add_argument('--incremental', action='store_true', help='Skip unchanged files and only reprocess changed chunks using the manifest.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of files processed in parallel per stage (download, OCR/chunk, enrich/upload).')
+    parser.add_argument('--profile', action='store_true', help='Profile the run with cProfile (same as PROFILE_ENABLED=true).')
 
     args = parser.parse_args()
 
     index_name = args.index if args.index else os.getenv("AI_SEARCH_INDEX_NAME")
 
-    if args.file:
-        process_file(args.file, index_name, args)
-    elif args.dir:
-        for root, dirs, files in os.walk(args.dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                process_file(file_path, index_name, args)
-    elif args.blob:
-        # Blob Storage内の全てのファイルを処理
-        print("Processing all files in Blob Storage...")
-        blob_list = blob_container_client.list_blobs()
-        for blob in blob_list:
-            process_file(blob.name, index_name, args)
-    else:
-        print("Please specify a file, directory, or use --blob to process files from Blob Storage.")
-        parser.print_help()
+    # --profile オプションの場合は cProfile でプロファイルする
+    with profile("preparedata", enabled=args.profile or None):
+        if args.file:
+            process_file(args.file, index_name, args)
+        elif args.dir or args.blob:
+            if args.dir:
+                file_paths = [os.path.join(root, file) for root, dirs, files in os.walk(args.dir) for file in files]
+            else:
+                # Blob Storage内の全てのファイルを処理
+                print("Processing all files in Blob Storage...")
+                file_paths = [blob.name for blob in get_blob_container_client().list_blobs()]
+
+            if args.workers > 1:
+                process_files_parallel(file_paths, index_name, args, args.workers)
+            else:
+                for file_path in file_paths:
+                    process_file(file_path, index_name, args)
+            if args.incremental:
+                source_prefix = os.path.join(os.path.abspath(args.dir), "") if args.dir else f"blob://{BLOB_CONTAINER_NAME}/"
+                remove_missing_files(index_name, source_prefix, {get_source_path(file_path, args) for file_path in file_paths})
+        else:
+            print("Please specify a file, directory, or use --blob to process files from Blob Storage.")
+            parser.print_help()
+            return
+        refresh_local_index(index_name)
+
+    print_cache_stats()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,207 @@
+import os
+import re
+from dococr.create_chunks import get_tiktoken_encoding
+
+# トークン数の上限を守ってプロンプトを組み立てる
+# プロンプトは システムロール + 情報源(Sources) + 会話履歴 + 回答の指示 で構成する
+#   - 情報源は重複・オーバーラップを取り除き、検索結果の順(セマンティックランカー・MMR の順位)に上限まで入れる。入りきらない情報源は切り詰めるか除外する
+#   - 会話履歴は直近のメッセージをそのまま残し、古いメッセージは要約(ローリングサマリ)にまとめる
+
+# システムロール・情報源・会話履歴の合計トークン数の上限
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "12000"))
+# 会話履歴(要約を含む)のトークン数の上限
+PROMPT_HISTORY_TOKENS = int(os.getenv("PROMPT_HISTORY_TOKENS", "2000"))
+# 情報源を切り詰めて入れる場合の最小トークン数。残りがこれより少ない場合は除外する
+PROMPT_MIN_SOURCE_TOKENS = int(os.getenv("PROMPT_MIN_SOURCE_TOKENS", "200"))
+
+SOURCES_HEADER = "\n\n# Sources(情報源): \n\n"
+HISTORY_HEADER = "# 今までの会話履歴：\n\n"
+SUMMARY_HEADER = "## これまでの会話の要約\n\n"
+PROMPT_FOOTER = "# 回答の生成\n\nそれでは、制約を踏まえて最高の回答をしてください。あなたならできる！"
+
+# オーバーラップとみなす最小の文字数
+MIN_OVERLAP_CHARS = 32
+
+
+# テキストのトークン数を返す
+def count_tokens(text):
+    return len(get_tiktoken_encoding().encode(text))
+
+
+# テキストを先頭から max_tokens トークンまでに切り詰める
+def truncate_tokens(text, max_tokens):
+    tokens = get_tiktoken_encoding().encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return get_tiktoken_encoding().decode(tokens[:max_tokens])
+
+
+# テキストを末尾の max_tokens トークンまでに切り詰める(先頭を削る)
+def truncate_tokens_front(text, max_tokens):
+    tokens = get_tiktoken_encoding().encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return get_tiktoken_encoding().decode(tokens[len(tokens) - max_tokens:])
+
+
+# プロンプトに入れる情報源の形式
+def format_source(source):
+    return f"## filename: {source['filename']}\n\n  ### score: {source['score']}\n\n  ### content: \n\n {source['content']}\n\n"
+
+
+# 参照元として表示する情報源の形式
+def format_display_source(source):
+    return f"## filename: {source['filename']}\n\n  ### title: {source['title']}\n\n  ### content: \n\n {source['content']}\n\n"
+
+
+# 情報源の名前。連続するチャンクをまとめた結果(diversify.py)は <ファイル名>-<先頭のチャンク番号>-<末尾のチャンク番号> とする
+# 複数のインデックスの結果(fanout.py)は先頭に <インデックス名>/ を付け、同名のファイルを区別する
+def __source_name(result):
+    prefix = result['indexName'] + "/" if result.get('indexName') else ""
+    chunk_nos = result.get('chunkNos')
+    if chunk_nos:
+        return f"{prefix}{result['fileName']}-{chunk_nos[0]}-{chunk_nos[-1]}"
+    return prefix + result['fileName'] + "-" + str(result['chunkNo'])
+
+
+# 回答中の [参照名] に一致する情報源を、参照された順に重複なく (参照名, 情報源) のリストで返す
+# 参照名を text(情報源) に含む最初の情報源を一致とする。情報源が表示用の文字列の場合は text=str を指定する
+def cited_sources(response, sources, text=format_display_source):
+    cited = []
+    for name in dict.fromkeys(re.findall(r'\[(.*?)\]', response)):
+        for source in sources:
+            if name in text(source):
+                cited.append((name, source))
+                break
+    return cited
+
+
+# 検索結果を情報源のリストにする。順番は検索結果の順のままとする
+# スコアはセマンティックランカーを使った場合はリランカーのスコア、それ以外は検索のスコアとする
+def sources_from_results(results):
+    return [{
+        "filename": __source_name(result),
+        "fileName": result['fileName'],
+        "indexName": result.get('indexName'),
+        "chunkNo": result['chunkNo'],
+        "score": result['@search.reranker_score'] if result.get('@search.reranker_score') is not None else result['@search.score'],
+        "title": result['title'],
+        "content": result['content'],
+    } for result in results]
+
+
+# 内容が同じ・他の情報源に含まれる情報源を除外し、同じファイルの隣接チャンクのオーバーラップ部分を取り除く
+def dedupe_sources(sources):
+    normalized = [re.sub(r"\s+", " ", source["content"]).strip() for source in sources]
+    kept = []
+    for i, source in enumerate(sources):
+        # 検索結果の順(順位の高い順)に並んでいるため、先に残したものを優先する
+        if any(normalized[i] in normalized[j] for j in kept):
+            continue
+        kept.append(i)
+    kept_sources = [dict(sources[i]) for i in kept]
+    by_chunk = {(source.get("indexName"), source["fileName"], source["chunkNo"]): source for source in kept_sources}
+    for source in kept_sources:
+        previous = by_chunk.get((source.get("indexName"), source["fileName"], source["chunkNo"] - 1))
+        if previous is not None:
+            overlap = overlap_length(previous["content"], source["content"])
+            if overlap:
+                source["content"] = source["content"][overlap:]
+    return kept_sources
+
+
+# a の末尾と b の先頭が一致する文字数を返す(MIN_OVERLAP_CHARS 未満の場合は 0)
+def overlap_length(a, b):
+    if len(a) < MIN_OVERLAP_CHARS or len(b) < MIN_OVERLAP_CHARS:
+        return 0
+    head = b[:MIN_OVERLAP_CHARS]
+    position = a.find(head, max(0, len(a) - len(b)))
+    while position != -1:
+        if b.startswith(a[position:]):
+            return len(a) - position
+        position = a.find(head, position + 1)
+    return 0
+
+
+# 情報源を並んでいる順(検索結果の順位の高い順)に max_tokens まで入れる。入りきらない最初の情報源は残りのトークン数に切り詰める
+# 戻り値は (入れた情報源のリスト, 切り詰めた件数, 除外した件数)
+def fit_sources(sources, max_tokens):
+    fitted = []
+    truncated = 0
+    remaining = max_tokens
+    for source in sources:
+        tokens = count_tokens(format_source(source))
+        if tokens <= remaining:
+            fitted.append(source)
+            remaining -= tokens
+            continue
+        overhead = tokens - count_tokens(source["content"])
+        if remaining - overhead >= PROMPT_MIN_SOURCE_TOKENS:
+            source = dict(source, content=truncate_tokens(source["content"], remaining - overhead))
+            fitted.append(source)
+            remaining -= count_tokens(format_source(source))
+            truncated += 1
+        break
+    return fitted, truncated, len(sources) - len(fitted)
+
+
+# 会話履歴のメッセージを平文にする
+def format_history(messages):
+    return "".join(message['role'] + ": " + message['content'] + "\n\n" for message in messages)
+
+
+# 会話履歴を max_tokens に収める。収まらない場合は古いメッセージを summarize(これまでの要約, メッセージ) で要約にまとめる
+# state は {"summary": 要約, "count": 要約済みのメッセージ数} で、セッションごとに保持して次のターンに引き継ぐ
+# 要約するときは直近のメッセージを max_tokens の半分まで残し、毎ターン要約しなくて済むようにする
+def compact_history(messages, state, max_tokens, summarize):
+    recent = messages[state["count"]:]
+    if count_tokens(__history_text(state["summary"], recent)) <= max_tokens:
+        return __history_text(state["summary"], recent)
+
+    keep = 0
+    kept_tokens = 0
+    for message in reversed(recent):
+        tokens = count_tokens(format_history([message]))
+        if kept_tokens + tokens > max_tokens // 2:
+            break
+        kept_tokens += tokens
+        keep += 1
+    older = recent[:len(recent) - keep]
+    if older:
+        state["summary"] = summarize(state["summary"], older)
+        state["count"] += len(older)
+    recent = messages[state["count"]:]
+    # それでも収まらない場合は、直近のメッセージを残すよう先頭(要約・古いメッセージ)から削る
+    return truncate_tokens_front(__history_text(state["summary"], recent), max_tokens)
+
+
+def __history_text(summary, messages):
+    text = SUMMARY_HEADER + summary + "\n\n" if summary else ""
+    return text + format_history(messages)
+
+
+# プロンプトを組み立てる。戻り値は (プロンプト, プロンプトに入れた情報源のリスト, トークン数などの内訳)
+def build_prompt(system_role, sources, messages, history_state, summarize, budget=PROMPT_TOKEN_BUDGET, history_tokens=PROMPT_HISTORY_TOKENS):
+    system_tokens = count_tokens(system_role + SOURCES_HEADER + HISTORY_HEADER + PROMPT_FOOTER)
+    history = compact_history(messages, history_state, min(history_tokens, max(budget - system_tokens, 0)), summarize)
+    history_used = count_tokens(history)
+
+    deduped = dedupe_sources(sources)
+    fitted, truncated, dropped = fit_sources(deduped, max(budget - system_tokens - history_used, 0))
+    prompt_source = "".join(format_source(source) for source in fitted)
+    sources_used = count_tokens(prompt_source)
+
+    prompt = system_role + SOURCES_HEADER + prompt_source + HISTORY_HEADER + history + PROMPT_FOOTER
+    stats = {
+        "system": system_tokens,
+        "sources": sources_used,
+        "history": history_used,
+        "total": system_tokens + sources_used + history_used,
+        "budget": budget,
+        "sources_retrieved": len(sources),
+        "sources_duplicated": len(sources) - len(deduped),
+        "sources_truncated": truncated,
+        "sources_dropped": dropped,
+        "summarized_messages": history_state["count"],
+    }
+    return prompt, fitted, stats
@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import argparse
+import importlib
+from dotenv import load_dotenv
+# 環境変数を読み込む
+load_dotenv()
+from startup import timed, timings, format_report
+from clients import (
+    RAG_BACKEND, get_openai_client, get_search_client, get_search_index_client, get_cosmos_database,
+    get_cosmos_container, get_blob_container_client, get_document_intelligence_client,
+)
+
+# 事前準備(プロビジョニング)とウォームアップ
+# プロビジョニング: Cosmos DB のコンテナ、Blob Storage のコンテナ、AI Search のインデックスが存在しない場合は作成する
+#   アプリ(app.py)やインデックス作成(preparedata.py)のリクエスト処理では作成しないため、デプロイ時などに1回だけ実行する
+# ウォームアップ: SDK などの重いモジュールの読み込み、トークナイザの読み込み、クライアントの生成、各サービスへの初回リクエストを行う
+#   app.py はプロセスの起動時にバックグラウンドで実行する。処理ごとの時間は起動時間のレポートに記録する
+#   python provision.py
+#   python provision.py --no-provision --output ./eval/output/startup.json
+
+AI_SEARCH_INDEX_NAME = os.getenv("AI_SEARCH_INDEX_NAME")
+AZURE_OPENAI_EMBED_MODEL = os.getenv("AZURE_OPENAI_EMBED_MODEL")
+COSMOS_CONTAINER_NAME_KB = os.getenv("COSMOS_CONTAINER_NAME_KB")
+COSMOS_CONTAINER_NAME_CHAT = os.getenv("COSMOS_CONTAINER_NAME_CHAT")
+
+# KB のコンテナのインデックスポリシー。ベクトルは検索に使わないため、書き込みの RU を減らすためにインデックスの対象から外す
+# (既存のコンテナには適用されない。変更する場合はポータルなどでインデックスポリシーを更新する)
+KB_INDEXING_POLICY = {
+    "indexingMode": "consistent",
+    "includedPaths": [{"path": "/*"}],
+    "excludedPaths": [{"path": "/contentVector/*"}, {"path": "/\"_etag\"/?"}],
+}
+
+# ウォームアップで読み込むモジュール。SDK はクライアントの生成時にも読み込まれるが、読み込み時間を分けて記録するため先に読み込む
+AZURE_MODULES = [
+    "openai",
+    "azure.search.documents",
+    "azure.search.documents.models",
+    "azure.cosmos",
+    "azure.storage.blob",
+    "azure.ai.documentintelligence",
+]
+APP_MODULES = ["numpy", "tiktoken", "rag", "preparedata"]
+
+
+# コンテナとインデックスが存在しない場合は作成する
+def provision(index_name=None):
+    index_name = index_name or AI_SEARCH_INDEX_NAME
+    with timed("provision.cosmos"):
+        # ローカルのスタンドインのコンテナは最初に使うときに作成される
+        if RAG_BACKEND != "local":
+            from azure.cosmos import PartitionKey
+            database = get_cosmos_database()
+            for container_name, indexing_policy in ((COSMOS_CONTAINER_NAME_KB, KB_INDEXING_POLICY), (COSMOS_CONTAINER_NAME_CHAT, None)):
+                if container_name:
+                    database.create_container_if_not_exists(
+                        id=container_name, partition_key=PartitionKey(path="/id"), indexing_policy=indexing_policy,
+                    )
+                    print("cosmos container:", container_name)
+    with timed("provision.blob"):
+        container_client = get_blob_container_client()
+        try:
+            container_client.get_container_properties()
+        except Exception:
+            container_client.create_container()
+            print("blob container created:", os.getenv("BLOB_CONTAINER_NAME"))
+    with timed("provision.search_index"):
+        from preparedata import ensure_index
+        ensure_index(index_name)
+        print("search index:", index_name)
+
+
+# 処理を実行して時間を記録する。失敗しても残りのウォームアップは続ける
+def __step(component, func):
+    try:
+        with timed(component):
+            return func()
+    except Exception as e:
+        print(f"warm up failed: {component}: {type(e).__name__}: {e}")
+        return None
+
+
+# モジュールの読み込み、クライアントの生成、各サービスへの初回リクエストを行う
+# send_requests=False の場合は各サービスへのリクエストを行わない
+def warm_up(index_name=None, send_requests=True):
+    index_name = index_name or AI_SEARCH_INDEX_NAME
+    start = time.perf_counter()
+    modules = (AZURE_MODULES if RAG_BACKEND != "local" else []) + APP_MODULES
+    for module in modules:
+        __step("import." + module, lambda: importlib.import_module(module))
+
+    from dococr.create_chunks import get_tiktoken_encoding
+    __step("tiktoken.encoding", get_tiktoken_encoding)
+
+    # クライアントの生成時間(SDK の読み込みを含む)は clients.py が client.<名前> として記録する
+    for create_client in (
+        get_openai_client,
+        lambda: get_search_client(index_name),
+        get_search_index_client,
+        lambda: get_cosmos_container(COSMOS_CONTAINER_NAME_CHAT),
+        get_blob_container_client,
+        get_document_intelligence_client,
+    ):
+        try:
+            create_client()
+        except Exception as e:
+            print(f"warm up failed: client: {type(e).__name__}: {e}")
+
+    # 初回リクエストで TLS 接続を確立しておく(Document Intelligence は課金されるため行わない)
+    if send_requests:
+        __step("request.openai", lambda: get_openai_client().embeddings.create(model=AZURE_OPENAI_EMBED_MODEL, input="warm up"))
+        __step("request.search", lambda: get_search_client(index_name).get_document_count())
+        __step("request.cosmos", lambda: get_cosmos_container(COSMOS_CONTAINER_NAME_CHAT).read())
+        __step("request.blob", lambda: get_blob_container_client().get_container_properties())
+
+    # プロセス内のベクトル検索を使う場合は、量子化した行列を読み込んでおく
+    from localindex import VECTOR_SEARCH_BACKEND, get_local_index
+    if VECTOR_SEARCH_BACKEND == "local":
+        __step("local_index.load", lambda: get_local_index(index_name).load())
+    print(f"warm up done: {time.perf_counter() - start:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Provision the containers and the index, then warm up and report the startup time.')
+    parser.add_argument('--index', type=str, default=AI_SEARCH_INDEX_NAME, help='Search index name.')
+    parser.add_argument('--no-provision', action='store_true', help='Skip creating the containers and the index.')
+    parser.add_argument('--no-requests', action='store_true', help='Do not send the first request to each service.')
+    parser.add_argument('--output', type=str, default=None, help='File to save the startup report to (JSON).')
+    args = parser.parse_args()
+
+    if not args.no_provision:
+        provision(args.index)
+    warm_up(args.index, send_requests=not args.no_requests)
+
+    print(format_report())
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"backend": RAG_BACKEND, "seconds": timings()}, f, ensure_ascii=False, indent=2)
+        print("saved:", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import os
+import re
+import asyncio
+import logging
+from localindex import VECTOR_SEARCH_BACKEND, DOC_FIELDS, get_local_index
+from diversify import MMR_FETCH_FACTOR, MMR_MAX_PER_FILE, diversify
+from promptbuilder import build_prompt, sources_from_results, format_source, cited_sources
+from tracing import traced, start_span
+
+# 質問に対する検索と回答の生成(RAG のリクエスト処理)
+# app.py とベンチマーク(bench_rag.py)で共通の処理。クライアントは呼び出し側から渡す
+# *_async の関数と answer_events は非同期のクライアント(clients.get_async_*)を使う非同期版(api.py 用)
+
+AI_SEACH_SEMANTIC = os.getenv("AI_SEACH_SEMANTIC")
+
+# OpenAIへのプロンプト設計を行う。
+SystemPrompt = """あなたは、会社の従業員が社内のナレッジやドキュメントに対する質問をする際に支援する優秀なアシスタントです。
+以下の制約を必ず守ってユーザの質問に回答してください。
+ハルシネーションは起こさないでください。
+魅力的で丁寧な回答をする必要があります。
+最初から最後までじっくり読んで回答を作ってください。最高の仕事をしましょう
+
+# 制約 
+・以下のSources(情報源)に記載されたコンテキストのみを使用して回答してください。必ず情報源に記載されたコンテキストを基に回答を作ってください
+・十分な情報がない場合は、わからないと回答してください。
+・以下のSources(情報源)を使用しない回答は生成しないでください 。回答には役割(userやassistantなど)の情報を含めないでください。
+・ユーザーの質問が不明瞭な場合は、明確化のためにユーザに質問してください。
+・Sourcesには、名前の後にコロンと実際の情報が続きます。回答で使用する各事実について、常にSourcesの情報を含めてください。
+  情報源を参照するには、各Content情報の前段にあるfilenameの情報を反映してください。角かっこを使用してください。
+  Sources参照ルール：[filename] 　Sources出力例：[info1.txt]
+・Sourcesを組み合わせないでください。各Sourcesを個別にリストしてください。例：[info1.txt],[info1.txt]
+・日本語の質問の場合は、日本語で回答を作成してください。英語での質問の場合は、英語で回答を作成し回答してください。    
+"""
+
+
+# 質問のテキストを整形する(改行・連続する空白をまとめ、長すぎる場合は切り詰める)
+def normalize_query(text, text_limit=7000):
+    # Clean up text (e.g. line breaks, )
+    text = re.sub(r'\s+', ' ', text).strip()
+    text = re.sub(r'[\n\r]+', ' ', text).strip()
+    # Truncate text if necessary
+    if len(text) > text_limit:
+        logging.warning("Token limit exceeded maximum length, truncating...")
+        text = text[:text_limit]
+    return text
+
+
+# テキストのベクトルを生成する
+@traced("embed_query")
+def embed_query(client, model, text):
+    response = client.embeddings.create(model=model, input=text)
+    return response.data[0].embedding
+
+
+# インデックスを検索して結果のリストを返す
+# with_vectors=True の場合は結果にベクトル(contentVector)を含める(検索結果の多様化用。diversify.py を参照)
+# timeout(秒)を指定した場合は、Azure AI Search へのリクエストを接続・読み込みのタイムアウトと再実行を含めた全体のタイムアウトで打ち切る
+@traced("search_documents")
+def search_documents(search_client, index_name, query, vector, searchtype, top_k, with_vectors=False, timeout=None):
+    # VECTOR_SEARCH_BACKEND が local の場合、Vector_only と Hybrid はローカルのインデックスでプロセス内で検索する
+    # (Semantic_Hybrid はセマンティックランカーが必要なため Azure AI Search を使う)
+    if searchtype == "Vector_only" and VECTOR_SEARCH_BACKEND == "local":
+        return get_local_index(index_name).search(vector, top_k, with_vectors=with_vectors)
+    if searchtype == "Hybrid" and VECTOR_SEARCH_BACKEND == "local":
+        return get_local_index(index_name).hybrid_search(query, vector, top_k, with_vectors=with_vectors)
+    kwargs = __search_kwargs(query, vector, searchtype, top_k, with_vectors)
+    if timeout is not None:
+        kwargs.update(timeout=timeout, connection_timeout=timeout, read_timeout=timeout)
+    results = search_client.search(**kwargs)
+    # 検索結果は読み出す時に取得されるため、ここで全件を取得する
+    return list(results)
+
+
+# Azure AI Search の search() の引数を作成する
+def __search_kwargs(query, vector, searchtype, top_k, with_vectors):
+    from azure.search.documents.models import VectorizedQuery
+    vector_query = VectorizedQuery(vector=vector, fields="contentVector")
+    # searchtypeがvector_onlyの場合は、search_textをNoneにする
+    if searchtype == "Vector_only":
+        search_text = None
+    # searchtypeがvector_only以外の場合は、search_textにqueryを設定する
+    else:
+        search_text = query
+    # ベクトルは必要な場合だけ取得する(3072次元で1件あたり数十KBになるため)
+    select = DOC_FIELDS + (["contentVector"] if with_vectors else [])
+
+    kwargs = {"search_text": search_text, "vector_queries": [vector_query], "top": top_k, "select": select}
+    # searchtypeがFullの場合
+    if searchtype != "Vector_only" and searchtype != "Hybrid":
+        kwargs.update(query_type='semantic', semantic_configuration_name=AI_SEACH_SEMANTIC)
+    return kwargs
+
+
+# 回答をストリーミングで生成し、生成されたテキストを順に返す
+# ジェネレータのため with では囲まず、最初のトークンまでの時間をスパンの属性に記録する
+def stream_answer(client, model, messages, temperature, max_tokens):
+    s = start_span("chat_stream", model=model)
+    try:
+        output = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+        )
+        for chunk in output:
+            # コンテンツフィルタの結果など、choices が空のチャンクは読み飛ばす
+            if chunk.choices and chunk.choices[0].delta.content:
+                if "first_token_ms" not in s.attributes:
+                    s.set_attribute("first_token_ms", s.duration_ms)
+                yield chunk.choices[0].delta.content
+    except Exception as e:
+        s.end(e)
+        raise
+    finally:
+        s.end()
+
+
+# embed_query の非同期版
+@traced("embed_query")
+async def embed_query_async(client, model, text):
+    response = await client.embeddings.create(model=model, input=text)
+    return response.data[0].embedding
+
+
+# search_documents の非同期版
+@traced("search_documents")
+async def search_documents_async(search_client, index_name, query, vector, searchtype, top_k, with_vectors=False):
+    # ローカルのインデックスの検索は CPU の処理のため、イベントループを止めないよう別スレッドで行う
+    if searchtype == "Vector_only" and VECTOR_SEARCH_BACKEND == "local":
+        return await asyncio.to_thread(get_local_index(index_name).search, vector, top_k, with_vectors=with_vectors)
+    if searchtype == "Hybrid" and VECTOR_SEARCH_BACKEND == "local":
+        return await asyncio.to_thread(get_local_index(index_name).hybrid_search, query, vector, top_k, with_vectors=with_vectors)
+    results = await search_client.search(**__search_kwargs(query, vector, searchtype, top_k, with_vectors))
+    return [result async for result in results]
+
+
+# stream_answer の非同期版
+async def stream_answer_async(client, model, messages, temperature, max_tokens):
+    s = start_span("chat_stream", model=model)
+    try:
+        output = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+        )
+        async for chunk in output:
+            if chunk.choices and chunk.choices[0].delta.content:
+                if "first_token_ms" not in s.attributes:
+                    s.set_attribute("first_token_ms", s.duration_ms)
+                yield chunk.choices[0].delta.content
+    except Exception as e:
+        s.end(e)
+        raise
+    finally:
+        s.end()
+
+
+# 会話履歴の要約は行わず、これまでの要約をそのまま返す(上限を超える古いメッセージは切り捨てられる)
+def __keep_summary(summary, messages):
+    return summary
+
+
+# 質問への回答(質問のベクトル化 → 検索 → 多様化 → プロンプトの作成 → 回答の生成)を行い、(イベント名, データ) を順に返す
+#   sources: プロンプトに入れた情報源のリスト
+#   token:   回答のテキストの断片
+#   done:    回答全体、回答で参照された情報源、プロンプトのトークン数の内訳、プロンプトに入れた情報源のテキスト
+# history には会話履歴のメッセージ({"role", "content"})のリストを指定する。mmr_lambda を指定した場合は検索結果を多様化する
+async def answer_events(openai_client, search_client, index_name, query, chat_model, embed_model, search_type="Hybrid", top_k=10,
+                        mmr_lambda=None, max_per_file=MMR_MAX_PER_FILE, temperature=0.0, max_tokens=1000,
+                        system_role=SystemPrompt, history=None):
+    vector = await embed_query_async(openai_client, embed_model, normalize_query(query))
+    if mmr_lambda is None:
+        results = await search_documents_async(search_client, index_name, query, vector, search_type, top_k)
+    else:
+        results = await search_documents_async(search_client, index_name, query, vector, search_type, top_k * MMR_FETCH_FACTOR, with_vectors=True)
+        results = diversify(results, top_k, mmr_lambda, max_per_file)
+
+    # プロンプトの作成(トークン数の計算)は CPU の処理のため、イベントループを止めないよう別スレッドで行う
+    prompt, sources, stats = await asyncio.to_thread(
+        build_prompt, system_role, sources_from_results(results), history or [], {"summary": "", "count": 0}, __keep_summary,
+    )
+    yield "sources", [{"filename": source["filename"], "title": source["title"], "score": source["score"]} for source in sources]
+
+    messages = [{"role": "system", "content": prompt}, {"role": "user", "content": query}]
+    answer = ""
+    async for content in stream_answer_async(openai_client, chat_model, messages, temperature, max_tokens):
+        answer += content
+        yield "token", content
+
+    yield "done", {
+        "answer": answer,
+        "citations": [
+            {"filename": name, "title": source["title"], "content": source["content"]}
+            for name, source in cited_sources(answer, sources)
+        ],
+        "prompt_tokens": stats,
+        "prompt_source": "".join(format_source(source) for source in sources),
+    }
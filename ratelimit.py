@@ -0,0 +1,132 @@
+import time
+import random
+import threading
+from collections import deque
+from tracing import count
+
+# 429 以外で再実行の対象とするステータスコードと、接続エラー・タイムアウトの例外のクラス名(openai を読み込まずに判定する)
+TRANSIENT_STATUS_CODES = {408, 500, 502, 503, 504}
+TRANSIENT_ERROR_NAMES = {"APIConnectionError", "APITimeoutError", "ConnectionError", "TimeoutError"}
+
+
+# 1分あたりのリクエスト数(RPM)とトークン数(TPM)を制限するレートリミッタ
+# 429 を受けた場合は Retry-After の間すべてのリクエストを止め、許容量を一時的に下げる
+class RateLimiter:
+    def __init__(self, name, rpm, tpm):
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        # 429 を受けた際に許容量に掛ける係数(0.1〜1.0)。成功が続くと元に戻していく
+        self.scale = 1.0
+        self.paused_until = 0.0
+        self.requests = deque()  # (送信時刻, トークン数)
+        self.used_tokens = 0  # 直近60秒の使用トークン数
+        self.total_tokens = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    # 指定トークン数のリクエストを送信できるまで待機する
+    def acquire(self, tokens):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    wait = self.__wait_for_budget(now, tokens)
+                if wait <= 0:
+                    self.requests.append((now, tokens))
+                    self.used_tokens += tokens
+                    self.total_tokens += tokens
+                    return
+            time.sleep(wait)
+
+    # 直近60秒の使用量から、送信可能になるまでの待ち時間を計算する
+    def __wait_for_budget(self, now, tokens):
+        while self.requests and now - self.requests[0][0] >= 60:
+            _, old_tokens = self.requests.popleft()
+            self.used_tokens -= old_tokens
+        if not self.requests:
+            return 0
+        rpm = max(1, int(self.rpm * self.scale)) if self.rpm else None
+        tpm = max(tokens, int(self.tpm * self.scale)) if self.tpm else None
+        over_requests = rpm is not None and len(self.requests) >= rpm
+        over_tokens = tpm is not None and self.used_tokens + tokens > tpm
+        if not over_requests and not over_tokens:
+            return 0
+        return max(0.05, 60 - (now - self.requests[0][0]))
+
+    # 成功したリクエストを記録し、下げていた許容量を少しずつ戻す
+    def success(self):
+        with self.lock:
+            self.scale = min(1.0, self.scale + 0.05)
+
+    # 429 を受けた場合に、指定秒数すべてのリクエストを止めて許容量を半分にする
+    def backoff(self, seconds):
+        with self.lock:
+            self.throttled += 1
+            self.scale = max(0.1, self.scale / 2)
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+# 例外(openai.RateLimitError など)のレスポンスヘッダから Retry-After の秒数を取得する
+def get_retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    for key, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(key)
+        if value is None:
+            continue
+        try:
+            return float(value) * scale
+        except ValueError:
+            pass
+    return None
+
+
+# 例外のステータスコードを取得する(ない場合は None)
+def __status_code(error):
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code
+
+
+# 429 かどうかを判定する
+def is_rate_limit_error(error):
+    return __status_code(error) == 429
+
+
+# 一時的なエラー(5xx・接続エラー・タイムアウト)かどうかを判定する
+def is_transient_error(error):
+    if __status_code(error) in TRANSIENT_STATUS_CODES:
+        return True
+    return any(cls.__name__ in TRANSIENT_ERROR_NAMES for cls in type(error).__mro__)
+
+
+# レートリミッタの許容量を待ってから func を実行する。429 の場合は Retry-After に従って再実行する
+# 一時的なエラー(5xx・接続エラー・タイムアウト)の場合は、許容量は下げずに指数バックオフで再実行する
+def call_with_rate_limit(limiter, tokens, func, *args, max_retries=8, **kwargs):
+    for attempt in range(max_retries + 1):
+        limiter.acquire(tokens)
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            if is_transient_error(e):
+                wait = min(30, 0.5 * 2 ** attempt) + random.uniform(0, 0.5)
+                print(f"transient error ({limiter.name}): {type(e).__name__}, retry after {wait:.1f}s")
+                count("retries.transient")
+                time.sleep(wait)
+                continue
+            if not is_rate_limit_error(e):
+                raise
+            wait = get_retry_after(e)
+            if wait is None:
+                wait = min(60, 2 ** attempt) + random.uniform(0, 1)
+            print(f"rate limited ({limiter.name}), retry after {wait:.1f}s")
+            count("retries.rate_limit")
+            limiter.backoff(wait)
+            continue
+        limiter.success()
+        return result
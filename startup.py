@@ -0,0 +1,41 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# 起動時間の内訳
+# モジュールの読み込み・クライアントの生成・初回リクエストなど、起動時の処理ごとの秒数を記録し、起動時間のレポートにする
+# クライアントの生成(clients.py)とウォームアップ(provision.py)から記録する
+
+__lock = threading.Lock()
+__timings = {}
+
+
+# 処理の秒数を記録する。同じ名前の処理は加算する
+def record(component, seconds):
+    with __lock:
+        __timings[component] = __timings.get(component, 0.0) + seconds
+
+
+# with で囲んだ処理の秒数を記録する
+@contextmanager
+def timed(component):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(component, time.perf_counter() - start)
+
+
+# 記録した秒数を {処理: 秒数} で返す
+def timings():
+    with __lock:
+        return dict(__timings)
+
+
+# 起動時間のレポートを、時間のかかった順に1行ずつの文字列にする
+def format_report(values=None):
+    values = timings() if values is None else values
+    total = sum(values.values())
+    lines = [f"{component:40s} {seconds * 1000:9.1f} ms" for component, seconds in sorted(values.items(), key=lambda x: -x[1])]
+    lines.append(f"{'total':40s} {total * 1000:9.1f} ms")
+    return "\n".join(lines)
@@ -0,0 +1,284 @@
+import os
+import time
+import json
+import atexit
+import inspect
+import pstats
+import cProfile
+import threading
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+from datetime import datetime
+
+# 処理時間の計測(スパン)とカウンタ
+# span("名前") / @traced("名前") で処理時間を計測し、親子関係(トレース)とともに記録する
+# count("名前", 値) でトークン数・バイト数・再実行回数・キャッシュヒットなどを数える。実行中のスパンの属性にも加算する
+# TRACE_EXPORT_ENABLED=true の場合は、終了したスパンを OpenTelemetry の OTLP/JSON 形式(1行に1つの ExportTraceServiceRequest)でファイルに書き出す
+# (OpenTelemetry Collector の otlpjsonfile レシーバなどでそのまま読み込める)
+# profile("名前") で囲んだ処理は PROFILE_ENABLED=true の場合に cProfile でプロファイルする
+
+# スパンの書き出しの有効・無効と、書き出し先(空の場合は書き出さない)、ファイルを切り替えるサイズ
+TRACE_EXPORT_ENABLED = os.getenv("TRACE_EXPORT_ENABLED", "false").lower() == "true"
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", os.path.join(".ragcache", "traces.jsonl")) if TRACE_EXPORT_ENABLED else ""
+TRACE_EXPORT_MAX_MB = int(os.getenv("TRACE_EXPORT_MAX_MB", "100"))
+# 書き出し待ちのスパンがこの件数を超えるか、前回の書き出しからこの秒数が経過したら書き出す
+TRACE_EXPORT_BATCH_SIZE = 64
+TRACE_EXPORT_INTERVAL = 5.0
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "rag-app")
+# cProfile によるプロファイルの有効・無効と、結果(.prof)の保存先
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "false").lower() == "true"
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(".ragcache", "profiles"))
+
+# OpenTelemetry のステータスコード
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+__current_span = contextvars.ContextVar("current_span", default=None)
+__lock = threading.Lock()
+__counters = {}
+__pending = []
+__last_export = time.time()
+# ファイルへの書き出しは __lock とは別のロックで行い、書き出し中もスパンの記録とカウンタの加算を待たせない
+__export_lock = threading.Lock()
+__profile_lock = threading.Lock()
+
+
+class Span:
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.parent = parent
+        self.root = parent.root if parent is not None else self
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.attributes = dict(attributes)
+        self.status = STATUS_OK
+        self.message = ""
+        self.start_ns = time.time_ns()
+        self.start = time.perf_counter()
+        self.duration = None
+        # ルートのスパンには、同じトレースで終了したスパンを記録する(ステージごとの処理時間の表示用)
+        self.finished = [] if parent is None else None
+        # propagate() したワーカースレッドから同じスパンのカウンタに加算されるため、加算はロックして行う
+        self.lock = threading.Lock()
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    # 数値の属性に加算する
+    def add(self, key, value=1):
+        with self.lock:
+            self.attributes[key] = self.attributes.get(key, 0) + value
+
+    # スパンを終了する。error を指定した場合はエラーとして記録する
+    def end(self, error=None):
+        end_span(self, error)
+
+    @property
+    def duration_ms(self):
+        return (self.duration if self.duration is not None else time.perf_counter() - self.start) * 1000
+
+
+# 実行中のスパンを返す
+def current_span():
+    return __current_span.get()
+
+
+# スパンを終了し、ルートのスパンへの記録と書き出しを行う
+def end_span(s, error=None):
+    if s.duration is not None:
+        return
+    s.duration = time.perf_counter() - s.start
+    if error is not None:
+        s.status = STATUS_ERROR
+        s.message = f"{type(error).__name__}: {error}"
+    with __lock:
+        s.root.finished.append(s)
+    __export(s)
+
+
+# スパンを開始する。実行中のスパンの子になるが、実行中のスパンにはならない(ジェネレータなど、with で囲めない処理用)
+# 終了時に span.end() を呼び出す
+def start_span(name, **attributes):
+    return Span(name, __current_span.get(), attributes)
+
+
+# with で囲んだ処理のスパンを記録する。処理中はこのスパンが実行中のスパンになる
+@contextmanager
+def span(name, **attributes):
+    s = start_span(name, **attributes)
+    token = __current_span.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.end(e)
+        raise
+    finally:
+        __current_span.reset(token)
+        s.end()
+
+
+# 関数の処理時間をスパンとして記録するデコレータ(async 関数にも使える)
+def traced(name=None):
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# 別スレッドで実行する関数が、呼び出し元のスパンの子としてスパンを記録するようにする(ThreadPoolExecutor 用)
+def propagate(func):
+    parent = __current_span.get()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        token = __current_span.set(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            __current_span.reset(token)
+    return wrapper
+
+
+# カウンタに加算する。実行中のスパンがあれば、その属性にも加算する
+def count(name, value=1):
+    with __lock:
+        __counters[name] = __counters.get(name, 0) + value
+    s = __current_span.get()
+    if s is not None:
+        s.add(name, value)
+
+
+# カウンタの値を返す
+def counters():
+    with __lock:
+        return dict(__counters)
+
+
+# カウンタの値を1行の文字列にする
+def format_counters():
+    return ", ".join(f"{name}={value}" for name, value in sorted(counters().items()))
+
+
+# ルートのスパンのトレースで終了したスパンの処理時間を、スパン名ごとに {名前: (回数, 合計ミリ秒)} で返す
+def stage_durations(root):
+    stages = {}
+    with __lock:
+        finished = list(root.finished)
+    for s in finished:
+        if s is root:
+            continue
+        calls, total = stages.get(s.name, (0, 0.0))
+        stages[s.name] = (calls + 1, total + s.duration_ms)
+    return stages
+
+
+# ステージごとの処理時間を1行の文字列にする
+def format_stages(root):
+    return ", ".join(
+        f"{name} {total:.0f}ms" + (f" x{calls}" if calls > 1 else "")
+        for name, (calls, total) in stage_durations(root).items()
+    )
+
+
+# スパンを書き出し待ちに追加し、件数か経過時間が閾値を超えたら書き出す
+def __export(s):
+    if not TRACE_EXPORT_PATH:
+        return
+    with __lock:
+        __pending.append(s)
+        if len(__pending) < TRACE_EXPORT_BATCH_SIZE and time.time() - __last_export < TRACE_EXPORT_INTERVAL and s.parent is not None:
+            return
+    flush()
+
+
+# 書き出し待ちのスパンをファイルに書き出す。書き出し待ちのスパンだけをロックして取り出し、ファイルへの書き込みはロックの外で行う
+def flush():
+    global __last_export
+    with __lock:
+        spans = list(__pending)
+        __pending.clear()
+        __last_export = time.time()
+    if not spans or not TRACE_EXPORT_PATH:
+        return
+    line = json.dumps(__to_otlp(spans), ensure_ascii=False) + "\n"
+    with __export_lock:
+        os.makedirs(os.path.dirname(TRACE_EXPORT_PATH) or ".", exist_ok=True)
+        if os.path.exists(TRACE_EXPORT_PATH) and os.path.getsize(TRACE_EXPORT_PATH) > TRACE_EXPORT_MAX_MB * 1024 * 1024:
+            os.replace(TRACE_EXPORT_PATH, TRACE_EXPORT_PATH + ".1")
+        with open(TRACE_EXPORT_PATH, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+atexit.register(flush)
+
+
+# スパンのリストを OTLP/JSON の ExportTraceServiceRequest にする
+def __to_otlp(spans):
+    return {"resourceSpans": [{
+        "resource": {"attributes": __otlp_attributes({"service.name": TRACE_SERVICE_NAME, "process.pid": os.getpid()})},
+        "scopeSpans": [{
+            "scope": {"name": "tracing"},
+            "spans": [{
+                "traceId": s.trace_id,
+                "spanId": s.span_id,
+                "parentSpanId": s.parent.span_id if s.parent is not None else "",
+                "name": s.name,
+                "kind": 1,
+                "startTimeUnixNano": str(s.start_ns),
+                "endTimeUnixNano": str(s.start_ns + int(s.duration * 1e9)),
+                "attributes": __otlp_attributes(s.attributes),
+                "status": {"code": s.status, "message": s.message},
+            } for s in spans],
+        }],
+    }]}
+
+
+def __otlp_attributes(attributes):
+    result = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            value = {"boolValue": value}
+        elif isinstance(value, int):
+            value = {"intValue": str(value)}
+        elif isinstance(value, float):
+            value = {"doubleValue": value}
+        else:
+            value = {"stringValue": str(value)}
+        result.append({"key": key, "value": value})
+    return result
+
+
+# with で囲んだ処理を cProfile でプロファイルし、PROFILE_DIR/<名前>_<日時>.prof に保存して上位を表示する
+# cProfile は同時に1つしか実行できないため、他のスレッドでプロファイル中の場合は何もしない
+@contextmanager
+def profile(name, enabled=None):
+    if not (PROFILE_ENABLED if enabled is None else enabled) or not __profile_lock.acquire(blocking=False):
+        yield
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prof")
+        profiler.dump_stats(path)
+        print("profile saved:", path)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+    finally:
+        __profile_lock.release()
@@ -0,0 +1,45 @@
+import base64
+import numpy as np
+
+# Cosmos DB に保存するベクトルの形式
+# json: float の配列のまま保存する(3072次元で約60KB)
+# float32 / float16: リトルエンディアンのバイト列を base64 の文字列にして保存する(3072次元でそれぞれ約16KB / 約8KB)
+# base64 で保存した場合は、形式を <フィールド名>Format に記録する。読み出す側は decode_item() でベクトル(floatのリスト)に戻す
+VECTOR_FORMATS = {"json": None, "float32": "<f4", "float16": "<f2"}
+
+
+# ベクトルを指定した形式の値にする
+def encode_vector(vector, vector_format):
+    if vector_format not in VECTOR_FORMATS:
+        raise ValueError(f"unsupported vector format: {vector_format}")
+    if vector_format == "json":
+        return list(vector)
+    data = np.asarray(vector, dtype=VECTOR_FORMATS[vector_format]).tobytes()
+    return base64.b64encode(data).decode("ascii")
+
+
+# encode_vector() の値をベクトルに戻す
+def decode_vector(value, vector_format):
+    if value is None or vector_format in (None, "json"):
+        return value
+    if vector_format not in VECTOR_FORMATS:
+        raise ValueError(f"unsupported vector format: {vector_format}")
+    data = base64.b64decode(value)
+    return np.frombuffer(data, dtype=VECTOR_FORMATS[vector_format]).astype(np.float32).tolist()
+
+
+# ドキュメントのベクトルのフィールドを指定した形式にしたコピーを返す
+def encode_item(item, vector_format, field="contentVector"):
+    if vector_format == "json":
+        return item
+    return dict(item, **{field: encode_vector(item[field], vector_format), field + "Format": vector_format})
+
+
+# Cosmos DB から読み出したドキュメントのベクトルのフィールドを floatのリストに戻したコピーを返す
+def decode_item(item, field="contentVector"):
+    vector_format = item.get(field + "Format")
+    if vector_format is None:
+        return item
+    item = {key: value for key, value in item.items() if key != field + "Format"}
+    item[field] = decode_vector(item[field], vector_format)
+    return item